@@ -1 +1,4 @@
-from .fits_r import *
\ No newline at end of file
+from .fits_r import *
+from .pool import FittingPool
+from .result import FitResult, convert_legacy, load_spaxel_results
+from .unwrapped import UnwrappedCube, open_unwrapped, convert_unwrapped
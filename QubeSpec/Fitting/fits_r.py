@@ -43,11 +43,53 @@ from ..Models import QSO_models as QSO_models
 from ..Models import Halpha_models as H_models
 from ..Models import Full_optical as FO_models
 from ..Models import Custom_model
+from ..Models.Chi2_kernels import chi2_kernels, chi2_kernels_FeII, FeII_kernel, chi2_block, window_k, pixel_edges
+from ..Models import FeII_models as Fem
+from ..Models import Compiled_models
+from ..Models import Model_builder
+from .pool import FittingPool
+from .result import FitResult, model_name
+from .linear import solve_amplitudes
 import numba
 from .. import Utils as sp
 
 from .priors import * 
 
+# attributes of Fitting read by log_probability_general and log_probability_linear - the state sent to the FittingPool workers
+pool_attributes = ['wave_fitloc', 'flux_fitloc', 'error_fitloc', 'pr_code', 'prior', 'log_prior_fce', 'fitted_model', 'template',
+                   'use_kernels', 'tolerance', 'lsf_sigma', 'edges', 'broadcasts', 'linear', 'labels', 'linear_idx',
+                   'nonlinear_idx', 'pr_code_nonlinear', 'prior_nonlinear', 'linear_use', 'linear_table', 'linear_column',
+                   'linear_cons', 'linear_lo', 'linear_hi', 'linear_log', 'linear_draws']
+
+# fitting method -> model keyword -> (line table in Models.Model_builder.line_tables, name of the result)
+named_models = {'Halpha': {'gal': ('Halpha', 'Halpha_wth_BLR'),
+                           'outflow': ('Halpha_outflow', 'Halpha_wth_out'),
+                           'BLR_simple': ('Halpha_wBLR', 'Halpha_wth_BLR'),
+                           'BLR': ('Halpha_BLR_outflow', 'Halpha_wth_BLR'),
+                           'QSO_BKPL': ('Hal_QSO_BKPL', 'Halpha_QSO_BKPL')},
+                'OIII': {'gal': ('OIII_gal', 'OIII_simple'),
+                         'gal_simple': ('OIII_gal', 'OIII_simple'),
+                         'outflow': ('OIII_outflow', 'OIII_outflow_simple'),
+                         'outflow_simple': ('OIII_outflow', 'OIII_outflow_simple'),
+                         'BLR_simple': ('OIII_gal_BLR', 'OIII_BLR_simple'),
+                         'BLR_outflow': ('OIII_outflow_BLR', 'OIII_simple'),
+                         'QSO_BKPL': ('OIII_QSO_BKPL', 'OIII_QSO_BKP')},
+                'Halpha_OIII': {'gal': ('Halpha_OIII', 'Halpha_OIII'),
+                                'outflow': ('Halpha_OIII_outflow', 'Halpha_OIII_outflow'),
+                                'BLR': ('Halpha_OIII_BLR', 'Halpha_OIII_BLR'),
+                                'BLR_simple': ('Halpha_OIII_BLR_simple', 'Halpha_OIII_BLR_simple'),
+                                'QSO_BKPL': ('Halpha_OIII_QSO_BKPL', 'Halpha_OIII_BLR')},
+                'optical': {'gal': ('Full_optical', 'Full_optical'),
+                            'outflow': ('Full_optical_outflow', 'Full_optical_outflow')}}
+
+# the same with a FeII template - the other models ignore the template
+named_models_FeII = {'OIII': {'BLR_simple': ('OIII_gal_BLR_Fe', 'OIII_BLR_simple_fe'),
+                              'BLR_outflow': ('OIII_outflow_BLR_Fe', 'OIII_simple')},
+                     'Halpha_OIII': {'BLR_simple': ('Halpha_OIII_BLR_simple_Fe', 'Halpha_OIII_BLR_simple')}}
+
+# line tables fitted with the compiled scipy prior (Models.Compiled_models.log_prior_scipy) instead of logprior_general
+scipy_prior_tables = ['OIII_QSO_BKPL']
+
 class Fitting:
     """ Simple class containing everything that we need to fit a spectrum and also all of its results. 
 
@@ -77,10 +119,64 @@ class Fitting:
 
     priors: dict - optional
         dictionary with all of the priors to update
+
+    linear: str - optional
+        None (default) samples all of the parameters with emcee. 'nnls' or 'marginalise' sample only the
+        nonlinear parameters (z, fwhms, velocities, ...) and solve for the line peaks and cont (the model is linear
+        in them) at each step: 'nnls' by non-negative weighted least squares (profile likelihood), 'marginalise'
+        by marginalisation over their prior. The amplitudes need uniform or loguniform priors (other priors
+        raise an exception) and both modes keep their bounds. The amplitudes stored with each step are a draw
+        from their conditional posterior given the nonlinear parameters (truncated to the prior bounds, with the
+        prior density and the constraints), so chains, props and labels keep the full set of parameters.
+        nnls is faster to converge but its nonlinear parameters follow the profile likelihood, marginalise samples
+        the same posterior as linear=None. See linear_draws.
+
+    autocorr: bool - optional
+        convergence driven run. The integrated autocorrelation time tau is checked every autocorr_check steps and the
+        run stops (before N, which becomes the maximum) once N > autocorr_factor*tau and tau changed by less than 
+        autocorr_tol. The burn-in (2*max tau) and thinning (0.5*min tau) are then set from tau instead of the fixed
+        values. The realised number of steps and tau are stored in N_run and tau after every fit. Default False.
+
+    map_start: bool - optional
+        find the maximum a posteriori first (bounded scipy minimisation of the negative log probability) and start
+        the walkers in a small ball (relative size map_ball) around it instead of around the prior central values.
+        The search is bounded to the prior ranges (loc +- map_nsigma scale for the normal priors) and the MAP is
+        only used if it improves on the best initial walker (MAP_used). The MAP and the optimiser cost are stored
+        in MAP, MAP_logprob, MAP_nfev and MAP_time. Default False.
+        
+    pool: FittingPool - optional
+        persistent worker pool (Fitting.FittingPool) owned by the caller and shared by consecutive fits. The data
+        are sent to the workers once per fit and each step only sends one block of walkers per worker. Overrides ncpu.
+        
+    backend: str - optional
+        path of an HDF5 file (group backend_name, default 'mcmc') where the emcee appends the chains and log
+        probabilities as it runs (Utils.chain_backend). If the file already holds a chain of the same shape from
+        the same fit (labels, model, priors and fitted data - see chain_signature), the fit resumes from the last
+        stored walker positions and only runs the missing steps up to N, and the chains/props are read from the
+        file. A chain from any other fit is overwritten. Default None - chains kept in memory only.
+
+    lsf: LSF - optional
+        instrumental line spread function (Models.LSF.LSF, e.g. Cube.lsf). sigma_instr is computed on the fit
+        window once per fit and each Gaussian is broadened at its centre in quadrature, keeping its flux - the fitted
+        peaks and FWHMs are the intrinsic ones. Needs a model with a fused chi2 kernel or a compiled equivalent.
+        Default None.
+
+    integrate: bool - optional
+        average the Gaussians over the pixels (difference of erf at the pixel edges) instead of sampling them at the
+        pixel centres - removes the bias on undersampled narrow lines (e.g. PRISM, R1000) without oversampling the
+        grid. The pixel edges are computed once per fit. Needs a model with a fused chi2 kernel or a compiled
+        equivalent. Default False.
+
+    warm_start: dict - optional
+        label: (value, sigma) to start the walkers from instead of the prior central values, e.g. the posteriors of
+        the already fitted neighbouring spaxels (Spaxel_fitting schedule='waves'). The walkers are drawn from a
+        normal of width warm_ball*sigma around value, labels not in the dict keep their default start. If all of the
+        sampled parameters are warm started the run is shortened to (0.5+warm_burnin)*N steps and only
+        warm_burnin*N steps are discarded as burn-in (self.warm is then True). Default None.
         
     """
        
-    def __init__(self, wave='', flux='', error='', z='', N=5000,ncpu=1, progress=True, priors= {'z':[0, 'normal', 0,0.003]}):
+    def __init__(self, wave='', flux='', error='', z='', N=5000,ncpu=1, progress=True, priors= {'z':[0, 'normal', 0,0.003]}, linear=None, autocorr=False, map_start=False, pool=None, backend=None, lsf=None, integrate=False, warm_start=None):
         priors_update = priors.copy()
         priors= {'z':[0, 'normal', 0,0.003],\
                 'cont':[0,'loguniform',-4,1],\
@@ -106,7 +202,7 @@ class Fitting:
                 'BLR_Hbeta_peak':[0,'loguniform', -3,1]}
         
         for name in list(priors_update.keys()):
-            priors[name] = priors_update[name]
+            priors[name] = list(priors_update[name]) # copy - the fitting methods centre the z priors in place
 
         self.N = N # Number of points in the chains
         self.priors = priors # storing priors
@@ -116,12 +212,39 @@ class Fitting:
         self.fluxs = flux # flux density
         self.error = error # errors
         self.ncpu= ncpu # number of cpus to use in the fit 
+        self.vectorize = False # evaluate likelihood on all walkers at once
+        self.broadcasts = None # fitted_model broadcasts over walkers, found by model_eval_vectorized
+        self.use_kernels = True # use the fused numba chi2 kernel if the fitted model has one
+        self.tolerance = None # kernels/compiled models evaluate each Gaussian only where it is above tolerance*peak
+        if linear not in [None, 'nnls', 'marginalise']:
+            raise Exception('linear keyword not understood. Available: None, nnls, marginalise')
+        self.linear = linear # solve for the linear amplitudes instead of sampling them
+        self.linear_draws = 16 # importance draws of the amplitudes per step in linear mode (marginal likelihood estimate and sample)
+        self.autocorr = autocorr # stop the emcee once the chains converged
+        self.autocorr_check = 100 # check tau every this many steps
+        self.autocorr_factor = 50 # converged once N > autocorr_factor*tau
+        self.autocorr_tol = 0.01 # and the relative change in tau is below this
+        self.map_start = map_start # start the walkers around the MAP
+        self.map_ball = 1e-3 # relative size of the ball of walkers around the MAP
+        self.map_nsigma = 5 # the MAP search is bounded to loc +- map_nsigma scale for the normal priors
+        self.pool = pool # persistent FittingPool shared between fits
+        self.prior_constraints = None # physical constraints of the compiled prior (see priors.physical_constraints) - None: named_constraints for the named models, none otherwise
+        self.backend = backend # HDF5 file to stream the chains to
+        self.backend_name = 'mcmc' # group in the HDF5 file
+        self.lsf = lsf # instrumental line spread function
+        self.lsf_sigma = None # sigma_instr on wave_fitloc, set in run_sampler
+        self.integrate = integrate # integrate the Gaussians over the pixels
+        self.edges = None # pixel edges of wave_fitloc, set in run_sampler if integrate
+        self.warm_start = warm_start # label: (value, sigma) to start the walkers from
+        self.warm_ball = 1. # width of the warm started walkers in units of sigma
+        self.warm_burnin = 0.1 # burn-in (fraction of N) of a fully warm started run
+        self.warm = False # all of the sampled parameters were warm started, set in run_sampler
     
     # =============================================================================
     #  Primary function to fit Halpha both with or without BLR - data prep and fit 
     # =============================================================================
     def fitting_optical(self, model='gal'):
-        """ Method to fit Halpha+[NII +[SII]]
+        """ Method to fit the full rest frame optical spectrum ([OII] to [NII]+Halpha)
         
         Parameters
         ----------
@@ -129,21 +252,16 @@ class Fitting:
         model - str
             current valid models names and their variable names/also prior names:
 
-            gal -  'z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak'
+            gal -  'z', 'cont', 'cont_grad', 'Hal_peak', 'NII_peak', 'OIII_peak', 'Hbeta_peak', 'Hgamma_peak', 'Hdelta_peak',
+                   'NeIII_peak', 'OII_peak', 'OII_rat', 'OIIIaur_peak', 'HeI_peak', 'HeII_peak', 'Nar_fwhm'
 
-            outflow - 'z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel'
+            outflow - gal + 'Hal_out_peak', 'OIII_out_peak', 'NII_out_peak', 'Hbeta_out_peak', 'outflow_vel', 'outflow_fwhm'
            
         """
         self.model= model
         self.template = None
         
-        if self.priors['z'][0]==0:
-            self.priors['z'][0]=self.z
-            if (self.priors['z'][1]=='normal_hat') & (self.priors['z'][2]==0):
-                self.priors['z'][2] = self.z
-                self.priors['z'][3] = 200/3e5*(1+self.z)
-                self.priors['z'][4] = self.z-1000/3e5*(1+self.z)
-                self.priors['z'][5] = self.z+1000/3e5*(1+self.z)
+        self.centre_z_prior()
         
         self.fluxs[np.isnan(self.fluxs)] = 0
         self.flux = self.fluxs.data[np.invert(self.fluxs.mask)]
@@ -156,65 +274,17 @@ class Fitting:
         self.wave_zoom = self.wave[sel]
         
         peak = np.ma.max(self.flux_zoom)
-        nwalkers=64
-
-        if self.model=='gal':
-            self.fitted_model = FO_models.Full_optical
-            self.log_prior_fce = logprior_general
-            self.labels= ['z', 'cont','cont_grad',  'Hal_peak', 'NII_peak', 'OIII_peak', 'Hbeta_peak','Hgamma_peak', 'Hdelta_peak','NeIII_peak','OII_peak','OII_rat','OIIIaur_peak', 'HeI_peak','HeII_peak', 'Nar_fwhm']
-
-            self.pr_code = self.prior_create()
-            cont = np.median(self.flux[self.fit_loc])
-            if cont<0:
-                cont=0.01
-            pos_l = np.array([self.z,cont,0.01, peak/2, peak/4,self.priors['Nar_fwhm'][0],peak/6, peak/6 ])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-
-            self.res = {'name': 'Full_optical'}
-            
-                
-        elif self.model=='outflow':
-            self.fitted_model = FO_models.Full_optical_outflow
-            self.log_prior_fce = logprior_general
-            self.labels= ['z', 'cont','cont_grad',  'Hal_peak', 'NII_peak', 'OIII_peak', 'Hbeta_peak','Hgamma_peak',\
-                          'Hdelta_peak','NeIII_peak','OII_peak','OII_rat','OIIIaur_peak', 'HeI_peak','HeII_peak', 'Nar_fwhm',\
-                          'Hal_out_peak', 'OIII_out_peak', 'NII_out_peak', 'Hbeta_out_peak', \
-                                  'outflow_vel', 'outflow_fwhm']
-            
-            self.pr_code = self.prior_create()
-            
-            cont = np.median(self.flux[self.fit_loc])
-            if cont<0:
-                cont=0.01
-            pos_l = np.array([self.z,cont,0.01, peak/2, peak/4, self.priors['Nar_fwhm'][0],peak/6, peak/6,peak/8, peak/8, self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0] ])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-            
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Full_optical_outflow'}
+        cont = np.median(self.flux[self.fit_loc])
+        if cont<0:
+            cont=0.01
+        pos_l, pos = self.setup_named_model('optical', {'z': self.z, 'cont': cont, 'peak': peak}, nwalkers=64)
         
         self.flux_fitloc = self.flux
         self.wave_fitloc = self.wave
         self.error_fitloc = self.error
         
-        if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-            print(logprior_general_scipy_test(pos_l, self.pr_code))
-                
-            raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                            boundries are sensible')
-
-        nwalkers, ndim = pos.shape
-        sampler = emcee.EnsembleSampler(
-             nwalkers, ndim, self.log_probability_general, args=())
-     
-        sampler.run_mcmc(pos, self.N, progress=self.progress)
-        self.flat_samples = sampler.get_chain(discard=int(0.25*self.N), thin=15, flat=True)      
+        sampler = self.run_sampler(pos)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.25*self.N), thin=15)      
         
         self.chains = {'name': 'Full_optical'}
         for i in range(len(self.labels)):
@@ -226,10 +296,10 @@ class Fitting:
         except:
             self.chi2, self.BIC = np.nan, np.nan
         
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
-        self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
+        self.yeval = self.evaluate_model(self.wave)
 
-    def fitting_Halpha(self, model='gal'):
+    def fitting_Halpha(self, model='gal', vectorize=False):
         """ Method to fit Halpha+[NII +[SII]]
         
         Parameters
@@ -250,23 +320,16 @@ class Fitting:
                     'Hal_out_peak', 'NII_out_peak', \
                     'outflow_fwhm', 'outflow_vel', \
                     'BLR_Hal_peak', 'zBLR', 'BLR_alp1', 'BLR_alp2', 'BLR_sig'
-        
+
+        vectorize : bool - optional
+            evaluate the prior and the model on the whole (nwalkers, ndim) block of walkers at once
+            (emcee vectorize=True) instead of calling the likelihood once per walker. Default False.
         
         """
         self.model= model
         self.template = None
-        if self.priors['z'][0]==0:
-            self.priors['z'][0]=self.z
-            if (self.priors['z'][1]=='normal_hat') & (self.priors['z'][2]==0):
-                self.priors['z'][2] = self.z
-                self.priors['z'][3] = 200/3e5*(1+self.z)
-                self.priors['z'][4] = self.z-1000/3e5*(1+self.z)
-                self.priors['z'][5] = self.z+1000/3e5*(1+self.z)
-        try:
-            if self.priors['zBLR'][0]==0:
-                self.priors['zBLR'][0]=self.z
-        except:
-            lksdf=0
+        self.vectorize = vectorize
+        self.centre_z_prior()
             
         self.fluxs[np.isnan(self.fluxs)] = 0
         self.flux = self.fluxs.data[np.invert(self.fluxs.mask)]
@@ -279,122 +342,17 @@ class Fitting:
         self.wave_zoom = self.wave[sel]
         
         peak = abs(np.ma.max(self.flux_zoom))
-        nwalkers=32
-        
         cont = np.median(self.flux[self.fit_loc])
         if cont<0:
             cont=0.01
-
-        if self.model=='BLR_simple':
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak','BLR_Hal_peak', 'NII_peak', 'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'SIIr_peak', 'SIIb_peak']
-            
-            self.fitted_model = H_models.Halpha_wBLR
-            self.log_prior_fce = logprior_general
-            self.pr_code = self.prior_create()
-            
-            pos_l = np.array([self.z,cont,0.001, peak/2, peak/4, peak/4, self.priors['Nar_fwhm'][0], self.priors['BLR_fwhm'][0],self.priors['zBLR'][0],peak/6, peak/6])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Halpha_wth_BLR'}
-        
-        if self.model=='BLR':
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak','BLR_Hal_peak', 'NII_peak', 'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'SIIr_peak', 'SIIb_peak',\
-                         'Halpha_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel']
-            
-            self.fitted_model = H_models.Halpha_BLR_outflow
-            self.log_prior_fce = logprior_general
-            self.pr_code = self.prior_create()
-            
-            pos_l = np.array([self.z,cont,0.001, peak/2, peak/4, peak/4, self.priors['Nar_fwhm'][0], self.priors['BLR_fwhm'][0],self.priors['zBLR'][0],peak/6, peak/6,\
-                              peak/6, peak/6, 700, -100])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Halpha_wth_BLR'}
-        
-        elif self.model=='gal':
-            self.fitted_model = H_models.Halpha
-            self.log_prior_fce = logprior_general
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak']
-            self.pr_code = self.prior_create()
-            
-            pos_l = np.array([self.z,cont,0.01, peak/2, peak/4,self.priors['Nar_fwhm'][0],peak/6, peak/6 ])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-
-            self.res = {'name': 'Halpha_wth_BLR'}
-            
-                
-        elif self.model=='outflow':
-            self.fitted_model = H_models.Halpha_outflow
-            self.log_prior_fce = logprior_general
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel']
-            self.pr_code = self.prior_create()
-            
-            pos_l = np.array([self.z,cont,0.01, peak/2, peak/4, self.priors['Nar_fwhm'][0],peak/6, peak/6,peak/8, peak/8, self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0] ])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-            
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            
-            self.res = {'name': 'Halpha_wth_out'}
-            
-        
-        elif self.model=='QSO_BKPL':
-            
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm',
-                    'Hal_out_peak', 'NII_out_peak', 
-                    'outflow_fwhm', 'outflow_vel', \
-                    'BLR_Hal_peak', 'zBLR', 'BLR_alp1', 'BLR_alp2', 'BLR_sig']
-                
-            pos_l = np.array([self.z,cont,0.01, peak/2, peak/4, self.priors['Nar_fwhm'][0],\
-                              peak/6, peak/6,\
-                              self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0], \
-                              peak, self.priors['zBLR'][0], self.priors['BLR_alp1'][0], self.priors['BLR_alp2'][0],self.priors['BLR_sig'][0], \
-                              ])
-            
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0]    
-            
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.pr_code = self.prior_create()
-            self.fitted_model = QSO_models.Hal_QSO_BKPL
-            self.log_prior_fce = logprior_general
-            self.res = {'name': 'Halpha_QSO_BKPL'}
-            
-        else:
-            raise Exception('self.model variable not understood. Available self.model keywords: BLR, outflow, gal, QSO_BKPL')
+        pos_l, pos = self.setup_named_model('Halpha', {'z': self.z, 'cont': cont, 'peak': peak}, nwalkers=32)
         
         self.flux_fitloc = self.flux[self.fit_loc]
         self.wave_fitloc = self.wave[self.fit_loc]
         self.error_fitloc = self.error[self.fit_loc]
         
-        if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-            print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                
-            raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                            boundries are sensible')
-
-        nwalkers, ndim = pos.shape
-        sampler = emcee.EnsembleSampler(
-             nwalkers, ndim, self.log_probability_general, args=())
-     
-        sampler.run_mcmc(pos, self.N, progress=self.progress)
-        self.flat_samples = sampler.get_chain(discard=int(0.25*self.N), thin=15, flat=True)      
+        sampler = self.run_sampler(pos)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.25*self.N), thin=15)      
         
         self.chains = {'name': 'Halpha'}
         for i in range(len(self.labels)):
@@ -406,14 +364,14 @@ class Fitting:
         except:
             self.chi2, self.BIC = np.nan, np.nan
         
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
-        self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
+        self.yeval = self.evaluate_model(self.wave)
         
     # =============================================================================
     # Primary function to fit [OIII] with and without outflows. 
     # =============================================================================
     
-    def fitting_OIII(self, model, Fe_template=0, plot=0):
+    def fitting_OIII(self, model, Fe_template=0, plot=0, vectorize=False):
         """ Method to fit [OIII] + Hbeta
         
         Parameters
@@ -429,25 +387,16 @@ class Fitting:
         template - str
             name of the FeII template you want to fit - Tsuzuki, BG92, Veron
 
+        vectorize : bool - optional
+            evaluate the prior and the model on the whole (nwalkers, ndim) block of walkers at once
+            (emcee vectorize=True) instead of calling the likelihood once per walker. Default False.
+
         """
         
         self.model = model
         self.template = Fe_template
-        if self.priors['z'][0]==0:
-            self.priors['z'][0]=self.z
-            if (self.priors['z'][1]=='normal_hat') & (self.priors['z'][2]==0):
-                self.priors['z'][2] = self.z
-                self.priors['z'][3] = 200/3e5*(1+self.z)
-                self.priors['z'][4] = self.z-1000/3e5*(1+self.z)
-                self.priors['z'][5] = self.z+1000/3e5*(1+self.z)
-        
-        if self.priors['zBLR'][0]==0:
-            self.priors['z'][0]=self.z
-            if (self.priors['zBLR'][1]=='normal_hat') & (self.priors['zBLR'][2]==0):
-                self.priors['zBLR'][2] = self.z
-                self.priors['zBLR'][3] = 200/3e5*(1+self.z)
-                self.priors['zBLR'][4] = self.z-1000/3e5*(1+self.z)
-                self.priors['zBLR'][5] = self.z+1000/3e5*(1+self.z)
+        self.vectorize = vectorize
+        self.centre_z_prior()
 
         self.flux = self.fluxs.data[np.invert(self.fluxs.mask)]
         self.wave = self.wave[np.invert(self.fluxs.mask)]
@@ -472,195 +421,28 @@ class Fitting:
         if plot==1:
             print(self.flux[self.fit_loc], self.error[self.fit_loc])
 
-        nwalkers=64
-
-        if  (self.model=='outflow_simple') | (self.model=='outflow'):
-            self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hbeta_peak', 'Hbeta_out_peak']
-            self.fitted_model = O_models.OIII_outflow
-            self.log_prior_fce = logprior_general
-            self.pr_code = self.prior_create()
-            
-            cont_init = abs(np.median(self.flux[self.fit_loc]))
-            pos_l = np.array([self.z,cont_init,0.001, peak/2, peak/6, self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0], peak_beta, peak_beta/3])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-            
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-
-            if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                            boundries are sensible')
-            
-            self.res = {'name': 'OIII_outflow_simple'}
-        
-        elif (self.model== 'gal_simple') | (self.model== 'gal'):
-            self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'Nar_fwhm', 'Hbeta_peak']
-            self.fitted_model = O_models.OIII_gal
-            self.log_prior_fce = logprior_general
-            self.pr_code = self.prior_create()
-            cont_init = abs(np.median(self.flux[self.fit_loc]))
-            pos_l = np.array([self.z,cont_init,0.001, peak/2, self.priors['Nar_fwhm'][0], peak_beta])
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'OIII_simple'}
-
-            if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                            boundries are sensible')
-            
-        elif (self.model=='BLR_simple'):
-            if self.template==0:
-                self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'Nar_fwhm', 'Hbeta_peak', 'zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm']
-                self.fitted_model = O_models.OIII_gal_BLR
-                self.log_prior_fce = logprior_general
-                self.pr_code = self.prior_create()
-                        
-                pos_l = np.array([self.z,np.median(self.flux[self.fit_loc]),0.001, peak/2, self.priors['Nar_fwhm'][0], peak_beta, self.z, peak_beta/2, self.priors['BLR_fwhm'][0]])
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-
-                if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                    print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                    
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                                boundries are sensible')
-                
-                self.res = {'name': 'OIII_BLR_simple'}
-
-            else:
-                self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'Nar_fwhm', 'Hbeta_peak', 'zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm','Fe_peak', 'Fe_fwhm']
-                self.fitted_model = O_models.OIII_gal_BLR_Fe
-                self.log_prior_fce = logprior_general
-                self.pr_code = self.prior_create()
-                        
-                pos_l = np.array([self.z,np.median(self.flux[self.fit_loc]),0.001, peak/2, self.priors['Nar_fwhm'][0], peak_beta, self.z, peak_beta/2, self.priors['BLR_fwhm'][0],\
-                                  np.median(self.flux[self.fit_loc]), self.priors['Fe_fwhm'][0]])
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-
-                if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                    print(logprior_general_test(pos_l, self.pr_code))
-                    
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                                boundries are sensible')
-                
-                self.res = {'name': 'OIII_BLR_simple_fe'}
-                
-        
-        elif (self.model== 'BLR_outflow'):
-            if self.template==0:
-                self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hbeta_peak', 'Hbeta_out_peak','zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm']
-                self.fitted_model = O_models.OIII_outflow_BLR
-                self.log_prior_fce = logprior_general
-                self.pr_code = self.prior_create()
-                        
-                pos_l = np.array([self.z,np.median(self.flux[self.fit_loc]),0.001, peak/2, peak/6, self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0], peak_beta, peak_beta/3,\
-                                 self.z, peak_beta/2, self.priors['BLR_fwhm'][0]])
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-                
-                self.res = {'name': 'OIII_simple'}
-
-                if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                    print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                    
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                                boundries are sensible')
-            
-            else:
-                self.labels=['z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hbeta_peak', 'Hbeta_out_peak','zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm','Fe_peak', 'Fe_fwhm']
-                self.fitted_model = O_models.OIII_outflow_BLR_Fe
-                self.log_prior_fce = logprior_general
-                self.pr_code = self.prior_create()
-                        
-                pos_l = np.array([self.z,np.median(self.flux[self.fit_loc]),0.001, peak/2, peak/6, self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0], peak_beta, peak_beta/3,\
-                                  self.z, peak_beta/2, self.priors['BLR_fwhm'][0],\
-                                  np.median(self.flux[self.fit_loc]), self.priors['Fe_fwhm'][0]])
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-                
-                self.res = {'name': 'OIII_simple'}
-
-                if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
-                    print(logprior_general_test(pos_l, self.pr_code,self.labels))
-                    
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
-                                boundries are sensible')
-                       
-        elif self.model=='QSO_BKPL':
-            self.labels=('z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm',\
-                        'outflow_vel', 'BLR_peak', 'zBLR', 'BLR_alp1', 'BLR_alp2','BLR_sig' ,\
-                        'Hb_nar_peak', 'Hb_out_peak')
-                
-            pos_l = np.array([self.z,np.median(self.flux[self.fit_loc]),0.001, peak/2, peak/6,\
-                    self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0],self.priors['outflow_vel'][0],\
-                    peak_beta, self.priors['zBLR'][0], self.priors['BLR_alp1'][0], self.priors['BLR_alp2'][0],self.priors['BLR_sig'][0], \
-                    peak_beta/4, peak_beta/4])
-            
-                
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0]    
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            pos[:,9] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.pr_code = self.prior_create()
-            self.fitted_model = QSO_models.OIII_QSO_BKPL
-            self.log_prior_fce = logprior_general_scipy
-            self.res = {'name': 'OIII_QSO_BKP'}
-            
-        else:
-            raise Exception('self.model variable not understood. Available self.model keywords: outflow, gal, QSO_BKPL')
+        cont = abs(np.median(self.flux[self.fit_loc]))
+        pos_l, pos = self.setup_named_model('OIII', {'z': self.z, 'cont': cont, 'peak': peak, 'peak_beta': peak_beta}, nwalkers=64)
          
-        nwalkers, ndim = pos.shape
-
         self.flux_fitloc = self.flux[self.fit_loc]
         self.wave_fitloc = self.wave[self.fit_loc]
         self.error_fitloc = self.error[self.fit_loc]
         
-        if self.template==0:
-            sampler = emcee.EnsembleSampler(
-                    nwalkers, ndim, self.log_probability_general, args=())
-        else:
-            sampler = emcee.EnsembleSampler(
-                    nwalkers, ndim, self.log_probability_general, args=())
-        
-        sampler.run_mcmc(pos, self.N, progress=self.progress)
-        self.flat_samples = sampler.get_chain(discard=int(0.25*self.N), thin=15, flat=True)      
+        sampler = self.run_sampler(pos)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.25*self.N), thin=15)      
         
         self.chains = {'name': 'OIII'}
         for i in range(len(self.labels)):
             self.chains[self.labels[i]] = self.flat_samples[:,i]
         
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
         self.props = self.prop_calc()
-        if self.template:
-            self.yeval = self.fitted_model(self.wave, *self.props['popt'], self.template)
-        else:
-            self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+        self.yeval = self.evaluate_model(self.wave)
         self.chi2 = sum(((self.flux_fitloc-self.yeval[self.fit_loc])/self.error_fitloc)**2)
         self.BIC = self.chi2+ len(self.props['popt'])*np.log(len(self.flux_fitloc))
         
         
-    def fitting_Halpha_OIII(self, model, template=0):
+    def fitting_Halpha_OIII(self, model, template=0, vectorize=False):
         """ Method to fit Halpha + [OIII] + Hbeta+ [NII] + [SII]
         
         Parameters
@@ -679,23 +461,17 @@ class Fitting:
 
             BLR_simple - 'z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak',\
                     'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak'
+
+        vectorize : bool - optional
+            evaluate the prior and the model on the whole (nwalkers, ndim) block of walkers at once
+            (emcee vectorize=True) instead of calling the likelihood once per walker. Default False.
         
         """
         self.template = template
         self.model = model
+        self.vectorize = vectorize
         
-        if self.priors['z'][0]==0:
-            self.priors['z'][0]=self.z
-            if (self.priors['z'][1]=='normal_hat') & (self.priors['z'][2]==0):
-                self.priors['z'][2] = self.z
-                self.priors['z'][3] = 200/3e5*(1+self.z)
-                self.priors['z'][4] = self.z-1000/3e5*(1+self.z)
-                self.priors['z'][5] = self.z+1000/3e5*(1+self.z)
-        try:
-            if self.priors['zBLR'][2]==0:
-                self.priors['zBLR'][2]=self.z
-        except:
-            lksdf=0
+        self.centre_z_prior()
             
             
         self.flux = self.fluxs.data[np.invert(self.fluxs.mask)]
@@ -732,234 +508,24 @@ class Fitting:
     # =============================================================================
     #   Setting up fitting  
     # =============================================================================
-        if self.model=='gal':
-            #self.priors['z'] = [z, z-zcont, z+zcont]
-            nwalkers=64
-            self.fitted_model = HO_models.Halpha_OIII
-            self.log_prior_fce = logprior_general
-            self.labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'OIII_peak', 'Hbeta_peak']
-            self.pr_code = self.prior_create()
-            
-            cont_init = np.median(self.flux[self.fit_loc])
-            if cont_init<0:
-                cont_init = abs(cont_init)
-            pos_l = np.array([self.z, cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, self.priors['Nar_fwhm'][0], peak_hal*0.15, peak_hal*0.2, peak_OIII*0.8,\
-                              peak_hal*0.2])  
-            
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-            if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                logprior_general_test(pos_l, self.pr_code, self.labels)
-                
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                boundries are sensible. {pos_l}')
-               
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Halpha_OIII'}
-            
-            
-        elif self.model=='outflow':
-            nwalkers=64
-            self.fitted_model = HO_models.Halpha_OIII_outflow
-            
-            self.labels=('z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak',\
-                    'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hal_out_peak','NII_out_peak', 'OIII_out_peak', 'Hbeta_out_peak' )
-            
-            self.pr_code = self.prior_create()
-            self.log_prior_fce = logprior_general
-            cont_init = np.median(self.flux[self.fit_loc])
-            if cont_init<0:
-                cont_init = abs(cont_init)
-
-            pos_l = np.array([self.z,cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, \
-                              peak_OIII*0.8, peak_hal*0.2, peak_hal*0.2, peak_hal*0.2, \
-                              self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0], self.priors['outflow_vel'][0],
-                              peak_hal*0.3, peak_hal*0.3, peak_OIII*0.2, peak_hal*0.05])
-            
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-            if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                
-                logprior_general_test(pos_l, self.pr_code, self.labels)
-                
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                boundries are sensible. {%pos_l}')
-                                
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Halpha_OIII_outflow'}
-            
-            
-        elif self.model=='BLR':
-            self.labels=('z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak',\
-                    'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hal_out_peak','NII_out_peak', 'OIII_out_peak', 'Hbeta_out_peak' ,\
-                    'BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak')
-                
-            nwalkers=64
-            
+        if self.model in ['BLR', 'BLR_simple']:
             if self.priors['BLR_Hal_peak'][2]=='self.error':
                 self.priors['BLR_Hal_peak'][2]=self.error[-2]; self.priors['BLR_Hal_peak'][3]=self.error[-2]*2
             if self.priors['BLR_Hbeta_peak'][2]=='self.error':
                 self.priors['BLR_Hbeta_peak'][2]=self.error[2]; self.priors['BLR_Hbeta_peak'][3]=self.error[2]*2
-            
-            self.pr_code = self.prior_create()
-            self.log_prior_fce = logprior_general
-            self.fitted_model = HO_models.Halpha_OIII_BLR
-            cont_init = np.median(self.flux[self.fit_loc])
-            if cont_init<0:
-                cont_init = abs(cont_init)
-            pos_l = np.array([self.z,cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, \
-                              peak_OIII*0.8, peak_hal*0.3 , peak_hal*0.2, peak_hal*0.2,\
-                              self.priors['Nar_fwhm'][0], self.priors['outflow_fwhm'][0], self.priors['outflow_vel'][0],
-                              peak_hal*0.3, peak_hal*0.3, peak_OIII*0.2, peak_hal*0.1,\
-                              self.priors['BLR_fwhm'][0], self.priors['zBLR'][0], peak_hal*0.3, peak_hal*0.1])
-                
-            for i in enumerate(self.labels):
-                pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                 
-            
-            
-            if (self.log_prior_fce(pos_l, self.pr_code)==np.nan)|\
-                (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                print(logprior_general_test(pos_l, self.pr_code, self.labels))
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                boundries are sensible. {pos_l} ')
-            
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            pos[:,-3] = np.random.normal(self.priors['zBLR'][0],0.00001, nwalkers)
-           
-            self.res = {'name': 'Halpha_OIII_BLR'}
-            
-        elif self.model=='BLR_simple':
-            if self.template==0:
-                self.labels=('z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak',\
-                        'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak')
-                    
-                nwalkers=64
-                
-                if self.priors['BLR_Hal_peak'][2]=='self.error':
-                    self.priors['BLR_Hal_peak'][2]=self.error[-2]; self.priors['BLR_Hal_peak'][3]=self.error[-2]*2
-                if self.priors['BLR_Hbeta_peak'][2]=='self.error':
-                    self.priors['BLR_Hbeta_peak'][2]=self.error[2]; self.priors['BLR_Hbeta_peak'][3]=self.error[2]*2
-                
-                self.pr_code = self.prior_create(self.labels, self.priors) 
-                self.log_prior_fce = logprior_general
-                self.fitted_model = HO_models.Halpha_OIII_BLR_simple
-                
-                cont_init = np.median(self.flux[self.fit_loc])
-                if cont_init<0:
-                    cont_init = abs(cont_init)
-
-                pos_l = np.array([self.z,cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, \
-                                peak_OIII*0.8, peak_hal*0.3 , peak_hal*0.2, peak_hal*0.2,\
-                                self.priors['Nar_fwhm'][0], self.priors['BLR_fwhm'][0], self.priors['zBLR'][0], peak_hal*0.3, peak_hal*0.1])
-                    
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-                if (self.log_prior_fce(pos_l, self.pr_code)==np.nan)|\
-                    (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                    print(logprior_general_test(pos_l, self.pr_code, self.labels))
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                    boundries are sensible. {pos_l} ')
-                
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-                pos[:,-3] = np.random.normal(self.priors['zBLR'][0],0.00001, nwalkers)
-            
-                self.res = {'name': 'Halpha_OIII_BLR_simple'}
-            
-            else:
-                self.labels=('z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak',\
-                        'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak', 'Fe_peak', 'Fe_FWHM')
-                    
-                nwalkers=64
-                
-                if self.priors['BLR_Hal_peak'][2]=='self.error':
-                    self.priors['BLR_Hal_peak'][2]=self.error[-2]; self.priors['BLR_Hal_peak'][3]=self.error[-2]*2
-                if self.priors['BLR_Hbeta_peak'][2]=='self.error':
-                    self.priors['BLR_Hbeta_peak'][2]=self.error[2]; self.priors['BLR_Hbeta_peak'][3]=self.error[2]*2
-                
-                self.pr_code = self.prior_create(self.labels, self.priors) 
-                self.log_prior_fce = logprior_general
-                self.fitted_model = HO_models.Halpha_OIII_BLR_simple
-                
-                cont_init = np.median(self.flux[self.fit_loc])
-                if cont_init<0:
-                    cont_init = abs(cont_init)
-
-                pos_l = np.array([self.z,cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, \
-                                peak_OIII*0.8, peak_hal*0.3 , peak_hal*0.2, peak_hal*0.2,\
-                                self.priors['Nar_fwhm'][0], self.priors['BLR_fwhm'][0], self.priors['zBLR'][0], peak_hal*0.3, peak_hal*0.1, cont_init, self.priors['Fe_FWHM'][0]])
-                    
-                for i in enumerate(self.labels):
-                    pos_l[i[0]] = pos_l[i[0]] if self.priors[i[1]][0]==0 else self.priors[i[1]][0] 
-                
-                if (self.log_prior_fce(pos_l, self.pr_code)==np.nan)|\
-                    (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                    print(logprior_general_test(pos_l, self.pr_code, self.labels))
-                    raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                    boundries are sensible. {pos_l} ')
-                
-                pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-                pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-                pos[:,-3] = np.random.normal(self.priors['zBLR'][0],0.00001, nwalkers)
-            
-                self.res = {'name': 'Halpha_OIII_BLR_simple'}
-            
-            
-        elif self.model=='QSO_BKPL':
-            self.labels =[ 'z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'OIII_peak','Hbeta_peak', 'Nar_fwhm', \
-                                  'Hal_out_peak', 'NII_out_peak','OIII_out_peak', 'Hbeta_out_peak',\
-                                  'outflow_fwhm', 'outflow_vel',\
-                                  'Hal_BLR_peak', 'Hbeta_BLR_peak',  'BLR_vel', 'BLR_alp1', 'BLR_alp2', 'BLR_sig']
-        
-        
-            nwalkers=64
-            self.pr_code = self.prior_create(self.labels, self.priors)   
-            self.log_prior_fce = logprior_general
-            self.fitted_model =  QSO_models.Halpha_OIII_QSO_BKPL
-            cont_init = np.median(self.flux[self.fit_loc])
-            if cont_init<0:
-                cont_init = abs(cont_init)
-
-            pos_l = np.array([self.z,cont_init, -0.1, peak_hal*0.7, peak_hal*0.3, \
-                              peak_OIII*0.8, peak_OIII*0.3,self.priors['Nar_fwhm'][0],\
-                              peak_hal*0.2, peak_hal*0.3, peak_OIII*0.4, peak_OIII*0.2   ,\
-                              self.priors['outflow_fwhm'][0], self.priors['outflow_vel'][0],\
-                              peak_hal*0.4, peak_OIII*0.4, self.priors['BLR_vel'][0], 
-                              self.priors['BLR_alp1'][0], self.priors['BLR_alp2'][0],self.priors['BLR_sig'][0]])
-            
-            if (self.log_prior_fce(pos_l, self.pr_code)==np.nan)|\
-                (self.log_prior_fce(pos_l, self.pr_code)==-np.inf):
-                raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your self.priors\
-                                boundries are sensible: {pos_l}')
-                                
-            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-            
-            self.res = {'name': 'Halpha_OIII_BLR'}
-            
-        else:
-            raise Exception('self.model variable not understood. Available self.model keywords: outflow, gal, QSO_BKPL')
+
+        cont_init = abs(np.median(self.flux[self.fit_loc]))
+        pos_l, pos = self.setup_named_model('Halpha_OIII', {'z': self.z, 'cont': cont_init, 'peak_hal': peak_hal, 'peak_OIII': peak_OIII},
+                                            nwalkers=64)
         
         self.flux_fitloc = self.flux[self.fit_loc]
         self.wave_fitloc = self.wave[self.fit_loc]
         self.error_fitloc = self.error[self.fit_loc]
 
-        nwalkers, ndim = pos.shape
-        sampler = emcee.EnsembleSampler(
-                nwalkers, ndim, self.log_probability_general, args=()) 
-        sampler.run_mcmc(pos, self.N, progress=self.progress)
+        sampler = self.run_sampler(pos)
         
-        self.flat_samples = sampler.get_chain(discard=int(0.5*self.N), thin=15, flat=True)
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.5*self.N), thin=15)
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
         
         self.chains = {'name': 'Halpha_OIII'}
         for i in range(len(self.labels)):
@@ -967,11 +533,76 @@ class Fitting:
 
         self.props = self.prop_calc()
         
-        self.chi2, self.BIC = sp.BIC_calc(self.waves, self.fluxs, self.error, self.fitted_model, self.props, 'Halpha_OIII')
-        self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+        model = self.fitted_model
+        if self.template:
+            model = lambda wave, *theta: self.fitted_model(wave, *theta, self.template)
+        self.chi2, self.BIC = sp.BIC_calc(self.waves, self.fluxs, self.error, model, self.props, 'Halpha_OIII')
+        self.yeval = self.evaluate_model(self.wave)
 
         
-    def fitting_general(self, fitted_model, labels, logprior=None, nwalkers=64):
+    def centre_z_prior(self):
+        """ Centres the default (0) initial value and loc of the z and zBLR normal or normal_hat priors on self.z.
+        The normal_hat priors get a width of 200 km/s and bounds of +-1000 km/s.
+        """
+        for name in ['z', 'zBLR']:
+            prior = self.priors.get(name)
+            if prior is None:
+                continue
+            if prior[0]==0:
+                prior[0] = self.z
+            if (prior[1] in ['normal', 'normal_hat']) & (prior[2]==0):
+                prior[2] = self.z
+                if prior[1]=='normal_hat':
+                    prior[3] = 200/3e5*(1+self.z)
+                    prior[4] = self.z-1000/3e5*(1+self.z)
+                    prior[5] = self.z+1000/3e5*(1+self.z)
+
+    def setup_named_model(self, method, scales, nwalkers):
+        """ Sets up the named model self.model of a fitting method ('Halpha', 'OIII', 'Halpha_OIII', 'optical' - see
+        named_models) from its line table (Models.Model_builder.line_tables): labels, fitted_model (the python model
+        the table reproduces, or the table model if there is none), prior, res and the initial walkers. scales are the
+        quantities measured on the spectrum that the initial positions of the table are given in (z, cont, peak, ...).
+        Returns pos_l and the walkers pos.
+        """
+        models = named_models[method]
+        if self.model not in models:
+            raise Exception('self.model variable not understood. Available self.model keywords: '+', '.join(models))
+        name, res_name = models[self.model]
+        if self.template:
+            if self.model in named_models_FeII.get(method, {}):
+                name, res_name = named_models_FeII[method][self.model]
+            else:
+                self.template = None
+
+        table = Model_builder.line_tables[name]
+        model = Model_builder.build(table)
+        self.labels = list(model.labels)
+        self.fitted_model = model if table.reference is None else table.reference
+        self.log_prior_fce = Compiled_models.log_prior_scipy if name in scipy_prior_tables else logprior_general
+        self.pr_code = self.prior_create(named_constraints)
+        self.res = {'name': res_name}
+
+        pos_l = model.initial(scales, self.priors)
+        # lower the initial values that break a constraint theta[a] >= factor*theta[b] (twice for chained ones)
+        for a, b, factor in np.vstack([self.prior.cons]*2):
+            if (b >= 0) and (factor > 0) and not (pos_l[int(a)] >= factor*pos_l[int(b)]):
+                pos_l[int(b)] = 0.9*pos_l[int(a)]/factor
+        if not np.isfinite(self.log_prior(pos_l)):
+            print(logprior_general_test(pos_l, self.pr_code, self.labels))
+            raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
+                            boundries are sensible')
+        pos = model.walkers(pos_l, nwalkers)
+        # redraw the walkers outside of the prior, pull the last ones towards pos_l
+        for i in range(100):
+            bad = ~np.isfinite(self.log_prior(pos))
+            if not np.any(bad):
+                break
+            pos[bad] = model.walkers(pos_l, np.sum(bad))
+        else:
+            pos[bad] = pos_l + (pos[bad]-pos_l)*1e-3
+        return pos_l, pos
+
+    def fitting_general(self, fitted_model, labels=None, logprior=None, nwalkers=64, vectorize=False):
         """ Fitting any general function that you pass. You need to put in fitted_model, labels and
         you can pass logprior function or number of walkers.  
 
@@ -979,10 +610,11 @@ class Fitting:
         ----------
 
         fitted_model : callable
-            Function to fit
+            Function to fit - or a line table model (Models.Model_builder.build), which is fitted with its compiled kernel
 
         labels : list
-            list of the name of the paramters in the same order as in the fitted_function
+            list of the name of the paramters in the same order as in the fitted_function. Default the labels of the
+            line table model
 
         priors: dict - optional
             dictionary with all of the priors to update
@@ -992,11 +624,21 @@ class Fitting:
         
         nwalkers : int - optional
             default 64 walkers for the MCMC
+
+        vectorize : bool - optional
+            evaluate the prior and the model on the whole (nwalkers, ndim) block of walkers at once
+            (emcee vectorize=True) instead of calling the likelihood once per walker. Default False.
                  
         """
         self.template= None
-        self.labels= labels
-        if logprior !=None:
+        self.vectorize = vectorize
+        table = fitted_model if isinstance(fitted_model, Model_builder.LineTableModel) else None
+        if labels is None:
+            if table is None:
+                raise Exception('labels are needed unless fitted_model is a line table model')
+            labels = table.labels
+        self.labels= list(labels)
+        if logprior is None:
             self.log_prior_fce = logprior_general
         else: 
             self.log_prior_fce = logprior
@@ -1015,56 +657,50 @@ class Fitting:
 
         self.pr_code = self.prior_create()
        
-        pos_l = np.zeros(len(self.labels))
-            
-        for i, name in enumerate(self.labels):
-            pos_l[i] = self.priors[name][0] 
+        if table is not None:
+            peak = np.nanmax(abs(self.flux_fitloc))
+            scales = {'z': self.z, 'cont': abs(np.nanmedian(self.flux_fitloc)), 'peak': peak, 'peak_beta': peak,
+                      'peak_hal': peak, 'peak_OIII': peak}
+            pos_l = table.initial(scales, self.priors)
+        else:
+            pos_l = np.zeros(len(self.labels))
+            for i, name in enumerate(self.labels):
+                pos_l[i] = self.priors[name][0] 
 
-            if ('_peak' in name) & (self.priors[name][0] ==0):
-                pos_l[i] = np.nanmean(self.error_fitloc)*np.random.uniform(5,10)
-            
-            if ('cont' == name) & (self.priors[name][0] ==0):
-                pos_l[i] = np.nanmedian(self.flux_fitloc)*5
-            
+                if ('_peak' in name) & (self.priors[name][0] ==0):
+                    pos_l[i] = np.nanmean(self.error_fitloc)*np.random.uniform(5,10)
+                
+                if ('cont' == name) & (self.priors[name][0] ==0):
+                    pos_l[i] = np.nanmedian(self.flux_fitloc)*5
                 
-        if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
+        if not np.isfinite(self.log_prior(pos_l)):
             logprior_general_test(pos_l, self.pr_code, self.labels)
                 
             raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
                             boundries are sensible')
                 
-        pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
-        pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
-        
-        nwalkers, ndim = pos.shape
+        if table is not None:
+            pos = table.walkers(pos_l, nwalkers)
+        else:
+            pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
+            pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
         
-        if self.ncpu==1:
-            sampler = emcee.EnsembleSampler(
-                nwalkers, ndim, self.log_probability_general, args=()) 
-            sampler.run_mcmc(pos, self.N, progress=self.progress)
-        
-        elif self.ncpu>1:
-            from multiprocess import Pool
-            with Pool(self.ncpu) as pool:
-                sampler = emcee.EnsembleSampler(
-                    nwalkers, ndim, self.log_probability_general, args=(), pool=pool) 
-            
-                sampler.run_mcmc(pos, self.N, progress=self.progress)
+        sampler = self.run_sampler_ncpu(pos)
 
-        self.flat_samples = sampler.get_chain(discard=int(0.5*self.N), thin=15, flat=True)
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.5*self.N), thin=15)
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
         self.chains = {'name': 'Custom model'}
         for i in range(len(self.labels)):
             self.chains[self.labels[i]] = self.flat_samples[:,i]
         
         self.props = self.prop_calc()
         try:
-            self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+            self.yeval = self.evaluate_model(self.wave)
         except:
             self.yeval = np.zeros_like(self.wave)
 
         try:
-            self.yeval_fitloc = self.fitted_model(self.wave_fitloc, *self.props['popt'])
+            self.yeval_fitloc = self.evaluate_model(self.wave_fitloc)
         except:
             self.yeval_fitloc = np.zeros_like(self.wave_fitloc)
         
@@ -1102,7 +738,7 @@ class Fitting:
         for i in enumerate(self.labels):
             pos_l[i[0]] = self.priors[i[1]][0] 
                 
-        if (self.log_prior_fce(pos_l, self.pr_code)==-np.inf) | (self.log_prior_fce(pos_l, self.pr_code)== np.nan):
+        if not np.isfinite(self.log_prior(pos_l)):
             logprior_general_test(pos_l, self.pr_code, self.labels)
                 
             raise Exception('Logprior function returned nan or -inf on initial conditions. You should double check that your priors\
@@ -1111,30 +747,17 @@ class Fitting:
         pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
         pos[:,0] = np.random.normal(self.z,0.001, nwalkers)
         
-        nwalkers, ndim = pos.shape
-        
-        if self.ncpu==1:
-            sampler = emcee.EnsembleSampler(
-                nwalkers, ndim, self.log_probability_general, args=()) 
-            sampler.run_mcmc(pos, self.N, progress=self.progress)
-        
-        elif self.ncpu>1:
-            from multiprocess import Pool
-            with Pool(self.ncpu) as pool:
-                sampler = emcee.EnsembleSampler(
-                    nwalkers, ndim, self.log_probability_general, args=(), pool=pool) 
-            
-                sampler.run_mcmc(pos, self.N, progress=self.progress)
+        sampler = self.run_sampler_ncpu(pos)
 
-        self.flat_samples = sampler.get_chain(discard=int(0.5*self.N), thin=15, flat=True)
-        self.like_chains = sampler.get_log_prob(discard=int(0.5*self.N),thin=15, flat=True)
+        self.flat_samples = self.flat_chain(sampler, discard=int(0.5*self.N), thin=15)
+        self.like_chains = self.flat_log_prob(sampler, discard=int(0.5*self.N), thin=15)
         self.chains = {'name': 'Custom model'}
         for i in range(len(self.labels)):
             self.chains[self.labels[i]] = self.flat_samples[:,i]
         
         self.props = self.prop_calc()
         try:
-            self.yeval = self.fitted_model(self.wave, *self.props['popt'])
+            self.yeval = self.evaluate_model(self.wave)
         except:
             self.yeval = np.zeros_like(self.wave)
 
@@ -1160,7 +783,11 @@ class Fitting:
         self.error_fitloc = self.errors.copy()
         
         self.Model = Custom_model.Model(self.model_name, model_inputs)
-        self.Model.fit_to_data(self.wave_fitloc, self.flux_fitloc, self.error_fitloc, N=self.N, nwalkers=nwalkers, ncpu=1)
+        self.Model.tolerance = self.tolerance
+        self.Model.lsf = self.lsf
+        self.Model.integrate = self.integrate
+        self.Model.fit_to_data(self.wave_fitloc, self.flux_fitloc, self.error_fitloc, N=self.N, nwalkers=nwalkers, ncpu=1, pool=self.pool,
+                               backend=self.backend)
 
         self.labels= self.Model.labels
         self.chains = self.Model.chains
@@ -1169,6 +796,12 @@ class Fitting:
         self.comps = self.Model.lines
 
 
+    def result(self, nchain=1000):
+        """ Returns the compact FitResult of the fit (labels, float32 percentiles, thinned float32 chain of nchain
+        samples, chi2/BIC and the model on the fit window) - much smaller to store than the whole class.
+        """
+        return FitResult(self, nchain=nchain)
+
     def save(self, file_path):
         import pickle
         """save class as self.name.txt"""
@@ -1185,18 +818,31 @@ class Fitting:
     def log_probability_general(self, theta):
         """ Basic log probability function used in the emcee. Theta are the variables supplied by the emcee 
         """
-        lp = self.log_prior_fce(theta,self.pr_code) 
+        if self.log_prior_fce is logprior_general:
+            lp = prior_eval_one(theta, *self.prior.args)
+        else:
+            lp = self.log_prior_fce(theta,self.pr_code) 
         try:
             if not np.isfinite(lp):
                 return -np.inf
         except:
             lp[np.isnan(lp)] = -np.inf
 
+        k = window_k(self.tolerance)
+        kernel = self.chi2_kernel()
+        if kernel is not None:
+            return lp - 0.5*kernel(self.wave_fitloc, self.flux_fitloc, self.error_fitloc, theta, k, self.lsf_sigma, self.edges)
+
+        model = self.compiled_model()
+        extra = (k, self.lsf_sigma, self.edges)
+        if model is None:
+            model = self.fitted_model
+            extra = ()
         try:
             if self.template:
-                evalm = self.fitted_model(self.wave_fitloc,*theta, self.template)
+                evalm = model(self.wave_fitloc,*theta, self.template, *extra)
             else:
-                evalm = self.fitted_model(self.wave_fitloc,*theta)
+                evalm = model(self.wave_fitloc,*theta, *extra)
         except:
             evalm = self.fitted_model(self.wave_fitloc,theta)
 
@@ -1206,6 +852,484 @@ class Fitting:
         
         return lp + log_likelihood
     
+    def chi2_kernel(self):
+        """ Returns the fused numba model+chi2 kernel (Models.Chi2_kernels) for self.fitted_model, the kernel of
+        its line table (Models.Model_builder) if it has no hand written one, or None if the model has neither or
+        use_kernels is False. Models with a FeII template get a FeII_kernel wrapping the kernel of the model without FeII.
+        """
+        if not self.use_kernels:
+            return None
+        try:
+            kernel = (chi2_kernels_FeII if self.template else chi2_kernels).get(self.fitted_model)
+        except TypeError:
+            kernel = None
+        if kernel is None:
+            table = Model_builder.table_model_of(self.fitted_model)
+            kernel = None if table is None else table.chi2
+        if self.template and (kernel is not None):
+            if self.template not in Fem.FeII_functions:
+                return None
+            return FeII_kernel(kernel, self.template)
+        return kernel
+
+    def evaluate_model(self, wave):
+        """ self.fitted_model with the best fit parameters (props['popt']) on wave, with the instrumental
+        LSF if self.lsf is set and integrated over the pixels if self.integrate (see Models.Compiled_models.evaluate).
+        """
+        return Compiled_models.evaluate(self.fitted_model, wave, self.props['popt'], self.template, lsf=self.lsf, integrate=self.integrate)
+
+    def compiled_model(self):
+        """ Returns the numba compiled equivalent (Models.Compiled_models) of self.fitted_model, its line table
+        model (Models.Model_builder) or None if there is none or use_kernels is False.
+        """
+        if not self.use_kernels:
+            return None
+        try:
+            model = Compiled_models.compiled_models.get(self.fitted_model)
+        except TypeError:
+            model = None
+        if model is None:
+            model = Model_builder.table_model_of(self.fitted_model)
+        return model
+    
+    def log_probability_vectorized(self, theta):
+        """ Vectorized log probability function used in the emcee when vectorize=True. Theta is 
+        the whole (nwalkers, ndim) block of walker positions, the prior and model are evaluated 
+        through broadcasting - or with the chi2 kernel looped over the block in compiled code
+        (Chi2_kernels.chi2_block) - and an array of (nwalkers) log probabilities is returned.
+        """
+        theta = np.atleast_2d(theta)
+        lp = self.log_prior(theta)
+        lp[np.isnan(lp)] = -np.inf
+
+        log_likelihood = np.full(len(theta), -np.inf)
+        use = np.isfinite(lp)
+        if not use.any():
+            return lp
+        
+        kernel = self.chi2_kernel()
+        if kernel is not None:
+            k = window_k(self.tolerance)
+            log_likelihood[use] = -0.5*chi2_block(kernel, self.wave_fitloc, self.flux_fitloc, self.error_fitloc, theta[use], k, self.lsf_sigma, self.edges)
+            return lp + log_likelihood
+
+        if (self.lsf_sigma is not None) or (self.edges is not None):
+            # the LSF and the pixel integration are only in the compiled models - evaluate them walker by walker
+            k = window_k(self.tolerance)
+            extra = (self.template,) if self.template else ()
+            model = self.compiled_model()
+            evalm = np.array([model(self.wave_fitloc, *th, *extra, k, self.lsf_sigma, self.edges) for th in theta[use]])
+        else:
+            evalm = self.model_eval_vectorized(self.wave_fitloc, theta[use])
+
+        sigma2 = self.error_fitloc**2
+        log_likelihood[use] = -0.5 * np.nansum((self.flux_fitloc - evalm) ** 2 / sigma2, axis=1)
+        
+        return lp + log_likelihood
+    
+    def model_eval_vectorized(self, wave, theta):
+        """ Evaluates self.fitted_model for a block of parameters theta (nwalkers, ndim) on wave.
+        Each parameter is passed as a (nwalkers,1) column so the built-in models broadcast to 
+        (nwalkers, len(wave)). Models that do not broadcast (e.g. FeII templates, or declared with
+        vectorized = False like the line table models) are evaluated walker by walker - a model that fails to
+        broadcast (ValueError/TypeError) is not tried again until the next run_sampler.
+        """
+        if self.broadcasts is None:
+            self.broadcasts = getattr(self.fitted_model, 'vectorized', True)
+        if self.broadcasts:
+            try:
+                if self.template:
+                    evalm = self.fitted_model(wave[None,:], *theta.T[:,:,None], self.template)
+                else:
+                    evalm = self.fitted_model(wave[None,:], *theta.T[:,:,None])
+                if np.shape(evalm) != (len(theta), len(wave)):
+                    raise ValueError('Model does not broadcast over walkers')
+                return evalm
+            except (ValueError, TypeError, numba.core.errors.TypingError):
+                self.broadcasts = False
+
+        if self.template:
+            return np.array([self.fitted_model(wave, *th, self.template) for th in theta])
+        return np.array([self.fitted_model(wave, *th) for th in theta])
+    
+    def run_sampler(self, pos, pool=None):
+        """ Sets up the emcee sampler and runs it for self.N steps from the initial walker positions pos.
+        If self.vectorize is True the likelihood is evaluated on all walkers at once - raises an exception if a pool is set too.
+        If self.pool (FittingPool) is set it is used instead of pool.
+        If self.linear is set only the nonlinear parameters are sampled (see run_sampler_linear).
+        If the fitted model has a fused chi2 kernel or a compiled equivalent the fit window arrays are converted to contiguous float64 for it
+        (and the Gaussians are truncated below self.tolerance times their peak, see Chi2_kernels.window_k).
+        sigma_instr of self.lsf and the pixel edges (integrate) are computed on the fit window here, once per fit
+        (self.lsf_sigma, self.edges).
+        If self.warm_start is set the walkers start around it (see warm_walkers) - then refined by map_start if set.
+        If self.map_start is True the walkers are first moved to a small ball around the MAP (see map_estimate).
+        If self.backend is set the chains are streamed to that HDF5 file and a stored run is resumed (see chain_backend).
+        """
+        nwalkers, ndim = pos.shape
+        if (self.chi2_kernel() is not None) | (self.compiled_model() is not None):
+            self.wave_fitloc = np.ascontiguousarray(self.wave_fitloc, dtype=float)
+            self.flux_fitloc = np.ascontiguousarray(self.flux_fitloc, dtype=float)
+            self.error_fitloc = np.ascontiguousarray(self.error_fitloc, dtype=float)
+            if (self.tolerance or (self.lsf is not None) or self.integrate) and np.any(np.diff(self.wave_fitloc) < 0):
+                raise Exception('tolerance, lsf and integrate need the wavelength grid sorted in ascending order')
+        elif (self.lsf is not None) or self.integrate:
+            raise Exception('lsf and integrate are only supported for models with a fused chi2 kernel or a compiled equivalent')
+        self.lsf_sigma = self.lsf.grid(self.wave_fitloc) if self.lsf is not None else None
+        self.edges = pixel_edges(self.wave_fitloc) if self.integrate else None
+        self.warm = False
+        self.broadcasts = None
+
+        if self.linear:
+            return self.run_sampler_linear(pos, pool=pool)
+
+        backend = self.chain_backend(nwalkers, ndim)
+        if (self.warm_start is not None) & (self.backend_iteration==0):
+            pos = self.warm_walkers(pos, self.labels)
+        if self.map_start & (self.backend_iteration==0):
+            pos = self.map_estimate(pos)
+
+        if self.vectorize:
+            if (pool is not None) or (self.pool is not None):
+                raise Exception('vectorize evaluates the whole block of walkers in this process - it cannot be combined with a pool'
+                                ' (pool, ncpu>1 or a FittingPool)')
+            sampler = emcee.EnsembleSampler(
+                nwalkers, ndim, self.log_probability_vectorized, vectorize=True, backend=backend)
+        elif self.pool is not None:
+            sampler = emcee.EnsembleSampler(
+                nwalkers, ndim, self.pool.likelihood(self, 'log_probability_general'), args=(), pool=self.pool, backend=backend)
+        else:
+            sampler = emcee.EnsembleSampler(
+                nwalkers, ndim, self.log_probability_general, args=(), pool=pool, backend=backend)
+        
+        self.run_mcmc(sampler, pos)
+        return sampler
+    
+    def run_sampler_ncpu(self, pos):
+        """ run_sampler on self.pool if set, else on a FittingPool of self.ncpu workers started for this fit
+        (or serially if ncpu is 1).
+        """
+        if (self.ncpu==1) | (self.pool is not None):
+            return self.run_sampler(pos)
+        with FittingPool(self.ncpu, lsf=self.lsf, integrate=self.integrate) as pool:
+            self.pool = pool
+            try:
+                return self.run_sampler(pos)
+            finally:
+                self.pool = None
+
+    def pool_state(self):
+        """ Light copy of the fit sent to the FittingPool workers - only the attributes in pool_attributes
+        (fit window, priors and the model/kernel selection) that are set."""
+        state = Fitting.__new__(Fitting)
+        state.__dict__ = {name: self.__dict__[name] for name in pool_attributes if name in self.__dict__}
+        return state
+
+    def prior_bounds(self):
+        """ Returns the (low, high) bounds of each parameter implied by self.pr_code to be used by the bounded
+        optimiser. The normal and lognormal priors are bounded to loc +- map_nsigma scale.
+        """
+        bounds = []
+        for p in self.pr_code:
+            if p[0]==0:
+                bounds.append((p[1]-self.map_nsigma*p[2], p[1]+self.map_nsigma*p[2]))
+            elif p[0]==2:
+                bounds.append((10**(p[1]-self.map_nsigma*p[2]), 10**(p[1]+self.map_nsigma*p[2])))
+            elif p[0]==1:
+                bounds.append((p[1], p[2]))
+            elif p[0]==3:
+                bounds.append((10**p[1], 10**p[2]))
+            elif p[0]==4:
+                bounds.append((p[3], p[4]))
+            elif p[0]==5:
+                bounds.append((10**p[3], 10**p[4]))
+            else:
+                bounds.append((None, None))
+        return bounds
+
+    def map_estimate(self, pos):
+        """ Bounded minimisation (scipy Powell) of the negative log_probability_general, started from the 
+        best of the initial walker positions pos within prior_bounds. Returns the walkers placed in a ball around
+        the MAP with a relative size of self.map_ball - or pos unchanged if the optimiser did not improve on the
+        log probability of the best initial walker (self.MAP_used False). The MAP is stored in self.MAP (dict of
+        labels) and self.MAP_theta, its log probability in self.MAP_logprob and the optimiser cost in
+        self.MAP_nfev and self.MAP_time (s).
+        """
+        import time
+        from scipy.optimize import minimize
+        
+        def neg_log_probability(theta):
+            lp = self.log_probability_general(theta)
+            return -lp if np.isfinite(lp) else 1e30
+
+        start = time.time()
+        lp = np.array([self.log_probability_general(th) for th in pos])
+        best = np.nanargmax(np.where(np.isfinite(lp), lp, -np.inf))
+        theta0 = pos[best].copy()
+        bounds = self.prior_bounds()
+        for i, (low, high) in enumerate(bounds):
+            theta0[i] = np.clip(theta0[i], low, high)
+
+        res = minimize(neg_log_probability, theta0, method='Powell', bounds=bounds)
+
+        self.MAP_theta = res.x
+        self.MAP = dict(zip(self.labels, res.x))
+        self.MAP_logprob = -res.fun
+        self.MAP_nfev = res.nfev + len(pos)
+        self.MAP_time = time.time()-start
+        self.MAP_used = bool(np.isfinite(self.MAP_logprob) & (self.MAP_logprob > np.nan_to_num(lp[best], nan=-np.inf)))
+        if not self.MAP_used:
+            print('map_start: the MAP (log probability %.6g) does not improve on the initial walkers (%.6g) - not used'
+                  %(self.MAP_logprob, lp[best]))
+            return pos
+
+        pos_new = np.random.normal(res.x, abs(res.x*self.map_ball)+1e-10, pos.shape)
+        for i in range(len(pos_new)):
+            if not np.isfinite(self.log_probability_general(pos_new[i])):
+                pos_new[i] = res.x + (pos_new[i]-res.x)*1e-3
+        return pos_new
+
+    def run_sampler_linear(self, pos, pool=None):
+        """ Runs the emcee over the nonlinear parameters only (self.linear = 'nnls' or 'marginalise'). The line peaks
+        and cont are solved for at each step by log_probability_linear and stored as the blobs of the sampler. The
+        number of walkers is reduced to max(16, 4*ndim) of the nonlinear parameters (or kept if lower). Use
+        flat_chain to get the full samples back.
+        The design matrix of the amplitudes is built in one pass from the line table of the model (Model_builder,
+        which also supports lsf and integrate) or from the python model evaluated once per amplitude.
+        The amplitudes keep the bounds and shape of their uniform or loguniform priors and the constraints on
+        them: each step draws self.linear_draws importance samples of the amplitudes from their conditional
+        posterior (see Fitting.linear.solve_amplitudes).
+        Raises an exception for other priors on the amplitudes and amplitudes the line table is not linear in.
+        """
+        self.linear_idx = np.array([i for i, name in enumerate(self.labels) if ('_peak' in name) | (name=='cont')], dtype=int)
+        self.nonlinear_idx = np.array([i for i, name in enumerate(self.labels) if i not in self.linear_idx], dtype=int)
+        if len(self.linear_idx)==0:
+            raise Exception('linear mode: none of the labels is a line peak or cont')
+        self.linear_column = np.full(len(self.labels), -1, dtype=np.int64)
+        self.linear_column[self.linear_idx] = np.arange(len(self.linear_idx))
+
+        self.linear_table = Model_builder.table_model_of(self.fitted_model) if self.use_kernels else None
+        if self.linear_table is not None:
+            nonlinear = [self.labels[i] for i in self.linear_table.nonlinear_slots() if i in self.linear_idx]
+            if nonlinear:
+                raise Exception('linear mode: the model is not linear in '+', '.join(nonlinear))
+        elif (self.lsf is not None) or self.integrate:
+            raise Exception('lsf and integrate are only supported with linear for line table models')
+
+        informative = [self.labels[i] for i in self.linear_idx if self.pr_code[i,0] not in [1, 3]]
+        if informative:
+            raise Exception('linear mode: the amplitudes need uniform or loguniform priors (or linear=None) - not the case for '
+                            +', '.join(informative))
+        code = self.pr_code[self.linear_idx]
+        self.linear_log = code[:,0]==3
+        self.linear_lo = np.where(self.linear_log, 10**code[:,1], code[:,1])
+        self.linear_hi = np.where(self.linear_log, 10**code[:,2], code[:,2])
+        cons = self.prior.cons if (self.log_prior_fce is logprior_general) and hasattr(self, 'prior') else np.zeros((0,3))
+        amplitude = np.isin(cons[:,0], self.linear_idx) | np.isin(cons[:,1], self.linear_idx)
+        self.linear_cons = np.ascontiguousarray(cons[amplitude])
+
+        self.pr_code_nonlinear = np.ascontiguousarray(self.pr_code[self.nonlinear_idx])
+        self.prior_nonlinear = Prior(self.pr_code_nonlinear, [self.labels[i] for i in self.nonlinear_idx], self.prior.constraints)
+        self.wave_fitloc = np.ascontiguousarray(self.wave_fitloc, dtype=float)
+        self.flux_fitloc = np.ascontiguousarray(self.flux_fitloc, dtype=float)
+        self.error_fitloc = np.ascontiguousarray(self.error_fitloc, dtype=float)
+        self.linear_use = np.isfinite(self.flux_fitloc) & np.isfinite(self.error_fitloc) & (self.error_fitloc>0)
+        
+        ndim = len(self.nonlinear_idx)
+        nwalkers = min(len(pos), max(16, 4*ndim))
+        pos = pos[:nwalkers]
+
+        backend = self.chain_backend(nwalkers, ndim)
+        if (self.warm_start is not None) & (self.backend_iteration==0):
+            pos = self.warm_walkers(pos, [self.labels[i] for i in self.nonlinear_idx])
+        if self.map_start & (self.backend_iteration==0):
+            pos = self.map_estimate(pos)[:, self.nonlinear_idx]
+        else:
+            pos = pos[:, self.nonlinear_idx]
+        if self.backend_iteration==0:
+            # walkers where no draw of the amplitudes meets the constraints would not move - restart them next to the others
+            bad = np.array([not np.isfinite(self.log_probability_linear(th)[0]) for th in pos])
+            if np.any(bad) & np.any(~bad):
+                good = pos[~bad][np.random.randint(np.sum(~bad), size=np.sum(bad))]
+                pos[bad] = good*(1 + 1e-5*np.random.standard_normal(good.shape))
+
+        if self.pool is not None:
+            sampler = emcee.EnsembleSampler(
+                nwalkers, ndim, self.pool.likelihood(self, 'log_probability_linear'), args=(), pool=self.pool, backend=backend)
+        else:
+            sampler = emcee.EnsembleSampler(
+                nwalkers, ndim, self.log_probability_linear, args=(), pool=pool, backend=backend)
+        self.run_mcmc(sampler, pos)
+        return sampler
+
+    def warm_walkers(self, pos, sampled):
+        """ Returns the walkers pos (nwalkers, len(labels)) moved to a normal of width warm_ball*sigma around the
+        values of self.warm_start (label: (value, sigma)), clipped to the prior bounds. Walkers outside the prior
+        are pulled back towards the start. Sets self.warm if all of the sampled labels were warm started.
+        """
+        start = pos
+        pos = pos.copy()
+        bounds = self.prior_bounds()
+        for i, name in enumerate(self.labels):
+            if name not in self.warm_start:
+                continue
+            value, sigma = self.warm_start[name]
+            low = -np.inf if bounds[i][0] is None else bounds[i][0]
+            high = np.inf if bounds[i][1] is None else bounds[i][1]
+            value = np.clip(value, low, high)
+            pos[:,i] = np.clip(np.random.normal(value, abs(sigma*self.warm_ball)+1e-10, len(pos)), low, high)
+            pos[np.isnan(pos[:,i]),i] = value
+
+        bad = ~np.isfinite(self.log_prior(pos))
+        if np.all(bad):
+            # warm start outside the prior - keep the default walkers
+            return start
+        centre = np.median(pos[~bad], axis=0)
+        pos[bad] = centre + (pos[bad]-centre)*1e-3
+
+        self.warm = all(name in self.warm_start for name in sampled)
+        return pos
+
+    def chain_backend(self, nwalkers, ndim):
+        """ Returns the emcee HDF5 backend for self.backend (None if not set) and stores in self.backend_iteration
+        the number of steps already in it (0 for a new run). A stored chain is only resumed if it has the
+        chain_signature of this fit.
+        """
+        self.backend_iteration = 0
+        if self.backend is None:
+            return None
+        backend, self.backend_iteration = sp.chain_backend(self.backend, nwalkers, ndim, name=self.backend_name,
+                                                           signature=self.chain_signature())
+        return backend
+
+    def chain_signature(self):
+        """ Hash of what is fitted - labels, model, template, linear mode, priors of the labels and their constraints
+        and the fit window data - that a chain stored in the backend must match to be resumed (Utils.chain_signature)."""
+        model = model_name(self.fitted_model) or getattr(self.fitted_model, '__qualname__', None) or repr(self.fitted_model)
+        return sp.chain_signature(list(self.labels), model, self.template, self.linear, self.integrate,
+                                  [self.priors.get(name) for name in self.labels], self.prior.cons.tolist() if hasattr(self, 'prior') else None,
+                                  np.asarray(self.wave_fitloc), np.asarray(self.flux_fitloc), np.asarray(self.error_fitloc))
+
+    def run_mcmc(self, sampler, pos):
+        """ Runs the sampler from pos for self.N steps, or with self.autocorr until the chains converged 
+        (N > autocorr_factor*tau and tau stable to autocorr_tol, checked every autocorr_check steps).
+        A fully warm started run (self.warm) is shortened to (0.5+warm_burnin)*N steps.
+        A run stored in the backend is continued from its last sample up to self.N steps in total.
+        Stores the realised number of steps in self.N_run and the autocorrelation time per parameter in self.tau.
+        """
+        N = int((0.5+self.warm_burnin)*self.N) if self.warm else self.N
+        steps = N
+        if self.backend_iteration>0:
+            # resume from the last walker positions stored in the backend
+            pos = sampler.backend.get_last_sample()
+            steps = max(N - self.backend_iteration, 0)
+
+        if steps==0:
+            pass
+        elif not self.autocorr:
+            sampler.run_mcmc(pos, steps, progress=self.progress)
+        else:
+            tau_old = np.inf
+            for sample in sampler.sample(pos, iterations=steps, progress=self.progress):
+                if sampler.iteration % self.autocorr_check:
+                    continue
+                tau = sampler.get_autocorr_time(tol=0)
+                if np.all(np.isfinite(tau)) & np.all(tau*self.autocorr_factor < sampler.iteration) & \
+                        np.all(np.abs(tau_old - tau)/tau < self.autocorr_tol):
+                    break
+                tau_old = tau
+        
+        self.N_run = sampler.iteration
+        self.tau = sampler.get_autocorr_time(tol=0)
+        self.converged = bool(np.all(self.tau*self.autocorr_factor < self.N_run))
+
+    def burn_thin(self, discard, thin):
+        """ Returns the burn-in and thinning to use on the chains: the values passed (at most warm_burnin*N for
+        a warm started run) or, with self.autocorr, 2*max(tau) and 0.5*min(tau).
+        """
+        if self.warm:
+            discard = min(discard, int(self.warm_burnin*self.N))
+        if not self.autocorr:
+            return discard, thin
+        tau = self.tau[np.isfinite(self.tau)]
+        if len(tau)==0:
+            return min(discard, int(0.5*self.N_run)), thin
+        return min(int(2*np.max(tau)), int(0.5*self.N_run)), int(max(1, 0.5*np.min(tau)))
+
+    def flat_log_prob(self, sampler, discard, thin):
+        """ Returns the flattened log probability chain with the same burn-in and thinning as flat_chain."""
+        discard, thin = self.burn_thin(discard, thin)
+        return sampler.get_log_prob(discard=discard, thin=thin, flat=True)
+
+    def log_probability_linear(self, theta):
+        """ Log probability function used in the emcee when self.linear is set. Theta are the nonlinear parameters only,
+        the amplitudes are solved for (nnls) or marginalised over by linear_solve. Returns the log probability and
+        the amplitudes (blobs of the sampler, the sample of linear_solve).
+        """
+        if self.log_prior_fce is logprior_general:
+            lp = self.prior_nonlinear(theta)
+        else:
+            lp = self.log_prior_fce(theta, self.pr_code_nonlinear)
+        if not np.isfinite(lp):
+            return -np.inf, np.zeros(len(self.linear_idx))
+        
+        amps, log_likelihood, sample = self.linear_solve(theta)
+        return lp + log_likelihood, sample
+
+    def linear_solve(self, theta):
+        """ Solves for the linear amplitudes (line peaks and cont) given the nonlinear parameters theta
+        (see Fitting.linear.solve_amplitudes).
+
+        Parameters
+        ----------
+
+        theta : array
+            values of the nonlinear parameters (ordered as self.nonlinear_idx)
+
+        Returns
+        -------
+        amps : array
+            best fit amplitudes within the prior bounds (ordered as self.linear_idx). Amplitudes of components
+            outside the fitted range are at the centre of their prior.
+        
+        log_likelihood : float
+            -0.5 chi2 of the best fit for 'nnls', the likelihood marginalised over the prior of the amplitudes
+            (importance sampling estimate) for 'marginalise'
+
+        sample : array
+            a draw from the conditional posterior of the amplitudes (both modes)
+        """
+        nlin = len(self.linear_idx)
+        full = np.zeros(len(self.labels))
+        full[self.nonlinear_idx] = theta
+        if self.linear_table is not None:
+            offset, design = self.linear_table.design(self.wave_fitloc, full, self.linear_column, self.template,
+                                                      window_k(self.tolerance), self.lsf_sigma, self.edges)
+        else:
+            rows = np.tile(full, (nlin+1, 1))
+            rows[np.arange(nlin)+1, self.linear_idx] = 1.
+            evalm = np.asarray(self.model_eval_vectorized(self.wave_fitloc, rows), dtype=float)
+            offset = np.ascontiguousarray(evalm[0])
+            design = np.ascontiguousarray(evalm[1:]-evalm[0])
+
+        uniforms = np.random.random((max(1, self.linear_draws), nlin+1))
+        return solve_amplitudes(design, offset, self.flux_fitloc, self.error_fitloc, self.linear_use, self.linear_lo, self.linear_hi,
+                                self.linear_log, full, self.linear_idx, self.linear_cons, self.linear=='nnls', uniforms)
+
+    def flat_chain(self, sampler, discard, thin):
+        """ Returns the flattened chain of the sampler (burn-in and thinning from burn_thin). If self.linear is set the amplitude
+        chains are taken from the blobs of the sampler: draws from the conditional posterior of the amplitudes given the
+        nonlinear parameters of each step.
+        """
+        discard, thin = self.burn_thin(discard, thin)
+        flat_samples = sampler.get_chain(discard=discard, thin=thin, flat=True)
+        if not self.linear:
+            return flat_samples
+        
+        full = np.zeros((len(flat_samples), len(self.labels)))
+        full[:, self.nonlinear_idx] = flat_samples
+        full[:, self.linear_idx] = sampler.get_blobs(discard=discard, thin=thin, flat=True)
+        return full
+    
     def log_probability_custom(self, theta):
         """ Basic log probability function used in the emcee. Theta are the variables supplied by the emcee 
         """
@@ -1231,40 +1355,26 @@ class Fitting:
         
         return lp + log_likelihood
     
-    def prior_create(self):
-        """ Function that takes the prior dictionary and create a priote code that the prior function as using.         
+    def prior_create(self, constraints=[]):
+        """ Function that takes the prior dictionary and create a priote code that the prior function as using.
+        Also builds the compiled prior (self.prior) with the physical constraints self.prior_constraints, or
+        constraints (the default of the fitting method) if it is None.
         """
-        pr_code = np.zeros((len(self.labels),5))
-        
-        for key in enumerate(self.labels):
-            if self.priors[key[1]][1]== 'normal':
-                pr_code[key[0]][0] = 0
-            
-            elif self.priors[key[1]][1]== 'lognormal':
-                pr_code[key[0]][0] = 2
-            
-            elif self.priors[key[1]][1]== 'uniform':
-                pr_code[key[0]][0] = 1
-            
-            elif self.priors[key[1]][1]== 'loguniform':
-                pr_code[key[0]][0] = 3
-            
-            elif self.priors[key[1]][1]== 'normal_hat':
-                pr_code[key[0]][0] = 4
-                pr_code[key[0]][3] = self.priors[key[1]][4]
-                pr_code[key[0]][4] = self.priors[key[1]][5]
-
-            elif self.priors[key[1]][1]== 'lognormal_hat':
-                pr_code[key[0]][0] = 5
-                pr_code[key[0]][3] = self.priors[key[1]][4]
-                pr_code[key[0]][4] = self.priors[key[1]][5]
-                
-            else:
-                raise Exception('Sorry mode in prior type not understood: ', key )
-            
-            pr_code[key[0]][1] = self.priors[key[1]][2]
-            pr_code[key[0]][2] = self.priors[key[1]][3]
-        return pr_code
+        if self.prior_constraints is not None:
+            constraints = self.prior_constraints
+        self.prior = Prior(prior_code(self.labels, self.priors), self.labels, constraints)
+        return self.prior.pr_code
+
+    def log_prior(self, theta):
+        """ Log prior of theta (a parameter vector or a (nwalkers, ndim) block) - the compiled prior with its
+        constraints (self.prior) for logprior_general, self.log_prior_fce otherwise.
+        """
+        if self.log_prior_fce is logprior_general:
+            return self.prior(theta)
+        theta = np.asarray(theta, dtype=float)
+        if theta.ndim==1:
+            return self.log_prior_fce(theta, self.pr_code)
+        return np.array([self.log_prior_fce(th, self.pr_code) for th in theta], dtype=float)
     
     def prop_calc(self): 
         """ Take the dictionary with the results chains and calculates the values 
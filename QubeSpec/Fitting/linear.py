@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled solvers of the linear amplitudes (line peaks and cont) of Fitting linear mode.
+
+The model is offset + amps @ design, with design the model of each amplitude set to 1 (see
+Model_builder.table_design). The weighted normal equations are accumulated in one pass over the spectrum and
+solved by Cholesky. The amplitudes are scaled to a unit diagonal of the normal matrix before solving.
+
+The amplitudes keep their (uniform or loguniform) priors: 'nnls' gives the bounded least squares fit (profile
+likelihood) and 'marginalise' integrates the likelihood over the prior. Both draw the sample of the amplitudes
+from their conditional posterior - the Gaussian of the normal equations truncated to the prior bounds, weighted
+by the prior density and the constraints - with the GHK sequential importance sampler.
+"""
+import math
+import numpy as np
+import numba
+
+from .priors import satisfies
+
+SQRT2 = np.sqrt(2.)
+
+
+@numba.njit(cache=True)
+def cholesky(M):
+    """ Lower triangular L with M = L L^T. Returns (L, False) if M is not positive definite."""
+    n = M.shape[0]
+    L = np.zeros((n, n))
+    for j in range(n):
+        d = M[j,j]
+        for m in range(j):
+            d -= L[j,m]*L[j,m]
+        if not d > 0:
+            return L, False
+        L[j,j] = np.sqrt(d)
+        for i in range(j+1, n):
+            s = M[i,j]
+            for m in range(j):
+                s -= L[i,m]*L[j,m]
+            L[i,j] = s/L[j,j]
+    return L, True
+
+@numba.njit(cache=True)
+def forward(L, b):
+    """ Solves L y = b for the lower triangular L."""
+    n = len(b)
+    y = np.empty(n)
+    for i in range(n):
+        s = b[i]
+        for m in range(i):
+            s -= L[i,m]*y[m]
+        y[i] = s/L[i,i]
+    return y
+
+@numba.njit(cache=True)
+def backward(L, y):
+    """ Solves L^T x = y for the lower triangular L."""
+    n = len(y)
+    x = np.empty(n)
+    for i in range(n-1, -1, -1):
+        s = y[i]
+        for m in range(i+1, n):
+            s -= L[m,i]*x[m]
+        x[i] = s/L[i,i]
+    return x
+
+@numba.njit(cache=True)
+def subset_solve(M, v, passive):
+    """ Solution of the normal equations M x = v restricted to the passive amplitudes (0 elsewhere).
+    Returns (x, False) if that part of M is singular."""
+    idx = np.nonzero(passive)[0]
+    x = np.zeros(len(v))
+    L, ok = cholesky(M[idx][:, idx])
+    if ok:
+        x[idx] = backward(L, forward(L, v[idx]))
+    return x, ok
+
+@numba.njit(cache=True)
+def nnls(M, v):
+    """ Non-negative least squares (Lawson-Hanson active set) on the normal equations M x = v."""
+    n = len(v)
+    x = np.zeros(n)
+    passive = np.zeros(n, dtype=np.bool_)
+    tol = 1e-12*np.max(np.abs(v)) if n > 0 else 0.
+    for it in range(3*n):
+        w = v - M @ x
+        j = -1
+        best = tol
+        for i in range(n):
+            if (not passive[i]) and (w[i] > best):
+                best = w[i]
+                j = i
+        if j < 0:
+            break
+        passive[j] = True
+        for inner in range(3*n):
+            s, ok = subset_solve(M, v, passive)
+            if not ok:
+                # degenerate amplitude - keep the previous solution
+                passive[j] = False
+                return x
+            positive = True
+            for i in range(n):
+                if passive[i] and (s[i] <= 0):
+                    positive = False
+            if positive:
+                x = s
+                break
+            alpha = 1.
+            limit = -1
+            for i in range(n):
+                if passive[i] and (s[i] <= 0):
+                    step = x[i]/(x[i]-s[i])
+                    if step < alpha:
+                        alpha = step
+                        limit = i
+            x = x + alpha*(s-x)
+            if limit >= 0:
+                x[limit] = 0.
+            for i in range(n):
+                if passive[i] and (x[i] <= 0):
+                    passive[i] = False
+                    x[i] = 0.
+    return x
+
+@numba.njit(cache=True)
+def bounded_ls(M, v, lo, hi):
+    """ Least squares on the normal equations M x = v with lo <= x <= hi: nnls of x - lo with the amplitudes
+    above hi fixed to it, releasing the fixed ones whose gradient points inside until the KKT conditions hold."""
+    n = len(v)
+    width = hi - lo
+    vl = v - M @ lo
+    upper = np.zeros(n, dtype=np.bool_)
+    y = np.zeros(n)
+    for it in range(3*n+1):
+        y = np.where(upper, width, 0.)
+        free = np.nonzero(~upper)[0]
+        if len(free) > 0:
+            r = vl - M @ y
+            y[free] = nnls(M[free][:, free], r[free])
+        changed = False
+        for i in free:
+            if y[i] > width[i]:
+                upper[i] = True
+                changed = True
+        if not changed:
+            g = vl - M @ y
+            for i in range(n):
+                if upper[i] and (g[i] < 0):
+                    upper[i] = False
+                    changed = True
+        if not changed:
+            break
+    return lo + np.minimum(y, width)
+
+@numba.njit(cache=True)
+def log_upper(x):
+    """ log of the upper tail 1-Phi(x) of the standard normal, asymptotic beyond x=25."""
+    if x < 25:
+        return np.log(0.5*math.erfc(x/SQRT2))
+    return -0.5*x*x - np.log(x*np.sqrt(2*np.pi)) + np.log1p(-1/(x*x) + 3/x**4)
+
+@numba.njit(cache=True)
+def ndtri(p):
+    """ Inverse of the standard normal cdf - Acklam's rational approximation refined by one Halley step."""
+    if p <= 0:
+        return -np.inf
+    if p >= 1:
+        return np.inf
+    if p < 0.02425:
+        q = np.sqrt(-2*np.log(p))
+        x = ((((((-7.784894002430293e-03*q - 3.223964580411365e-01)*q - 2.400758277161838e+00)*q
+                - 2.549732539343734e+00)*q + 4.374664141464968e+00)*q + 2.938163982698783e+00)
+             /((((7.784695709041462e-03*q + 3.224671290700398e-01)*q + 2.445134137142996e+00)*q
+                + 3.754408661907416e+00)*q + 1))
+    elif p <= 1-0.02425:
+        q = p - 0.5
+        r = q*q
+        x = ((((((-3.969683028665376e+01*r + 2.209460984245205e+02)*r - 2.759285104469687e+02)*r
+                + 1.383577518672690e+02)*r - 3.066479806614716e+01)*r + 2.506628277459239e+00)*q
+             /(((((-5.447609879822406e+01*r + 1.615858368580409e+02)*r - 1.556989798598866e+02)*r
+                 + 6.680131188771972e+01)*r - 1.328068155288572e+01)*r + 1))
+    else:
+        q = np.sqrt(-2*np.log(1-p))
+        x = -((((((-7.784894002430293e-03*q - 3.223964580411365e-01)*q - 2.400758277161838e+00)*q
+                 - 2.549732539343734e+00)*q + 4.374664141464968e+00)*q + 2.938163982698783e+00)
+              /((((7.784695709041462e-03*q + 3.224671290700398e-01)*q + 2.445134137142996e+00)*q
+                 + 3.754408661907416e+00)*q + 1))
+    e = 0.5*math.erfc(-x/SQRT2) - p
+    u = e*np.sqrt(2*np.pi)*np.exp(0.5*x*x)
+    return x - u/(1 + 0.5*x*u)
+
+@numba.njit(cache=True)
+def truncated_normal(a, b, u):
+    """ Draw of the standard normal truncated to [a, b] by the inverse cdf at u (uniform in [0, 1)) and the log
+    of the probability of [a, b]. Intervals in the upper half are mirrored to keep the tails accurate and
+    far in the tail (beyond 30 sigma) the exponential approximation of the truncated normal is used."""
+    sign = 1.
+    if a > 0:
+        a, b = -b, -a
+        sign = -1.
+    if b < -30:
+        t, s = -b, -a
+        logp = log_upper(t) + np.log1p(-np.exp(log_upper(s)-log_upper(t)))
+        z = t - np.log1p(-u*(1-np.exp(-t*(s-t))))/t
+        return -sign*z, logp
+    pa = np.exp(log_upper(-a))
+    pb = np.exp(log_upper(-b))
+    z = min(max(ndtri(pa + u*(pb-pa)), a), b)
+    return sign*z, np.log(pb-pa)
+
+@numba.njit(cache=True)
+def log_prior_density(A, lo, hi, logu):
+    """ Log density of the uniform (logu False) or loguniform (in log10, logu True) prior of A between lo and hi."""
+    if logu:
+        return -np.log(A) - np.log(np.log(hi/lo))
+    return -np.log(hi-lo)
+
+@numba.njit(cache=True)
+def solve_amplitudes(design, offset, flux, error, use, lo, hi, logu, full, amp_idx, cons, profile, uniforms):
+    """ Solves for the amplitudes of the model offset + amps @ design (design (namps, len(flux))) on the
+    pixels use, weighted by 1/error**2, with uniform (logu False) or loguniform (logu True) priors between lo
+    and hi (in linear units, lo > 0 for loguniform).
+
+    The conditional posterior of the amplitudes is the Gaussian of the normal equations truncated to the prior
+    bounds and multiplied by the prior density and the constraints cons (Fitting.priors.satisfies of full, the
+    vector of all of the parameters, with the amplitudes at amp_idx). It is sampled with the GHK sequential
+    importance sampler: each row of uniforms (ndraws, namps+1) gives one draw and its weight, the last column
+    of the first row picks the returned sample among them in proportion to the weights.
+
+    profile gives the log likelihood -0.5 chi2 of the bounded least squares fit (profile likelihood). Otherwise
+    the log likelihood is marginalised over the prior of the amplitudes, estimated by the mean weight of the
+    draws (unbiased, so the sampler targets the exact posterior - pseudo-marginal MCMC). Amplitudes with no
+    (finite, non negligible) contribution to the used pixels are drawn from their prior. The log likelihood is
+    -inf if no draw satisfies the constraints.
+
+    Returns the bounded least squares amplitudes, the log likelihood and the sample of the amplitudes.
+    """
+    namps, npix = design.shape
+    active = np.zeros(namps, dtype=np.bool_)
+    finite = np.ones(namps, dtype=np.bool_)
+    for a in range(namps):
+        for i in range(npix):
+            if use[i]:
+                if not np.isfinite(design[a,i]):
+                    finite[a] = False
+                elif design[a,i] != 0:
+                    active[a] = True
+    active = active & finite
+
+    M = np.zeros((namps, namps))
+    v = np.zeros(namps)
+    chi2 = 0.
+    for i in range(npix):
+        if not use[i]:
+            continue
+        w = 1/(error[i]*error[i])
+        r = flux[i]-offset[i]
+        chi2 += r*r*w
+        for a in range(namps):
+            if (not active[a]) or (design[a,i] == 0):
+                continue
+            da = design[a,i]*w
+            v[a] += da*r
+            for b in range(a+1):
+                if active[b]:
+                    M[a,b] += da*design[b,i]
+    for a in range(namps):
+        for b in range(a):
+            M[b,a] = M[a,b]
+
+    # negligible contributions (lines far outside of the spectrum) would make the normal matrix singular
+    diag = np.diag(M)
+    idx = np.nonzero(active & (diag > 1e-30*np.max(diag)))[0]
+    inactive = np.ones(namps, dtype=np.bool_)
+    inactive[idx] = False
+    ndraws = uniforms.shape[0]
+    n = len(idx)
+
+    amps = np.empty(namps)
+    draws = np.empty((ndraws, namps))
+    for a in range(namps):
+        if inactive[a]:
+            amps[a] = np.sqrt(lo[a]*hi[a]) if logu[a] else 0.5*(lo[a]+hi[a])
+            for k in range(ndraws):
+                u = uniforms[k,a]
+                draws[k,a] = lo[a]*(hi[a]/lo[a])**u if logu[a] else lo[a] + u*(hi[a]-lo[a])
+
+    logL = 0.
+    L = np.zeros((n, n))
+    xh = np.zeros(n)
+    scale = np.ones(n)
+    los = np.zeros(n)
+    his = np.zeros(n)
+    if n > 0:
+        scale = 1/np.sqrt(diag[idx])
+        Ms = M[idx][:, idx]*np.outer(scale, scale)
+        vs = v[idx]*scale
+        L, ok = cholesky(Ms)
+        if not ok:
+            return amps, -np.inf, amps.copy()
+        los = lo[idx]/scale
+        his = hi[idx]/scale
+        xb = bounded_ls(Ms, vs, los, his)
+        amps[idx] = xb*scale
+        xh = backward(L, forward(L, vs))
+        if profile:
+            logL = -0.5*(chi2 + xb @ Ms @ xb - 2*(xb @ vs))
+        else:
+            logdet = 2*np.sum(np.log(np.diag(L))) - 2*np.sum(np.log(scale))
+            logL = -0.5*(chi2 - xh @ vs) - 0.5*logdet + 0.5*n*np.log(2*np.pi)
+    else:
+        logL = -0.5*chi2
+
+    logw = np.zeros(ndraws)
+    d = np.empty(n)
+    for k in range(ndraws):
+        for j in range(n-1, -1, -1):
+            s = 0.
+            for m in range(j+1, n):
+                s += L[m,j]*d[m]
+            z, logp = truncated_normal(L[j,j]*(los[j]-xh[j]) + s, L[j,j]*(his[j]-xh[j]) + s, uniforms[k, idx[j]])
+            logw[k] += logp
+            d[j] = (z - s)/L[j,j]
+            a = idx[j]
+            draws[k,a] = min(max((xh[j] + d[j])*scale[j], lo[a]), hi[a])
+            logw[k] += log_prior_density(draws[k,a], lo[a], hi[a], logu[a])
+        if len(cons):
+            full[amp_idx] = draws[k]
+            if not satisfies(full, cons):
+                logw[k] = -np.inf
+
+    top = np.max(logw)
+    if not np.isfinite(top):
+        return amps, -np.inf, amps.copy()
+    weights = np.exp(logw - top)
+    total = np.sum(weights)
+    if not profile:
+        logL += top + np.log(total/ndraws)
+    pick = uniforms[0, namps]*total
+    k = 0
+    cumulative = weights[0]
+    while (cumulative < pick) and (k < ndraws-1):
+        k += 1
+        cumulative += weights[k]
+    return amps, logL, draws[k].copy()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent worker pool that can be shared by many consecutive fits.
+
+The workers are started once. The static data of each fit - only what its log probability reads: wave_fitloc,
+flux_fitloc, error_fitloc, pr_code and the model/kernel selection (see Fitting.pool_state) - is written once to
+the pool directory under the id of the fit and loaded once per worker. Each step of the emcee then sends one
+block of walker positions per worker.
+"""
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import numpy as np
+
+worker_state = {'directory': None, 'key': None, 'object': None}
+
+def numba_warmup(queue=None, lsf=False, integrate=False):
+    """ Compiles (or loads from the on-disk numba cache) the jitted priors, chi2 kernels (hand written and line
+    table) and compiled models with the signatures used in the fits (and the FeII template spline), so that the
+    first spaxel/fit of each process does not pay for it. lsf and integrate - the settings of the fits (Fitting
+    lsf is not None, integrate) - also warm up the LSF broadened and pixel integrated variants of the kernels.
+    Returns the time spent in seconds and also puts it in queue if given (to collect it from pool workers).
+    """
+    import inspect
+    from ..Models.Chi2_kernels import chi2_kernels, pixel_edges
+    from ..Models.Compiled_models import compiled_models
+    from ..Models import Model_builder
+    from .priors import logprior_general, prior_eval_one, Prior
+    from ..Models.FeII_models import spline_eval
+
+    start = time.time()
+    x = np.linspace(1., 2., 10)
+    theta = np.ones(40)
+    pr_code = np.zeros((3,5))
+    pr_code[:,0] = 1
+    pr_code[:,2] = 2
+    logprior_general(theta[:3], pr_code)
+    prior = Prior(pr_code, ['a', 'b', 'c'], [('a', 'b', 1.), ('c', None, 0.)])
+    prior_eval_one(theta[:3], *prior.args)
+    prior(np.ones((2,3)))
+
+    variants = [(None, None)]
+    if lsf or integrate:
+        variants.append((np.full(len(x), 1e-4) if lsf else None, pixel_edges(x) if integrate else None))
+    table = Model_builder.build(next(iter(Model_builder.line_tables.values())))
+    for sigma, edges in variants:
+        for kernel in set(chi2_kernels.values()):
+            kernel(x, x, x, theta, 0., sigma, edges)
+        table.chi2(x, x, x, theta[:len(table.labels)], 0., sigma, edges)
+        table(x, *theta[:len(table.labels)], 0., sigma, edges)
+        for model in set(compiled_models.values()):
+            if hasattr(model, 'py_func'):
+                nparams = len(inspect.signature(model.py_func).parameters)-4
+                model(x, *theta[:nparams], 0., sigma, edges)
+    coeffs = np.zeros((4, 10))
+    coeffs.setflags(write=False) # the coefficients are memory-mapped read-only from the store
+    spline_eval(x, 0., 8., 1e-4, coeffs)
+    compile_time = time.time()-start
+    
+    if queue is not None:
+        queue.put(compile_time)
+    return compile_time
+
+def pool_initializer(directory, lsf=False, integrate=False):
+    """ Initializer of each worker - stores the directory with the data of the fits and warms up numba. The random
+    state is reseeded so that the forked workers do not share it (draws of the marginalised amplitudes)."""
+    np.random.seed()
+    worker_state['directory'] = directory
+    worker_state['key'] = None
+    worker_state['object'] = None
+    numba_warmup(lsf=lsf, integrate=integrate)
+
+def worker_object(key):
+    """ Returns the fit state for key, loading it from the pool directory on the first call of each fit."""
+    if worker_state['key'] != key:
+        import dill
+        with open(os.path.join(worker_state['directory'], key+'.pkl'), 'rb') as file:
+            worker_state['object'] = dill.load(file)
+        worker_state['key'] = key
+    return worker_state['object']
+
+
+class PoolLikelihood:
+    """ Light-weight callable passed to emcee in place of the bound log probability method.
+    Only the key of the fit and the name of the method are pickled with each block of walkers.
+    """
+    def __init__(self, key, method):
+        self.key = key
+        self.method = method
+
+    def __call__(self, theta):
+        return getattr(worker_object(self.key), self.method)(theta)
+
+    def block(self, thetas):
+        """ Log probability (or (log probability, blobs)) of each walker of the block thetas."""
+        fce = getattr(worker_object(self.key), self.method)
+        return [fce(theta) for theta in thetas]
+
+
+class FittingPool:
+    """ Process pool owned by the caller and passed to Fitting (pool=...) or Custom_model.Model.fit_to_data
+    so that consecutive fits share the same warm workers. Close it when done (or use it as a context manager).
+
+    Parameters
+    ----------
+
+    ncpu : int
+        number of worker processes
+
+    lsf : LSF - optional
+        instrumental LSF of the fits (Fitting lsf) - the workers warm up the LSF broadened kernels
+
+    integrate : bool - optional
+        the fits integrate the lines over the pixels (Fitting integrate) - the workers warm up those kernels
+
+    """
+    def __init__(self, ncpu, lsf=None, integrate=False):
+        from multiprocess import Pool
+        self.ncpu = ncpu
+        self.directory = tempfile.mkdtemp(prefix='QubeSpec_pool_')
+        self.key = None
+        self.pool = Pool(ncpu, initializer=pool_initializer, initargs=(self.directory, lsf is not None, integrate))
+
+    def likelihood(self, fit, method='log_probability_general'):
+        """ Sends the static data of the fit to the workers (once, under a new fit id) and returns the callable
+        to give to emcee.
+
+        Parameters
+        ----------
+
+        fit : object
+            Fitting or Custom_model.Model instance ready to be fitted - only fit.pool_state() is sent if it has one
+
+        method : str
+            name of the log probability method of fit
+        """
+        import dill
+        if self.pool is None:
+            raise Exception('FittingPool was closed')
+        self.clean()
+        self.key = uuid.uuid4().hex
+        state = fit.pool_state() if hasattr(fit, 'pool_state') else fit
+        with open(os.path.join(self.directory, self.key+'.pkl'), 'wb') as file:
+            dill.dump(state, file)
+        return PoolLikelihood(self.key, method)
+
+    def map(self, func, iterable):
+        """ map for emcee. The walkers of a PoolLikelihood (also wrapped by emcee without args) are split in one
+        block per worker, anything else is mapped element by element."""
+        target = getattr(func, 'f', func)
+        if isinstance(target, PoolLikelihood) and not getattr(func, 'args', None) and not getattr(func, 'kwargs', None):
+            thetas = np.asarray(list(iterable))
+            blocks = np.array_split(thetas, max(1, min(self.ncpu, len(thetas))))
+            return [res for block in self.pool.map(target.block, blocks) for res in block]
+        return self.pool.map(func, iterable)
+
+    def clean(self):
+        """ Removes the data of the previous fit."""
+        if self.key is not None:
+            try:
+                os.remove(os.path.join(self.directory, self.key+'.pkl'))
+            except FileNotFoundError:
+                pass
+            self.key = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # the live pool is not stored when a Fitting object is pickled (e.g. Fitting.save)
+        return {'ncpu': self.ncpu, 'directory': None, 'key': None, 'pool': None}
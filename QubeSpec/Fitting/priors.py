@@ -42,7 +42,7 @@ def logprior_general_scipy(theta, priors):
 
 
 import numba
-@numba.njit
+@numba.njit(cache=True)
 def logprior_general(theta, priors):
     results = 0.
     for t,p in zip( theta, priors):
@@ -69,7 +69,140 @@ def logprior_general(theta, priors):
     return results
 
 
-@numba.njit
+def prior_code(labels, priors):
+    """ Converts the priors dictionary to the prior code array (nparameters, 5) with columns 
+    [type, loc/low, scale/high, low hat, high hat] used by the prior functions. Types: 0 normal, 1 uniform, 
+    2 lognormal, 3 loguniform, 4 normal_hat, 5 lognormal_hat.
+    """
+    types = {'normal':0, 'uniform':1, 'lognormal':2, 'loguniform':3, 'normal_hat':4, 'lognormal_hat':5}
+    pr_code = np.zeros((len(labels),5))
+    for i, name in enumerate(labels):
+        if priors[name][1] not in types:
+            raise Exception('Sorry mode in prior type not understood: ', (i, name) )
+        pr_code[i][0] = types[priors[name][1]]
+        pr_code[i][1] = priors[name][2]
+        pr_code[i][2] = priors[name][3]
+        if pr_code[i][0]>=4:
+            pr_code[i][3] = priors[name][4]
+            pr_code[i][4] = priors[name][5]
+    return pr_code
+
+# Physical constraints as (a, b, factor): theta[a] >= factor*theta[b], or theta[a] >= factor if b is None - the ones
+# encoded in the model specific priors (log_prior_Halpha, log_prior_Halpha_OIII, ...) grouped by kind. Constraints on
+# labels that are not fitted are ignored.
+physical_constraints = {'positive': [('Hal_peak', None, 0), ('NII_peak', None, 0), ('SIIr_peak', None, 0), ('SIIb_peak', None, 0),
+                                     ('BLR_Hal_peak', None, 0)],
+                        # [SII] below Halpha and [SII]6716/6731 between its high and low density limits
+                        'SII': [('Hal_peak', 'SIIr_peak', 1), ('Hal_peak', 'SIIb_peak', 1),
+                                ('SIIb_peak', 'SIIr_peak', 0.44), ('SIIr_peak', 'SIIb_peak', 1/1.45)],
+                        # outflow components below the narrow ones
+                        'outflow': [('Hal_peak', 'Hal_out_peak', 1), ('Hal_peak', 'Halpha_out_peak', 1), ('NII_peak', 'NII_out_peak', 1),
+                                    ('OIII_peak', 'OIII_out_peak', 1), ('Hbeta_peak', 'Hbeta_out_peak', 1), ('Hb_nar_peak', 'Hb_out_peak', 1)],
+                        # Halpha/Hbeta above the case B value (with margin)
+                        'Balmer': [('Hal_peak', 'Hbeta_peak', 2.86/1.35), ('BLR_Hal_peak', 'BLR_Hbeta_peak', 2.86/1.35)]}
+
+# constraints applied by default to the named models (Fitting.setup_named_model)
+named_constraints = [cons for group in physical_constraints.values() for cons in group]
+
+@numba.njit(cache=True)
+def satisfies(theta, cons):
+    """ True if theta meets the constraints cons rows [a, b, factor] (theta[a] >= factor*theta[b], b<0 for
+    theta[a] >= factor)."""
+    for k in range(cons.shape[0]):
+        b = 1. if cons[k,1] < 0 else theta[int(cons[k,1])]
+        if not (theta[int(cons[k,0])] >= cons[k,2]*b):
+            return False
+    return True
+
+@numba.njit(cache=True)
+def prior_eval_one(theta, gauss, bound, cons, const):
+    """ Evaluates the prior grouped by Prior on a single parameter vector theta. gauss rows are
+    [index, mu, 1/sigma, -log(sigma)-0.5log(2pi), log10], bound rows [index, low, high, log10] and cons rows
+    [a, b, factor] (see satisfies).
+    """
+    lp = const
+    for k in range(gauss.shape[0]):
+        y = theta[int(gauss[k,0])]
+        if gauss[k,4]:
+            y = np.log10(y)
+        d = (y - gauss[k,1])*gauss[k,2]
+        lp += gauss[k,3] - 0.5*d*d
+
+    for k in range(bound.shape[0]):
+        y = theta[int(bound[k,0])]
+        if bound[k,3]:
+            y = np.log10(y)
+        if not ((bound[k,1] < y) & (y < bound[k,2])):
+            return -np.inf
+    if not satisfies(theta, cons):
+        return -np.inf
+    return lp if lp==lp else -np.inf
+
+@numba.njit(cache=True)
+def prior_eval(theta, gauss, bound, cons, const):
+    """ prior_eval_one on each walker of a block theta (nwalkers, ndim)."""
+    nwalkers = theta.shape[0]
+    results = np.empty(nwalkers)
+    for w in range(nwalkers):
+        results[w] = prior_eval_one(theta[w], gauss, bound, cons, const)
+    return results
+
+
+class Prior:
+    """ Compiled prior built once per fit from the prior code (see prior_code). The parameters are grouped by 
+    distribution type and the constants (log sigma, log(b-a), truncation bounds) are precomputed, so the evaluation
+    (prior_eval_one) does not branch on the type. Works on a single parameter vector or a (nwalkers, ndim) block
+    (prior_eval) and gives the same values as logprior_general. The hot loop (Fitting.log_probability_general)
+    calls prior_eval_one directly with Prior.args.
+
+    Parameters
+    ----------
+
+    pr_code : array
+        prior code array (nparameters, 5)
+
+    labels : list - optional
+        names of the parameters, needed for the constraints
+
+    constraints : list - optional
+        extra physical constraints as (a, b, factor) meaning theta[a] >= factor*theta[b] (theta[a] >= factor if b 
+        is None) - a and b are labels. See physical_constraints and named_constraints.
+    """
+    def __init__(self, pr_code, labels=None, constraints=[]):
+        self.pr_code = np.ascontiguousarray(pr_code, dtype=float)
+        code = self.pr_code[:,0].astype(int)
+        loc = self.pr_code[:,1]
+        scale = self.pr_code[:,2]
+
+        log = ((code==2) | (code==3) | (code==5)).astype(float)
+
+        gauss_idx = np.where((code==0) | (code==2) | (code==4) | (code==5))[0]
+        self.gauss = np.column_stack([gauss_idx, loc[gauss_idx], 1/scale[gauss_idx],
+                                      -np.log(scale[gauss_idx]) - 0.5*np.log(2*np.pi), log[gauss_idx]]).reshape(-1,5)
+
+        flat = np.where((code==1) | (code==3))[0]
+        hat = np.where((code==4) | (code==5))[0]
+        self.bound = np.vstack([np.column_stack([flat, loc[flat], scale[flat], log[flat]]).reshape(-1,4),
+                                np.column_stack([hat, self.pr_code[hat,3], self.pr_code[hat,4], log[hat]]).reshape(-1,4)])
+        self.const = float(np.sum(-np.log(scale[flat]-loc[flat])))
+
+        self.constraints = list(constraints)
+        cons = []
+        for a, b, factor in self.constraints:
+            if (labels is None) or (a not in labels) or ((b is not None) and (b not in labels)):
+                continue
+            cons.append([labels.index(a), -1 if b is None else labels.index(b), factor])
+        self.cons = np.array(cons, dtype=float).reshape(-1,3)
+        self.args = (self.gauss, self.bound, self.cons, self.const)
+
+    def __call__(self, theta):
+        theta = np.asarray(theta, dtype=float)
+        if theta.ndim==1:
+            return prior_eval_one(theta, *self.args)
+        return prior_eval(np.ascontiguousarray(theta), *self.args)
+
+
+@numba.njit(cache=True)
 def logprior_general_test(theta, priors, labels):
     for t,p,lb in zip( theta, priors, labels):
         print(p)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact fit results.
+
+FitResult keeps only what is needed downstream of a fit (labels, percentiles, a thinned chain, chi2/BIC and
+the model on the fit window) in float32 by default, instead of the whole Fitting.__dict__ with the spectrum and full chains.
+"""
+import importlib
+import pickle
+import numpy as np
+
+
+class FitResult:
+    """ Compact result of a Fitting run - use Fitting.result() to create it.
+
+    Parameters
+    ----------
+
+    Fits : Fitting
+        fitted Fitting class instance
+
+    nchain : int - optional
+        number of chain samples to keep (evenly thinned). None keeps every sample, 0 no chain. Default 1000.
+
+    dtype : numpy dtype - optional
+        precision of the stored percentiles, chain and model. Default np.float32
+
+    """
+    __slots__ = ('name', 'labels', 'fitted_model', 'template', 'percentiles', 'chain', 'chi2', 'BIC',
+                 'fit_range', 'yeval')
+
+    def __init__(self, Fits, nchain=1000, dtype=np.float32):
+        self.name = Fits.props.get('name', '')
+        self.labels = list(Fits.labels)
+        self.fitted_model = model_name(getattr(Fits, 'fitted_model', None))
+        self.template = getattr(Fits, 'template', None)
+        self.percentiles = np.array([Fits.props[name] for name in self.labels], dtype=dtype)
+
+        chain = np.array([Fits.chains[name] for name in self.labels], dtype=dtype).T
+        if nchain is None:
+            self.chain = chain
+        elif nchain==0:
+            self.chain = None
+        else:
+            self.chain = chain[np.unique(np.linspace(0, len(chain)-1, min(nchain, len(chain))).astype(int))]
+
+        self.chi2 = float(getattr(Fits, 'chi2', np.nan))
+        self.BIC = float(getattr(Fits, 'BIC', np.nan))
+
+        wave_fitloc = np.asarray(Fits.wave_fitloc)
+        self.fit_range = (float(np.min(wave_fitloc)), float(np.max(wave_fitloc)))
+        wave = np.asarray(Fits.wave)
+        yeval = np.asarray(getattr(Fits, 'yeval', []))
+        if len(yeval) == len(wave):
+            self.yeval = yeval[self.fit_window(wave)].astype(dtype)
+        else:
+            self.yeval = None
+
+    def fit_window(self, wave):
+        """ Bool mask of the fit window on wave."""
+        return (wave>=self.fit_range[0]) & (wave<=self.fit_range[1])
+
+    @property
+    def props(self):
+        """ Results dictionary in the same format as Fitting.props."""
+        props = {'name': self.name}
+        for name, p in zip(self.labels, self.percentiles):
+            props[name] = p.astype(float)
+        props['popt'] = list(self.percentiles[:,0].astype(float))
+        return props
+
+    @property
+    def chains(self):
+        """ Chains dictionary in the same format as Fitting.chains (None if no chain was kept)."""
+        if self.chain is None:
+            return None
+        chains = {'name': self.name}
+        for i, name in enumerate(self.labels):
+            chains[name] = self.chain[:,i].astype(float)
+        return chains
+
+    def model(self):
+        """ Returns the fitted model function (None if it was not stored)."""
+        if self.fitted_model is None:
+            return None
+        module, name = self.fitted_model.split(':')
+        return getattr(importlib.import_module(module), name)
+
+    def to_fitting(self, wave, flux, error):
+        """ Rebuilds a Fitting instance with the spectrum that was fitted (e.g. from the unwrapped cube)
+        so that the plotting and map making functions can be used on the compact result. If the fitted model
+        cannot be imported (e.g. defined in __main__) Fits.fitted_model is None and Fits.yeval is the stored
+        model on the fit window (nan outside).
+        """
+        from .fits_r import Fitting
+        z = float(self.percentiles[self.labels.index('z'),0]) if 'z' in self.labels else ''
+        Fits = Fitting(wave, flux, error, z)
+        Fits.labels = list(self.labels)
+        Fits.props = self.props
+        Fits.chains = self.chains
+        if self.chain is not None:
+            Fits.flat_samples = self.chain.astype(float)
+        Fits.chi2 = self.chi2
+        Fits.BIC = self.BIC
+        Fits.template = self.template
+        Fits.fitted_model = None
+
+        use = self.fit_window(wave)
+        Fits.wave_fitloc = wave[use]
+        Fits.flux_fitloc = flux[use]
+        Fits.error_fitloc = error[use]
+        try:
+            Fits.fitted_model = self.model()
+            if self.template:
+                Fits.yeval = Fits.fitted_model(wave, *Fits.props['popt'], self.template)
+            else:
+                Fits.yeval = Fits.fitted_model(wave, *Fits.props['popt'])
+        except Exception:
+            Fits.yeval = np.full(len(wave), np.nan)
+            if (self.yeval is not None) and (np.sum(use)==len(self.yeval)):
+                Fits.yeval[use] = self.yeval
+        return Fits
+
+
+def model_name(fitted_model):
+    """ 'module:function' name of the fitted model so it can be imported back (None if not a module function)."""
+    if callable(fitted_model) and hasattr(fitted_model, '__module__') and hasattr(fitted_model, '__name__'):
+        if fitted_model.__name__ != '<lambda>':
+            return fitted_model.__module__+':'+fitted_model.__name__
+    return None
+
+
+def compact_results(results, nchain=1000, dtype=np.float32):
+    """ Converts the Fitting instances in a result (single Fitting or list of spaxel rows [i,j,Fits,...])
+    to FitResult (see FitResult for nchain and dtype). Failed fits and FitResults are kept as they are.
+    """
+    from .fits_r import Fitting
+    if isinstance(results, Fitting):
+        return FitResult(results, nchain=nchain, dtype=dtype)
+
+    rows = []
+    for row in results:
+        rows.append([FitResult(res, nchain=nchain, dtype=dtype) if isinstance(res, Fitting) else res for res in row])
+    return rows
+
+
+def convert_legacy(file_path, file_path_out=None, nchain=None):
+    """ Converts a legacy pickle - a Fitting.save file or the list of spaxel fits (spaxel_fit_raw) - to FitResults.
+    By default every chain sample is kept (nchain=None) in float64, so no information used downstream is lost.
+
+    Parameters
+    ----------
+
+    file_path : str
+        legacy pickle
+
+    file_path_out : str - optional
+        where to save the converted results (not saved if None)
+
+    nchain : int - optional
+        number of chain samples to keep, see FitResult
+
+    Returns
+    -------
+    FitResult or list of spaxel rows with FitResults
+    """
+    from .fits_r import Fitting
+    with open(file_path, "rb") as fp:
+        results = pickle.load(fp)
+
+    if isinstance(results, dict):
+        Fits = Fitting()
+        Fits.__dict__ = results
+        results = Fits
+    converted = compact_results(results, nchain=nchain, dtype=np.float64)
+
+    if file_path_out is not None:
+        with open(file_path_out, "wb") as fp:
+            pickle.dump(converted, fp)
+    return converted
+
+
+def load_spaxel_results(file_path, unwrapped_path=None):
+    """ Loads the spaxel fits (spaxel_fit_raw) and turns the FitResults back into Fitting instances with the
+    spectra of the unwrapped cube (unwrapped_path, see unwrapped.open_unwrapped), so legacy and compact result files
+    can be used the same way.
+    """
+    with open(file_path, "rb") as fp:
+        results = pickle.load(fp)
+
+    if not any(isinstance(res, FitResult) for row in results for res in row[2:]):
+        return results
+
+    from .unwrapped import open_unwrapped
+    spectra = open_unwrapped(unwrapped_path).spectra()
+
+    rows = []
+    for row in results:
+        i, j = row[:2]
+        fits = []
+        for res in row[2:]:
+            if isinstance(res, FitResult):
+                flux, error, wave = spectra[(i,j)]
+                res = res.to_fitting(wave, flux, error)
+            fits.append(res)
+        rows.append([i, j]+fits)
+    return rows
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar, memory-mapped unwrapped cube.
+
+Cube.unwrap_cube saves the spectra to fit spaxel by spaxel as a directory (<ID>_<band>_Unwrapped_cube<add>/) with
+
+    flux.npy   (Nspax, Nwave) float32 - spatially binned flux density
+    error.npy  (Nspax, Nwave) float32 - its error
+    mask.npy   (Nspax, ceil(Nwave/8)) uint8 - bit-packed mask of the flux (np.packbits)
+    index.npy  (Nspax, 2) int32 - (i, j) spaxel of each row
+    wave.npy   (Nwave) float64 - observed wavelength grid, stored once
+    meta.json  redshift and shape
+
+The arrays are opened with np.load(mmap_mode='r'), so a worker process only reads the rows it fits from
+the page cache instead of unpickling the whole cube. The old pickled lists of [i, j, masked flux, error, wave, z]
+(_Unwrapped_cube<add>.txt) are converted by convert_unwrapped - open_unwrapped does it on the fly.
+"""
+import json
+import os
+import pickle
+import numpy as np
+
+format_version = 1
+columns = ('flux', 'error', 'mask', 'index', 'wave')
+
+opened_cubes = {} # UnwrappedCube opened by open_unwrapped in this process, by path
+
+
+class UnwrappedCube:
+    """ Memory-mapped unwrapped cube - use open_unwrapped to open it and UnwrappedCube.create to write one.
+    Rows are returned as the legacy [i, j, masked flux, error, wave, z] lists that Spaxel fit_spaxel expect.
+
+    Parameters
+    ----------
+
+    path : str
+        directory of the unwrapped cube
+
+    mode : str - optional
+        np.load mmap_mode - 'r' (default) to read, 'r+' to fill the rows of a new cube
+
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+        if self.meta.get('version', 0) > format_version:
+            raise Exception('Unwrapped cube '+path+' was written by a newer version of QubeSpec')
+        self.z = self.meta['z'] # redshift of the cube
+        for name in columns:
+            setattr(self, name, np.load(os.path.join(path, name+'.npy'), mmap_mode=mode))
+        self.nwave = len(self.wave)
+
+    @classmethod
+    def create(cls, path, nspax, wave, z):
+        """ Creates an empty unwrapped cube with nspax rows on the wave grid and returns it open for writing
+        (fill it with set_row)."""
+        nspax = int(nspax)
+        if nspax==0:
+            raise Exception('No spaxels to store in the unwrapped cube')
+        wave = np.asarray(wave, dtype=float)
+        nwave = len(wave)
+        os.makedirs(path, exist_ok=True)
+        shapes = {'flux': ((nspax, nwave), np.float32), 'error': ((nspax, nwave), np.float32),
+                  'mask': ((nspax, (nwave+7)//8), np.uint8), 'index': ((nspax, 2), np.int32)}
+        for name, (shape, dtype) in shapes.items():
+            np.lib.format.open_memmap(os.path.join(path, name+'.npy'), mode='w+', dtype=dtype, shape=shape).flush()
+        np.save(os.path.join(path, 'wave.npy'), wave)
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump({'version': format_version, 'z': float(z), 'nspax': nspax, 'nwave': nwave}, fp)
+        opened_cubes.pop(unwrapped_path(path), None)
+        return cls(path, mode='r+')
+
+    def set_row(self, n, i, j, flux, error):
+        """ Stores the spectrum of spaxel (i, j) - flux as a masked array - in row n."""
+        self.set_rows(n, [[i, j]], flux[None,:], np.asarray(error)[None,:])
+
+    def set_rows(self, n, index, flux, error):
+        """ Stores the (N, Nwave) spectra of the spaxels index (N,2) - flux as a masked array - in rows n to n+N."""
+        rows = slice(n, n+len(index))
+        self.index[rows] = index
+        self.flux[rows] = np.ma.getdata(flux)
+        self.error[rows] = np.ma.getdata(error)
+        self.mask[rows] = np.packbits(np.ma.getmaskarray(flux), axis=-1)
+
+    def flush(self):
+        for name in columns[:-1]:
+            getattr(self, name).flush()
+
+    def row(self, n):
+        """ [i, j, masked flux, error, wave, z] of row n. The spectrum is copied to float64 arrays as the fits
+        modify it in place."""
+        mask = np.unpackbits(self.mask[n], count=self.nwave).astype(bool)
+        flux = np.ma.masked_array(self.flux[n].astype(float), mask=mask)
+        return [int(self.index[n,0]), int(self.index[n,1]), flux, self.error[n].astype(float), np.array(self.wave), self.z]
+
+    def find(self, spaxels):
+        """ Row numbers of the spaxels [(i,j), ...] - None for the spaxels that are not in the cube."""
+        if getattr(self, 'lookup', None) is None:
+            self.lookup = {tuple(ij): n for n, ij in enumerate(self.index.tolist())} # row of each (i,j)
+        return [self.lookup.get((int(i), int(j))) for i, j in spaxels]
+
+    def spectra(self):
+        """ Dictionary (i, j): (masked flux, error, wave) of all of the spaxels."""
+        return {tuple(row[:2]): tuple(row[2:5]) for row in self}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        return self.row(n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.row(n)
+
+    def __repr__(self):
+        return 'UnwrappedCube(%s, %i spaxels, %i pixels)' %(self.path, len(self), self.nwave)
+
+    def __getstate__(self):
+        # only the path is sent to other processes, they map the files themselves
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+class RowReader:
+    """ Callable sent to the pool workers in place of the rows of the cube: reads row n of the unwrapped cube
+    at path (mapped once per process) and passes it (and any keywords) to func."""
+    def __init__(self, path, func):
+        self.path = path
+        self.func = func
+
+    def __call__(self, n, **kwargs):
+        return self.func(open_unwrapped(self.path).row(n), **kwargs)
+
+
+def unwrapped_path(path):
+    """ Directory of the unwrapped cube for path - with or without the legacy .txt extension."""
+    if path.endswith('.txt'):
+        path = path[:-4]
+    return path.rstrip('/')
+
+def convert_unwrapped(file_path, path=None):
+    """ Converts a legacy pickled unwrapped cube (list of [i, j, masked flux, error, wave, z]) to the
+    memory-mapped format.
+
+    Parameters
+    ----------
+
+    file_path : str
+        pickled unwrapped cube (_Unwrapped_cube<add>.txt)
+
+    path : str - optional
+        directory to save the converted cube to, default file_path without .txt
+
+    Returns
+    -------
+    UnwrappedCube
+    """
+    with open(file_path, "rb") as fp:
+        Unwrapped_cube = pickle.load(fp)
+    if len(Unwrapped_cube)==0:
+        raise Exception('Unwrapped cube '+file_path+' is empty')
+
+    wave = np.asarray(Unwrapped_cube[0][4], dtype=float)
+    z = Unwrapped_cube[0][5]
+    for row in Unwrapped_cube:
+        if (len(row[4])!=len(wave)) or np.any(np.asarray(row[4])!=wave) or (row[5]!=z):
+            raise Exception('Spaxels of '+file_path+' do not share the wavelength grid and redshift')
+
+    if path is None:
+        path = unwrapped_path(file_path)
+    cube = UnwrappedCube.create(path, len(Unwrapped_cube), wave, z)
+    for n, row in enumerate(Unwrapped_cube):
+        cube.set_row(n, *row[:4])
+    cube.flush()
+    return UnwrappedCube(path)
+
+def open_unwrapped(path):
+    """ Opens the unwrapped cube at path (directory, or the legacy _Unwrapped_cube<add>.txt name). A legacy
+    pickle without the converted directory is converted first. Cubes are mapped once per process."""
+    path = unwrapped_path(path)
+    if path not in opened_cubes:
+        if not os.path.isfile(os.path.join(path, 'meta.json')):
+            if not os.path.isfile(path+'.txt'):
+                raise Exception('No unwrapped cube at '+path)
+            print('Converting the pickled unwrapped cube '+path+'.txt')
+            convert_unwrapped(path+'.txt', path)
+        opened_cubes[path] = UnwrappedCube(path)
+    return opened_cubes[path]
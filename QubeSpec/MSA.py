@@ -25,6 +25,7 @@ PATH='/Users/jansen/My Drive/Astro/'
 from . import Utils as sp
 from . import Plotting as emplot
 from . import Fitting as emfit
+from .Models.LSF import LSF
 
 
 
@@ -172,7 +173,7 @@ class R1000:
                                                    'Nar_fwhm':[300,'uniform',100,900],\
                                                    'SIIr_peak':[0,'loguniform',-5,1.7],\
                                                    'SIIb_peak':[0,'loguniform',-5,1.7],\
-                                                   'NII_peak':[0,'loguniform',-5,1.7]}):
+                                                   'NII_peak':[0,'loguniform',-5,1.7]}, lsf=False, integrate=False):
         if self.Hal_band != None:  
             dvstd = 300/3e5*(1+self.z)
             if priors['z'][2] ==0:
@@ -180,7 +181,8 @@ class R1000:
                 priors['z'] = [self.z, 'normal', self.z, dvstd]
             
             
-            self.Hal_fits = emfit.Fitting(self.Hal_obs_wave, self.Hal_flux, self.Hal_error, self.z, N=N, progress=progress, priors=priors)
+            self.Hal_fits = emfit.Fitting(self.Hal_obs_wave, self.Hal_flux, self.Hal_error, self.z, N=N, progress=progress, priors=priors,\
+                                          lsf=LSF('NIRSPEC', self.Hal_band) if lsf else None, integrate=integrate)
             self.Hal_fits.fitting_Halpha(model='gal')
             
             self.Halpha_flux = sp.flux_calc_mcmc(self.Hal_fits, 'Han', norm=1e-15)
@@ -205,13 +207,14 @@ class R1000:
                                                           'OIII_out_peak':[0,'loguniform',-3,1.7],\
                                                           'Hbeta_peak':[0,'loguniform',-4,1.7],\
                                                           'Hbeta_fwhm':[200,'uniform',120,900],\
-                                                          'Hbeta_vel':[10,'normal', 0,10]}):
+                                                          'Hbeta_vel':[10,'normal', 0,10]}, lsf=False, integrate=False):
 
         if self.O3_band != None:  
             dvstd = 300/3e5*(1+self.z)
             if priors['z'][2] ==0:
                 priors['z'] = [self.z, 'normal', self.z, dvstd]
-            self.O3_fits = emfit.Fitting(self.O3_obs_wave, self.O3_flux, self.O3_error, self.z, N=N, progress=progress, priors=priors)
+            self.O3_fits = emfit.Fitting(self.O3_obs_wave, self.O3_flux, self.O3_error, self.z, N=N, progress=progress, priors=priors,\
+                                         lsf=LSF('NIRSPEC', self.O3_band) if lsf else None, integrate=integrate)
             self.O3_fits.fitting_OIII(model='gal')
 
             self.O3_flux = sp.flux_calc_mcmc(self.O3_fits, 'OIIIt', norm=1e-15)
@@ -226,7 +229,7 @@ class R1000:
                                                           'cont':[0.1,'loguniform',-3,1],\
                                                           'cont_grad':[-0.1,'normal',0,0.3], \
                                                           'Nar_fwhm':[300,'uniform',100,900],\
-                                                          'peak':[0.2, 'loguniform', -3,1]}):
+                                                          'peak':[0.2, 'loguniform', -3,1]}, lsf=False, integrate=False):
         self.model = model
         self.labels= labels
         self.priors = priors
@@ -234,7 +237,8 @@ class R1000:
             use = np.where( (self.custom_obs_wave>((self.wave_custom+useb[0])*(1+self.z)/1e4)) & (self.custom_obs_wave< ((self.wave_custom+useb[1])*(1+self.z)/1e4))   )[0]
 
         self.use = use
-        self.Fitting = emfit.Fitting(self.custom_obs_wave[use], self.custom_flux[use], self.custom_error[use],z=self.z, priors=self.priors,N=10000, progress=progress)
+        self.Fitting = emfit.Fitting(self.custom_obs_wave[use], self.custom_flux[use], self.custom_error[use],z=self.z, priors=self.priors,N=10000, progress=progress,\
+                                     lsf=LSF('NIRSPEC', self.band_custom) if lsf else None, integrate=integrate)
         self.Fitting.fitting_general(self.model, labels, emfit.logprior_general)
         
         self.yeval = self.model(self.custom_obs_wave, *self.Fitting.props['popt'])
@@ -316,14 +320,15 @@ class R100:
                                                    'Nar_fwhm':[1000,'uniform',500,3000],\
                                                    'SIIr_peak':[0,'loguniform',-3,1],\
                                                    'SIIb_peak':[0,'loguniform',-3,1],\
-                                                   'NII_peak':[0,'loguniform',-3,1]}):
+                                                   'NII_peak':[0,'loguniform',-3,1]}, lsf=False, integrate=False):
         if self.Hal_band != None:  
             z_std = 200/3e5*(1+self.z)
             zlim = 600/3e5*(1+self.z)
             priors['z'] = [self.z, 'normal_hat', self.z, z_std, self.z-zlim, self.z+zlim]
             
             
-            self.Hal_fits = emfit.Fitting(self.obs_wave, self.flux, self.error, self.z, N=N, progress=progress, priors=priors)
+            self.Hal_fits = emfit.Fitting(self.obs_wave, self.flux, self.error, self.z, N=N, progress=progress, priors=priors,\
+                                          lsf=LSF('NIRSPEC', self.band) if lsf else None, integrate=integrate)
             self.Hal_fits.fitting_Halpha(model='gal')
             
             f,ax = plt.subplots(1)
@@ -349,11 +354,12 @@ class R100:
                                                           'OIII_out_peak':[0,'loguniform',-3,1],\
                                                           'Hbeta_peak':[0,'loguniform',-3,1],\
                                                           'Hbeta_fwhm':[200,'uniform',120,900],\
-                                                          'Hbeta_vel':[10,'normal', 0,10]}):
+                                                          'Hbeta_vel':[10,'normal', 0,10]}, lsf=False, integrate=False):
         
         if self.O3_band != None:  
             priors['z'] = [self.z, 'uniform', self.z-0.01, self.z+0.01]
-            self.O3_fits = emfit.Fitting(self.obs_wave, self.flux, self.error, self.z, N=N, progress=progress, priors=priors)
+            self.O3_fits = emfit.Fitting(self.obs_wave, self.flux, self.error, self.z, N=N, progress=progress, priors=priors,\
+                                          lsf=LSF('NIRSPEC', self.band) if lsf else None, integrate=integrate)
             
             self.O3_fits.fitting_OIII(model='gal')
             
@@ -49,8 +49,8 @@ def Map_creation_OIII(Cube,SNR_cut = 3 , fwhmrange = [100,500], velrange=[-100,1
     # =============================================================================
     #         Importing all the data necessary to post process
     # =============================================================================
-    with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_OIII'+add+'.txt', "rb") as fp:
-        results= pickle.load(fp)
+    results = emfit.load_spaxel_results(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_OIII'+add+'.txt',
+        Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt')
 
     # =============================================================================
     #         Setting up the maps
@@ -257,8 +257,8 @@ def Map_creation_Halpha(Cube, SNR_cut = 3 , fwhmrange = [100,500], velrange=[-10
     # =============================================================================
     #         Importing all the data necessary to post process
     # =============================================================================
-    with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha'+add+'.txt', "rb") as fp:
-        results= pickle.load(fp)
+    results = emfit.load_spaxel_results(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha'+add+'.txt',
+        Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt')
 
     # =============================================================================
     #         Setting up the maps
@@ -494,8 +494,8 @@ def Map_creation_Halpha_OIII(Cube, SNR_cut = 3 , fwhmrange = [100,500], velrange
     # =============================================================================
     #         Importing all the data necessary to post process
     # =============================================================================
-    with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha_OIII'+add+'.txt', "rb") as fp:
-        results= pickle.load(fp)
+    results = emfit.load_spaxel_results(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha_OIII'+add+'.txt',
+        Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt')
 
     # =============================================================================
     #         Setting up the maps
@@ -966,8 +966,8 @@ def Map_creation_general(Cube,info, SNR_cut = 3 , width_upper=300,add='',\
     # =============================================================================
     #         Importing all the data necessary to post process
     # =============================================================================
-    with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "rb") as fp:
-        results= pickle.load(fp)
+    results = emfit.load_spaxel_results(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt',
+        Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt')
 
     # =============================================================================
     #         Setting up the maps
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fused model + chi2 kernels for the built-in emission line models.
+
+Each kernel takes (x, flux, error, theta) with theta in the same order as the
+labels used in Fitting and returns the chi2 of the model. The line centres,
+widths and peaks are computed once per call and the model and chi2 are then
+accumulated in a single pass over the wavelength grid, without building the
+model, sigma2 or residual arrays. With k>0 (see window_k) each Gaussian is only
+evaluated within +-k sigma of its centre (add_lines). With lsf (the instrumental sigma
+on x, see Models.LSF) each Gaussian is broadened at its centre in quadrature (broaden).
+With edges (the pixel edges of x, see pixel_edges) each Gaussian is averaged over the
+pixels instead of sampled at their centres (add_lines_integrated).
+
+The kernels reproduce the corresponding model functions in Halpha_models,
+OIII_models, Halpha_OIII_models and Full_optical exactly - see chi2_kernels
+at the bottom for the mapping that Fitting uses to pick them up.
+
+The models with a FeII template use the kernel of the same model without FeII
+on the spectrum minus the FeII template (FeII_kernel).
+"""
+
+import numpy as np
+import numba
+import math
+
+from . import Halpha_models as H_models
+from . import OIII_models as O_models
+from . import Halpha_OIII_models as HO_models
+from . import Full_optical as FO_models
+from . import FeII_models as Fem
+
+def window_k(tolerance):
+    """ Half width (in sigma) of the window outside of which a Gaussian is below tolerance times its peak,
+    sqrt(-2 ln(tolerance)). 0 - no truncation - for tolerance None or 0.
+    """
+    if not tolerance:
+        return 0.
+    if not 0 < tolerance < 1:
+        raise Exception('tolerance has to be between 0 and 1')
+    return np.sqrt(-2*np.log(tolerance))
+
+@numba.njit(cache=True)
+def add_lines(x, peaks, centres, sigs, k, out):
+    """ Adds a set of Gaussians to out (same length as x). With k>0 each Gaussian is only evaluated within
+    +-k sigma of its centre - the window is found by binary search, so x has to be sorted in ascending order.
+    With k=0 every Gaussian is evaluated on the whole grid.
+    """
+    n = len(x)
+    for l in range(len(peaks)):
+        inv2sig2 = 1/(2*sigs[l]*sigs[l])
+        low, high = 0, n
+        if k > 0:
+            half = k*abs(sigs[l])
+            low = np.searchsorted(x, centres[l]-half)
+            high = np.searchsorted(x, centres[l]+half, side='right')
+        for i in range(low, high):
+            dx = x[i]-centres[l]
+            out[i] += peaks[l]*np.exp(-dx*dx*inv2sig2)
+    return out
+
+def pixel_edges(x):
+    """ Edges (len(x)+1) of the pixels of the sorted grid x - half way between the pixel centres and half a
+    pixel beyond the first and last ones.
+    """
+    x = np.asarray(x, dtype=float)
+    if len(x) < 2:
+        raise Exception('pixel edges need at least two pixels')
+    edges = np.empty(len(x)+1)
+    edges[1:-1] = 0.5*(x[1:]+x[:-1])
+    edges[0] = x[0] - 0.5*(x[1]-x[0])
+    edges[-1] = x[-1] + 0.5*(x[-1]-x[-2])
+    return edges
+
+# erf and its derivative tabulated on [0, erf_max] in steps of 1/erf_scale for fast_erf
+erf_scale = 128.
+erf_max = 6.
+erf_grid = np.arange(int(erf_max*erf_scale)+2)/erf_scale
+erf_values = np.array([math.erf(t) for t in erf_grid])
+erf_slopes = 2/np.sqrt(np.pi)*np.exp(-erf_grid**2)/erf_scale
+
+@numba.njit(cache=True)
+def fast_erf(t):
+    """ erf from the tables above with cubic Hermite interpolation (absolute error < 1e-10)."""
+    a = abs(t)
+    if a >= erf_max:
+        r = 1.
+    else:
+        u = a*erf_scale
+        i = int(u)
+        f = u - i
+        f2 = f*f
+        f3 = f2*f
+        r = (2*f3-3*f2+1)*erf_values[i] + (f3-2*f2+f)*erf_slopes[i] + (-2*f3+3*f2)*erf_values[i+1] + (f3-f2)*erf_slopes[i+1]
+    return r if t >= 0 else -r
+
+@numba.njit(cache=True)
+def add_lines_integrated(edges, peaks, centres, sigs, k, out):
+    """ Adds a set of Gaussians averaged over each pixel (edges from pixel_edges) to out - the difference of erf
+    at the pixel edges divided by the pixel width, so the peaks keep their meaning and the model tends to
+    add_lines for well sampled lines. erf is evaluated once per edge (fast_erf). With k>0 only the pixels within
+    +-k sigma of the centre are evaluated.
+    """
+    n = len(out)
+    for l in range(len(peaks)):
+        sig = abs(sigs[l])
+        scale = 1/(np.sqrt(2.)*sig)
+        norm = peaks[l]*sig*np.sqrt(np.pi/2)
+        low, high = 0, n
+        if k > 0:
+            half = k*sig
+            low = max(np.searchsorted(edges, centres[l]-half)-1, 0)
+            high = min(np.searchsorted(edges, centres[l]+half, side='right'), n)
+        if low >= high:
+            continue
+        previous = fast_erf((edges[low]-centres[l])*scale)
+        for i in range(low, high):
+            current = fast_erf((edges[i+1]-centres[l])*scale)
+            out[i] += norm*(current-previous)/(edges[i+1]-edges[i])
+            previous = current
+    return out
+
+@numba.njit(cache=True)
+def broaden(x, lsf, peaks, centres, sigs):
+    """ Adds the instrumental sigma lsf (tabulated on the sorted grid x, see LSF.grid) at each line centre in
+    quadrature to sigs and scales the peaks by sigma/sigma_obs so that the line fluxes are kept.
+    Returns the broadened peaks and sigmas.
+    """
+    n = len(x)
+    out_peaks = np.empty(len(peaks))
+    out_sigs = np.empty(len(sigs))
+    for l in range(len(peaks)):
+        i = np.searchsorted(x, centres[l])
+        if i <= 0:
+            s = lsf[0]
+        elif i >= n:
+            s = lsf[n-1]
+        else:
+            s = lsf[i-1] + (centres[l]-x[i-1])/(x[i]-x[i-1])*(lsf[i]-lsf[i-1])
+        out_sigs[l] = np.sqrt(sigs[l]*sigs[l] + s*s)
+        out_peaks[l] = peaks[l]*abs(sigs[l])/out_sigs[l]
+    return out_peaks, out_sigs
+
+@numba.njit(cache=True)
+def chi2_lines(x, flux, error, cont, cont_wv, cont_grad, peaks, centres, sigs, k=0., lsf=None, edges=None):
+    """ Power-law continuum plus a set of Gaussians, chi2 accumulated pixel by pixel.
+    nan terms are skipped as in np.nansum. With k>0 the Gaussians are truncated at +-k sigma (see add_lines)
+    and accumulated in a model buffer first. lsf is the instrumental sigma on x (see broaden). With edges
+    the Gaussians are integrated over the pixels (see add_lines_integrated) - the continuum is still sampled
+    at the pixel centres.
+    """
+    if lsf is not None:
+        peaks, sigs = broaden(x, lsf, peaks, centres, sigs)
+    nlines = len(peaks)
+    if edges is not None:
+        model = np.empty(len(x))
+        for i in range(len(x)):
+            model[i] = cont*(x[i]/cont_wv)**(-cont_grad)
+        add_lines_integrated(edges, peaks, centres, sigs, k, model)
+
+        chi2 = 0.
+        for i in range(len(x)):
+            term = (flux[i]-model[i])**2/(error[i]*error[i])
+            if not np.isnan(term):
+                chi2 += term
+        return chi2
+
+    if k > 0:
+        model = np.empty(len(x))
+        for i in range(len(x)):
+            model[i] = cont*(x[i]/cont_wv)**(-cont_grad)
+        add_lines(x, peaks, centres, sigs, k, model)
+
+        chi2 = 0.
+        for i in range(len(x)):
+            term = (flux[i]-model[i])**2/(error[i]*error[i])
+            if not np.isnan(term):
+                chi2 += term
+        return chi2
+
+    inv2sig2 = np.empty(nlines)
+    for l in range(nlines):
+        inv2sig2[l] = 1/(2*sigs[l]*sigs[l])
+
+    chi2 = 0.
+    for i in range(len(x)):
+        model = cont*(x[i]/cont_wv)**(-cont_grad)
+        for l in range(nlines):
+            dx = x[i]-centres[l]
+            model += peaks[l]*np.exp(-dx*dx*inv2sig2[l])
+        term = (flux[i]-model)**2/(error[i]*error[i])
+        if not np.isnan(term):
+            chi2 += term
+    return chi2
+
+# =============================================================================
+#  Halpha models
+# =============================================================================
+@numba.njit(cache=True)
+def chi2_Halpha(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk = theta[:8]
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+
+    Nar_vel_hal = Nar_fwhm/3e5*Hal_wv/2.35482
+
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk])
+    centres = np.array([Hal_wv, NII_r, NII_b, SII_r, SII_b])
+    sigs = np.array([Nar_vel_hal, Nar_fwhm/3e5*NII_r/2.35482, Nar_fwhm/3e5*NII_b/2.35482, Nar_vel_hal, Nar_vel_hal])
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Halpha_wBLR(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z,cont, cont_grad, Hal_peak, BLR_peak, NII_peak, Nar_fwhm, BLR_fwhm, zBLR, SII_rpk, SII_bpk = theta[:11]
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+
+    Nar_sig= Nar_fwhm/3e5*Hal_wv/2.35482
+    BLR_sig = BLR_fwhm/3e5*Hal_wv/2.35482
+    BLR_wv = 6564.52*(1+zBLR)/1e4
+
+    peaks = np.array([Hal_peak, BLR_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk])
+    centres = np.array([Hal_wv, BLR_wv, NII_r, NII_b, SII_r, SII_b])
+    sigs = np.array([Nar_sig, BLR_sig, Nar_sig, Nar_sig, Nar_sig, Nar_sig])
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Halpha_outflow(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, Hal_out_peak, NII_out_peak, outflow_fwhm, outflow_vel = theta[:12]
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+
+    Nar_vel_hal = Nar_fwhm/3e5*Hal_wv/2.35482
+
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk, Hal_out_peak, NII_out_peak, NII_out_peak/3])
+    centres = np.array([Hal_wv, NII_r, NII_b, SII_r, SII_b,
+                        Hal_wv + outflow_vel/3e5*Hal_wv, NII_r + outflow_vel/3e5*NII_r, NII_b + outflow_vel/3e5*NII_b])
+    sigs = np.array([Nar_vel_hal, Nar_fwhm/3e5*NII_r/2.35482, Nar_fwhm/3e5*NII_b/2.35482, Nar_vel_hal, Nar_vel_hal,
+                     outflow_fwhm/3e5*Hal_wv/2.35482, outflow_fwhm/3e5*NII_r/2.35482, outflow_fwhm/3e5*NII_b/2.35482])
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Halpha_BLR_outflow(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z,cont, cont_grad, Hal_peak, BLR_peak, NII_peak, Nar_fwhm, BLR_fwhm, zBLR, SII_rpk, SII_bpk,Hal_out_peak, NII_out_peak, outflow_fwhm, outflow_vel = theta[:15]
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+
+    Nar_sig= Nar_fwhm/3e5*Hal_wv/2.35482
+    BLR_sig = BLR_fwhm/3e5*Hal_wv/2.35482
+    BLR_wv = 6564.52*(1+zBLR)/1e4
+
+    peaks = np.array([Hal_peak, BLR_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk, Hal_out_peak, NII_out_peak, NII_out_peak/3])
+    centres = np.array([Hal_wv, BLR_wv, NII_r, NII_b, SII_r, SII_b,
+                        Hal_wv + outflow_vel/3e5*Hal_wv, NII_r + outflow_vel/3e5*NII_r, NII_b + outflow_vel/3e5*NII_b])
+    sigs = np.array([Nar_sig, BLR_sig, Nar_sig, Nar_sig, Nar_sig, Nar_sig,
+                     outflow_fwhm/3e5*Hal_wv/2.35482, outflow_fwhm/3e5*NII_r/2.35482, outflow_fwhm/3e5*NII_b/2.35482])
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+# =============================================================================
+#  [OIII] models
+# =============================================================================
+@numba.njit(cache=True)
+def chi2_OIII_gal(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak = theta[:6]
+    OIIIr = 5008.24*(1+z)/1e4
+    OIIIb = OIIIr- (48.*(1+z)/1e4)
+    Hbeta = 4862.6*(1+z)/1e4
+
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, Hbeta_peak])
+    centres = np.array([OIIIr, OIIIb, Hbeta])
+    sigs = OIII_fwhm/3e5*centres/2.35482
+    return chi2_lines(x, flux, error, cont, OIIIr, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_OIII_outflow(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak = theta[:10]
+    z_out = z+ out_vel/3e5*(1+z)
+    OIIIr = 5008.24*(1+z)/1e4
+    OIIIr_out = 5008.24*(1+z_out)/1e4
+
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, Hbeta_peak, OIIIw_peak, OIIIw_peak/3, Hbeta_out_peak])
+    centres = np.array([OIIIr, OIIIr- (48.*(1+z)/1e4), 4862.6*(1+z)/1e4,
+                        OIIIr_out, OIIIr_out- (48.*(1+z_out)/1e4), 4862.6*(1+z_out)/1e4])
+    fwhms = np.array([OIII_fwhm, OIII_fwhm, OIII_fwhm, OIII_out, OIII_out, OIII_out])
+    sigs = fwhms/3e5*centres/2.35482
+    return chi2_lines(x, flux, error, cont, OIIIr, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_OIII_gal_BLR(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, zBLR, Hbeta_blr_peak, BLR_fwhm = theta[:9]
+    OIIIr = 5008.24*(1+z)/1e4
+
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, Hbeta_peak, Hbeta_blr_peak])
+    centres = np.array([OIIIr, OIIIr- (48.*(1+z)/1e4), 4862.6*(1+z)/1e4, 4862.6*(1+zBLR)/1e4])
+    fwhms = np.array([OIII_fwhm, OIII_fwhm, OIII_fwhm, BLR_fwhm])
+    sigs = fwhms/3e5*centres/2.35482
+    return chi2_lines(x, flux, error, cont, OIIIr, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_OIII_outflow_BLR(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak,\
+        zBLR, Hbeta_blr_peak, BLR_fwhm = theta[:13]
+    z_out = z+ out_vel/3e5*(1+z)
+    OIIIr = 5008.24*(1+z)/1e4
+    OIIIr_out = 5008.24*(1+z_out)/1e4
+
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, Hbeta_peak, OIIIw_peak, OIIIw_peak/3, Hbeta_out_peak, Hbeta_blr_peak])
+    centres = np.array([OIIIr, OIIIr- (48.*(1+z)/1e4), 4862.6*(1+z)/1e4,
+                        OIIIr_out, OIIIr_out- (48.*(1+z_out)/1e4), 4862.6*(1+z_out)/1e4,
+                        4862.6*(1+zBLR)/1e4])
+    fwhms = np.array([OIII_fwhm, OIII_fwhm, OIII_fwhm, OIII_out, OIII_out, OIII_out, BLR_fwhm])
+    sigs = fwhms/3e5*centres/2.35482
+    return chi2_lines(x, flux, error, cont, OIIIr, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+# =============================================================================
+#  Halpha + [OIII] models
+# =============================================================================
+@numba.njit(cache=True)
+def Halpha_OIII_lines(z, Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak):
+    """ Peaks, centres and widths of the lines in HO_models.Halpha_OIII (without the continuum)"""
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+    OIIIr = 5008.24*(1+z)/1e4
+    OIIIb = 4960.3*(1+z)/1e4
+    Hbeta = 4862.6*(1+z)/1e4
+
+    Nar_vel_hal = Nar_fwhm/3e5*Hal_wv/2.35482
+    OIII_sig = Nar_fwhm/3e5*OIIIr/2.35482
+
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk, OIIIn_peak, OIIIn_peak/3, Hbeta_peak])
+    centres = np.array([Hal_wv, NII_r, NII_b, SII_r, SII_b, OIIIr, OIIIb, Hbeta])
+    sigs = np.array([Nar_vel_hal, Nar_fwhm/3e5*NII_r/2.35482, Nar_fwhm/3e5*NII_b/2.35482, Nar_vel_hal, Nar_vel_hal,
+                     OIII_sig, OIII_sig, Nar_fwhm/3e5*Hbeta/2.35482])
+    return peaks, centres, sigs
+
+@numba.njit(cache=True)
+def chi2_Halpha_OIII(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak = theta[:10]
+    peaks, centres, sigs = Halpha_OIII_lines(z, Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak)
+    return chi2_lines(x, flux, error, cont, 6564.52*(1+z)/1e4, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Halpha_OIII_outflow(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, SII_rpk, SII_bpk,\
+        Nar_fwhm, outflow_fwhm, outflow_vel, \
+        Hal_out_peak, NII_out_peak, OIII_out_peak, Hbeta_out_peak = theta[:16]
+    Hal_wv = 6564.52*(1+z)/1e4
+    NII_r = 6585.27*(1+z)/1e4
+    NII_b = 6549.86*(1+z)/1e4
+    OIII_r = 5008.24*(1+z)/1e4
+    OIII_b = 4960.3*(1+z)/1e4
+    Hbeta = 4862.6*(1+z)/1e4
+    SII_r = 6732.67*(1+z)/1e4
+    SII_b = 6718.29*(1+z)/1e4
+
+    nar_centres = np.array([Hal_wv, NII_r, NII_b, SII_r, SII_b, OIII_r, OIII_b, Hbeta])
+    nar_sigs = Nar_fwhm/3e5*nar_centres/2.35482
+    nar_sigs[3] = nar_sigs[0]
+    nar_sigs[4] = nar_sigs[0]
+
+    out_base = np.array([Hal_wv, NII_r, NII_b, OIII_r, OIII_b, Hbeta])
+    out_centres = out_base + outflow_vel/3e5*out_base
+    out_sigs = outflow_fwhm/3e5*out_base/2.35482
+
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, SII_rpk, SII_bpk, OIIIn_peak, OIIIn_peak/3, Hbeta_peak,
+                      Hal_out_peak, NII_out_peak, NII_out_peak/3, OIII_out_peak, OIII_out_peak/3, Hbeta_out_peak])
+    centres = np.concatenate((nar_centres, out_centres))
+    sigs = np.concatenate((nar_sigs, out_sigs))
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Halpha_OIII_BLR(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, SII_rpk, SII_bpk,\
+        Nar_fwhm, outflow_fwhm, outflow_vel, \
+        Hal_out_peak, NII_out_peak, OIII_out_peak,  Hbeta_out_peak,\
+        BLR_fwhm, zBLR, BLR_hal_peak, BLR_hbe_peak = theta[:20]
+
+    nar_peaks, nar_centres, nar_sigs = Halpha_OIII_lines(z, Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak)
+    zout = z+ outflow_vel/3e5*(1+z)
+    out_peaks, out_centres, out_sigs = Halpha_OIII_lines(zout, Hal_out_peak, NII_out_peak, outflow_fwhm, 0., 0., OIII_out_peak, Hbeta_out_peak)
+
+    Hal_wv = 6564.52*(1+z)/1e4
+    Hbe_wv = 4862.6*(1+z)/1e4
+    blr_peaks = np.array([BLR_hal_peak, BLR_hbe_peak])
+    blr_centres = np.array([6564.52*(1+zBLR)/1e4, 4862.6*(1+zBLR)/1e4])
+    blr_sigs = np.array([BLR_fwhm/3e5*Hal_wv/2.35482, BLR_fwhm/3e5*Hbe_wv/2.35482])
+
+    peaks = np.concatenate((nar_peaks, out_peaks, blr_peaks))
+    centres = np.concatenate((nar_centres, out_centres, blr_centres))
+    sigs = np.concatenate((nar_sigs, out_sigs, blr_sigs))
+    return chi2_lines(x, flux, error, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+# =============================================================================
+#  Full optical models
+# =============================================================================
+@numba.njit(cache=True)
+def Full_optical_lines(z, Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak):
+    """ Peaks and centres of the narrow lines in FO_models.Full_optical"""
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, Hgamma_peak, Hdelta_peak, OIIIn_peak, OIIIn_peak/3, Hbeta_peak,
+                      NeIII_peak, 0.322*NeIII_peak, OII_peak, OII_rat*OII_peak, OIIIc_peak, HeI_peak, HeII_peak])
+    rest = np.array([6564.52, 6585.27, 6549.86, 4341.647191, 4102.859855, 5008.24, 4960.3, 4862.6,
+                     3869.68, 3968.68, 3727.1, 3729.875, 4364.436, 3889.73, 4686.0])
+    return peaks, rest*(1+z)/1e4
+
+@numba.njit(cache=True)
+def chi2_Full_optical(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak, Nar_fwhm = theta[:16]
+    peaks, centres = Full_optical_lines(z, Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak)
+    sigs = Nar_fwhm/3e5*centres/2.35482
+    return chi2_lines(x, flux, error, cont, 6564.52*(1+z)/1e4, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+@numba.njit(cache=True)
+def chi2_Full_optical_outflow(x, flux, error, theta, k=0., lsf=None, edges=None):
+    z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, \
+        HeI_peak,HeII_peak, Nar_fwhm, Hal_out_peak, OIII_out_peak, NII_out_peak, Hbeta_out_peak, outflow_vel, outflow_fwhm = theta[:22]
+    nar_peaks, nar_centres = Full_optical_lines(z, Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak)
+
+    out_base = np.array([6564.52, 6585.27, 6549.86, 5008.24, 4960.3, 4862.6])*(1+z)/1e4
+    out_centres = out_base + outflow_vel/3e5*out_base
+    out_peaks = np.array([Hal_out_peak, NII_out_peak, NII_out_peak/3, OIII_out_peak, OIII_out_peak/3, Hbeta_out_peak])
+
+    peaks = np.concatenate((nar_peaks, out_peaks))
+    centres = np.concatenate((nar_centres, out_centres))
+    sigs = np.concatenate((Nar_fwhm/3e5*nar_centres/2.35482, outflow_fwhm/3e5*out_centres/2.35482))
+    return chi2_lines(x, flux, error, cont, 6564.52*(1+z)/1e4, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+
+# Model function -> fused chi2 kernel. Fitting uses the kernel whenever self.fitted_model is in here.
+chi2_kernels = {H_models.Halpha: chi2_Halpha,
+                H_models.Halpha_wBLR: chi2_Halpha_wBLR,
+                H_models.Halpha_outflow: chi2_Halpha_outflow,
+                H_models.Halpha_BLR_outflow: chi2_Halpha_BLR_outflow,
+                O_models.OIII_gal: chi2_OIII_gal,
+                O_models.OIII_outflow: chi2_OIII_outflow,
+                O_models.OIII_gal_BLR: chi2_OIII_gal_BLR,
+                O_models.OIII_outflow_BLR: chi2_OIII_outflow_BLR,
+                HO_models.Halpha_OIII: chi2_Halpha_OIII,
+                HO_models.Halpha_OIII_outflow: chi2_Halpha_OIII_outflow,
+                HO_models.Halpha_OIII_BLR: chi2_Halpha_OIII_BLR,
+                FO_models.Full_optical: chi2_Full_optical,
+                FO_models.Full_optical_outflow: chi2_Full_optical_outflow}
+
+
+class FeII_kernel:
+    """ chi2 kernel of a model with a FeII template - the template (Fem.FeII_functions) is evaluated
+    and subtracted from the flux and the kernel of the model without FeII is used on the rest.
+    FeII_peak and FeII_fwhm are the last two parameters of theta.
+    """
+    def __init__(self, kernel, template):
+        self.kernel = kernel
+        self.FeII_fce = Fem.FeII_functions[template]
+
+    def __call__(self, x, flux, error, theta, k=0., lsf=None, edges=None):
+        FeII = theta[-2]*self.FeII_fce(x, theta[0], theta[-1])
+        return self.kernel(x, flux-FeII, error, theta, k, lsf, edges)
+
+    def chi2_block(self, x, flux, error, thetas, k=0., lsf=None, edges=None):
+        """ chi2 of a block of walkers - the template differs per walker, so the walkers are evaluated one by one."""
+        return np.array([self(x, flux, error, theta, k, lsf, edges) for theta in thetas], dtype=float)
+
+# Model function with a FeII template -> kernel of the model without FeII (see FeII_kernel)
+chi2_kernels_FeII = {O_models.OIII_gal_BLR_Fe: chi2_OIII_gal_BLR,
+                     O_models.OIII_outflow_BLR_Fe: chi2_OIII_outflow_BLR}
+
+
+@numba.njit
+def kernel_block(kernel, x, flux, error, thetas, k=0., lsf=None, edges=None):
+    """ chi2 of the compiled kernel for each walker of the block thetas (nwalkers, ndim). Not cached - numba
+    compiles it once per kernel and process as the kernel is an argument."""
+    chi2 = np.empty(thetas.shape[0])
+    for w in range(thetas.shape[0]):
+        chi2[w] = kernel(x, flux, error, thetas[w], k, lsf, edges)
+    return chi2
+
+def chi2_block(kernel, x, flux, error, thetas, k=0., lsf=None, edges=None):
+    """ chi2 of kernel (a compiled kernel of chi2_kernels, a line table LineTableModel.chi2 or a FeII_kernel) for each
+    walker of the block thetas (nwalkers, ndim) - the vectorized likelihood of Fitting. The walkers are looped over in
+    compiled code (kernel_block, Model_builder.table_chi2_block) except for the FeII templates.
+    """
+    thetas = np.ascontiguousarray(thetas, dtype=float)
+    if isinstance(kernel, numba.core.registry.CPUDispatcher):
+        return kernel_block(kernel, x, flux, error, thetas, k, lsf, edges)
+    owner = getattr(kernel, '__self__', kernel)
+    if hasattr(owner, 'chi2_block'):
+        return owner.chi2_block(x, flux, error, thetas, k, lsf, edges)
+    return np.array([kernel(x, flux, error, theta, k, lsf, edges) for theta in thetas], dtype=float)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+numba compiled equivalents of the OIII_models, Full_optical and QSO_models model and prior functions.
+
+The models take the same arguments as the python ones (x a 1D array, scalar parameters) and compute
+the power-law continuum inline instead of through astropy PowerLaw1D.evaluate. They reproduce the python
+models to floating point precision, including the way the QSO models place their lines. The python
+models are kept as the reference and for broadcasting over walkers (Fitting.model_eval_vectorized);
+compiled_models at the bottom maps each of them to its compiled equivalent, which Fitting uses to evaluate the likelihood of models without a fused chi2 kernel.
+
+All the compiled models take three last arguments k, lsf and edges - with k>0 each Gaussian is only evaluated within
++-k sigma of its centre (Chi2_kernels.add_lines, x sorted), with lsf, the instrumental sigma on x (Models.LSF), each
+Gaussian is broadened in quadrature (Chi2_kernels.broaden) and with edges, the pixel edges of x (Chi2_kernels.pixel_edges),
+each Gaussian is integrated over the pixels (Chi2_kernels.add_lines_integrated). evaluate picks the compiled model and
+sets k, lsf and edges.
+
+The QSO priors take arrays instead of the priors dictionary / list of frozen scipy distributions - use
+prior_bounds and frozen_prior_code to convert them.
+"""
+
+import math
+import numpy as np
+import numba
+
+from . import OIII_models as O_models
+from . import Full_optical as FO_models
+from . import QSO_models
+from . import FeII_models as Fem
+from .Chi2_kernels import Full_optical_lines, add_lines, add_lines_integrated, window_k, broaden, pixel_edges
+
+@numba.njit(cache=True)
+def lines_model(x, cont, cont_wv, cont_grad, peaks, centres, sigs, k=0., lsf=None, edges=None):
+    """ Power-law continuum cont*(x/cont_wv)**(-cont_grad) plus a set of Gaussians, truncated at +-k sigma
+    if k>0 (see Chi2_kernels.add_lines), broadened by the instrumental sigma lsf on x (Chi2_kernels.broaden)
+    and integrated over the pixels with edges (Chi2_kernels.add_lines_integrated)."""
+    if lsf is not None:
+        peaks, sigs = broaden(x, lsf, peaks, centres, sigs)
+    y = np.empty(len(x))
+    for i in range(len(x)):
+        y[i] = cont*(x[i]/cont_wv)**(-cont_grad)
+    if edges is not None:
+        return add_lines_integrated(edges, peaks, centres, sigs, k, y)
+    return add_lines(x, peaks, centres, sigs, k, y)
+
+# =============================================================================
+#  [OIII] models
+# =============================================================================
+@numba.njit(cache=True)
+def OIII_gal(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, k=0., lsf=None, edges=None):
+    OIIIr = 5008.24*(1+z)/1e4
+    centres = np.array([OIIIr, OIIIr- (48.*(1+z)/1e4), 4862.6*(1+z)/1e4])
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, Hbeta_peak])
+    return lines_model(x, cont, OIIIr, cont_grad, peaks, centres, OIII_fwhm/3e5*centres/2.35482, k, lsf, edges)
+
+@numba.njit(cache=True)
+def OIII_outflow(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak, k=0., lsf=None, edges=None):
+    z_out = z+ out_vel/3e5*(1+z)
+    return OIII_gal(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, k, lsf, edges) + \
+           OIII_gal(x, z_out, 0., 0., OIIIw_peak,  OIII_out, Hbeta_out_peak, k, lsf, edges)
+
+@numba.njit(cache=True)
+def OIII_gal_BLR(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, zBLR, Hbeta_blr_peak, BLR_fwhm, k=0., lsf=None, edges=None):
+    Hbeta_blr = 4862.6*(1+zBLR)/1e4
+    return OIII_gal(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, k, lsf, edges) + \
+           lines_model(x, 0., 1., 0., np.array([Hbeta_blr_peak]), np.array([Hbeta_blr]), np.array([BLR_fwhm/3e5*Hbeta_blr/2.35482]), k, lsf, edges)
+
+@numba.njit(cache=True)
+def OIII_outflow_BLR(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak,
+                     zBLR, Hbeta_blr_peak, BLR_fwhm, k=0., lsf=None, edges=None):
+    Hbeta_blr = 4862.6*(1+zBLR)/1e4
+    return OIII_outflow(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak, k, lsf, edges) + \
+           lines_model(x, 0., 1., 0., np.array([Hbeta_blr_peak]), np.array([Hbeta_blr]), np.array([BLR_fwhm/3e5*Hbeta_blr/2.35482]), k, lsf, edges)
+
+def OIII_gal_BLR_Fe(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, zBLR, Hbeta_blr_peak, BLR_fwhm,
+                    FeII_peak, FeII_fwhm, template, k=0., lsf=None, edges=None):
+    y = OIII_gal_BLR(x, z, cont, cont_grad, OIIIn_peak,  OIII_fwhm, Hbeta_peak, zBLR, Hbeta_blr_peak, BLR_fwhm, k, lsf, edges)
+    return y + FeII_peak*Fem.FeII_functions[template](x, z, FeII_fwhm)
+
+def OIII_outflow_BLR_Fe(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak,
+                        zBLR, Hbeta_blr_peak, BLR_fwhm, FeII_peak, FeII_fwhm, template, k=0., lsf=None, edges=None):
+    y = OIII_outflow_BLR(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel, Hbeta_peak, Hbeta_out_peak,
+                         zBLR, Hbeta_blr_peak, BLR_fwhm, k, lsf, edges)
+    return y + FeII_peak*Fem.FeII_functions[template](x, z, FeII_fwhm)
+
+# =============================================================================
+#  Full optical models
+# =============================================================================
+@numba.njit(cache=True)
+def Full_optical(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak, Nar_fwhm, k=0., lsf=None, edges=None):
+    peaks, centres = Full_optical_lines(z, Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak)
+    return lines_model(x, cont, 6564.52*(1+z)/1e4, cont_grad, peaks, centres, Nar_fwhm/3e5*centres/2.35482, k, lsf, edges)
+
+@numba.njit(cache=True)
+def Full_optical_outflow(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak,
+                         Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak,
+                         HeI_peak,HeII_peak, Nar_fwhm,
+                         Hal_out_peak, OIII_out_peak, NII_out_peak, Hbeta_out_peak,
+                         outflow_vel, outflow_fwhm, k=0., lsf=None, edges=None):
+    nar_peaks, nar_centres = Full_optical_lines(z, Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, Hgamma_peak, Hdelta_peak, NeIII_peak, OII_peak, OII_rat,OIIIc_peak, HeI_peak,HeII_peak)
+
+    out_base = np.array([6564.52, 6585.27, 6549.86, 5008.24, 4960.3, 4862.6])*(1+z)/1e4
+    out_centres = out_base + outflow_vel/3e5*out_base
+    out_peaks = np.array([Hal_out_peak, NII_out_peak, NII_out_peak/3, OIII_out_peak, OIII_out_peak/3, Hbeta_out_peak])
+
+    peaks = np.concatenate((nar_peaks, out_peaks))
+    centres = np.concatenate((nar_centres, out_centres))
+    sigs = np.concatenate((Nar_fwhm/3e5*nar_centres/2.35482, outflow_fwhm/3e5*out_centres/2.35482))
+    return lines_model(x, cont, 6564.52*(1+z)/1e4, cont_grad, peaks, centres, sigs, k, lsf, edges)
+
+# =============================================================================
+#  QSO models
+# =============================================================================
+@numba.njit(cache=True)
+def BKPLG(x, peak,center,sig, a1,a2, k=0., lsf=None, edges=None):
+    """ Broken power law (amplitude 1, break at center) convolved with a Gaussian of sig pixels and scaled to a
+    maximum of peak - same kernel (sampled at the pixel centres, odd size >= 8 sig, normalised) and zero filled
+    boundaries as astropy convolve with Gaussian1DKernel. k, lsf and edges are only there for the common
+    signature of the compiled models and are not used.
+    """
+    n = len(x)
+    BKP = np.empty(n)
+    for i in range(n):
+        if x[i] < center:
+            BKP[i] = (x[i]/center)**(-a1)
+        else:
+            BKP[i] = (x[i]/center)**(-a2)
+
+    size = int(np.ceil(8*sig))
+    if size%2 == 0:
+        size += 1
+    half = size//2
+    kernel = np.empty(size)
+    for j in range(size):
+        kernel[j] = np.exp(-0.5*((j-half)/sig)**2)
+    kernel /= np.sum(kernel)
+
+    convolved = np.zeros(n)
+    for i in range(n):
+        total = 0.
+        for j in range(max(0, half-i), min(size, n+half-i)):
+            total += kernel[j]*BKP[i+j-half]
+        convolved[i] = total
+    return convolved/np.max(convolved)*peak
+
+@numba.njit(cache=True)
+def OIII_QSO_lines(z, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel):
+    """ Narrow and outflow [OIII] doublet of the QSO models."""
+    OIIIr = 5008.24*(1+z)/1e4
+    OIIIb = 4960.3*(1+z)/1e4
+    Nar_sig = OIII_fwhm/3e5*OIIIr/2.35482
+    Out_sig = OIII_out/3e5*OIIIr/2.35482
+    out_vel_wv = out_vel/3e5*OIIIr
+
+    peaks = np.array([OIIIn_peak, OIIIn_peak/3, OIIIw_peak, OIIIw_peak/3])
+    centres = np.array([OIIIr, OIIIb, OIIIr+out_vel_wv, OIIIb+out_vel_wv])
+    sigs = np.array([Nar_sig, Nar_sig, Out_sig, Out_sig])
+    return peaks, centres, sigs
+
+@numba.njit(cache=True)
+def OIII_QSO(x, z, cont,cont_grad,
+             OIIIn_peak, OIIIw_peak, OIII_fwhm,
+             OIII_out, out_vel,
+             Hb_BLR1_peak, Hb_BLR2_peak, Hb_BLR_fwhm1, Hb_BLR_fwhm2, Hb_BLR_vel,
+             Hb_nar_peak, Hb_out_peak, k=0., lsf=None, edges=None):
+    Hbeta = 4862.6*(1+z)/1e4
+    oiii_peaks, oiii_centres, oiii_sigs = OIII_QSO_lines(z, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel)
+
+    Hbeta_BLR_wv = Hbeta+Hb_BLR_vel/3e5*Hbeta
+    hb_peaks = np.array([Hb_BLR1_peak, Hb_BLR2_peak, Hb_nar_peak, Hb_out_peak])
+    hb_centres = np.array([Hbeta_BLR_wv, Hbeta_BLR_wv, Hbeta, Hbeta+out_vel/3e5*Hbeta])
+    hb_sigs = np.array([Hb_BLR_fwhm1, Hb_BLR_fwhm2, OIII_fwhm, OIII_out])/3e5*Hbeta/2.35482
+
+    return lines_model(x, cont, 5008.24*(1+z)/1e4, cont_grad, np.concatenate((oiii_peaks, hb_peaks)),
+                       np.concatenate((oiii_centres, hb_centres)), np.concatenate((oiii_sigs, hb_sigs)), k, lsf, edges)
+
+@numba.njit(cache=True)
+def OIII_QSO_BKPL(x, z, cont,cont_grad,
+             OIIIn_peak, OIIIw_peak, OIII_fwhm,
+             OIII_out, out_vel,
+             Hb_BLR_peak, zBLR, Hb_BLR_alp1, Hb_BLR_alp2, Hb_BLR_sig,
+             Hb_nar_peak, Hb_out_peak, k=0., lsf=None, edges=None):
+    Hbeta = 4862.6*(1+z)/1e4
+    oiii_peaks, oiii_centres, oiii_sigs = OIII_QSO_lines(z, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel)
+
+    # as in QSO_models the narrow Hbeta widths use z, the centres zBLR and the BLR is at twice the Hbeta(zBLR) wavelength
+    Hbeta_BLR = 4862.6*(1+zBLR)/1e4
+    hb_peaks = np.array([Hb_nar_peak, Hb_out_peak])
+    hb_centres = np.array([Hbeta_BLR, Hbeta_BLR+out_vel/3e5*Hbeta_BLR])
+    hb_sigs = np.array([OIII_fwhm, OIII_out])/3e5*Hbeta/2.35482
+
+    y = lines_model(x, cont, 5008.24*(1+z)/1e4, cont_grad, np.concatenate((oiii_peaks, hb_peaks)),
+                    np.concatenate((oiii_centres, hb_centres)), np.concatenate((oiii_sigs, hb_sigs)), k, lsf, edges)
+    return y + BKPLG(x, Hb_BLR_peak, Hbeta_BLR+Hbeta_BLR, Hb_BLR_sig, Hb_BLR_alp1, Hb_BLR_alp2)
+
+def OIII_Fe_QSO(x, z, cont,cont_grad,
+             OIIIn_peak, OIIIw_peak, OIII_fwhm,
+             OIII_out, out_vel,
+             Hb_BLR1_peak, Hb_BLR2_peak, Hb_BLR_fwhm1, Hb_BLR_fwhm2, Hb_BLR_vel,
+             Hb_nar_peak, Hb_out_peak, FeII_peak, FeII_fwhm, template, k=0., lsf=None, edges=None):
+    y = OIII_QSO(x, z, cont,cont_grad, OIIIn_peak, OIIIw_peak, OIII_fwhm, OIII_out, out_vel,
+                 Hb_BLR1_peak, Hb_BLR2_peak, Hb_BLR_fwhm1, Hb_BLR_fwhm2, Hb_BLR_vel, Hb_nar_peak, Hb_out_peak, k, lsf, edges)
+    return y + FeII_peak*Fem.FeII_functions[template](x, z, FeII_fwhm)
+
+@numba.njit(cache=True)
+def Hal_QSO_BKPL(x, z, cont,cont_grad, Hal_peak, NII_peak, Nar_fwhm, Hal_out_peak, NII_out_peak, outflow_fwhm, outflow_vel,Ha_BLR_peak, zBLR, Ha_BLR_alp1, Ha_BLR_alp2, Ha_BLR_sig, k=0., lsf=None, edges=None):
+    Hal_wv = 6564.52*(1+z)/1e4
+    nar_centres = np.array([6564.52, 6585.27, 6549.86])*(1+z)/1e4
+    # the outflow of all three lines is shifted by outflow_vel/3e5*Hal_wv as in QSO_models
+    out_centres = nar_centres + outflow_vel/3e5*Hal_wv
+
+    peaks = np.array([Hal_peak, NII_peak, NII_peak/3, Hal_out_peak, NII_out_peak, NII_out_peak/3])
+    centres = np.concatenate((nar_centres, out_centres))
+    sigs = np.concatenate((Nar_fwhm/3e5*nar_centres/2.35482, outflow_fwhm/3e5*nar_centres/2.35482))
+
+    y = lines_model(x, cont, Hal_wv, cont_grad, peaks, centres, sigs, k, lsf, edges)
+    return y + BKPLG(x, Ha_BLR_peak, Hal_wv+6564.52*(1+zBLR)/1e4, Ha_BLR_sig, Ha_BLR_alp1, Ha_BLR_alp2)
+
+@numba.njit(cache=True)
+def Halpha_OIII_QSO_BKPL(x, z, cont,cont_grad, Hal_peak, NII_peak, OIII_peak,Hbeta_peak, Nar_fwhm,
+                      Hal_out_peak, NII_out_peak,OIII_out_peak, Hbeta_out_peak,
+                      outflow_fwhm, outflow_vel,
+                      Hal_BLR_peak, Hbeta_BLR_peak,  zBLR, BLR_alp1, BLR_alp2, BLR_sig, k=0., lsf=None, edges=None):
+
+    Hal_part = Hal_QSO_BKPL(x, z, 0., 0., Hal_peak, NII_peak, Nar_fwhm, Hal_out_peak, NII_out_peak, outflow_fwhm, outflow_vel, Hal_BLR_peak, zBLR, BLR_alp1, BLR_alp2, BLR_sig, k, lsf, edges)
+
+    OIII_part = OIII_QSO_BKPL(x, z, cont,cont_grad,
+                 OIII_peak, OIII_out_peak, Nar_fwhm,
+                 outflow_fwhm, outflow_vel,
+                 Hbeta_BLR_peak, zBLR, BLR_alp1, BLR_alp2, BLR_sig,
+                 Hbeta_peak, Hbeta_out_peak, k, lsf, edges)
+
+    return Hal_part + OIII_part
+
+# =============================================================================
+#  QSO priors
+# =============================================================================
+# parameters checked by the box priors of QSO_models, in the order of theta, and whether the bound is on log10
+prior_names = {'OIII_QSO': ['z', 'cont', 'cont_grad', 'OIIIn_peak', 'OIIIw_peak', 'OIII_fwhm', 'OIII_out', 'out_vel',
+                            'Hb_BLR1_peak', 'Hb_BLR2_peak', 'Hb_BLR1_fwhm', 'Hb_BLR2_fwhm', 'Hb_BLR_vel', 'Hb_nar_peak', 'Hb_out_peak'],
+               'OIII_Fe_QSO': ['z', 'cont', 'cont_grad', 'OIIIn_peak', 'OIIIw_peak', 'OIII_fwhm', 'OIII_out', 'out_vel',
+                            'Hb_BLR1_peak', 'Hb_BLR2_peak', 'Hb_BLR1_fwhm', 'Hb_BLR2_fwhm', 'Hb_BLR_vel', 'Hb_nar_peak', 'Hb_out_peak',
+                            'Fe_peak', 'Fe_fwhm']}
+log_names = ['cont', 'OIIIn_peak', 'OIIIw_peak', 'Hb_BLR1_peak', 'Hb_BLR2_peak', 'Hb_nar_peak', 'Hb_out_peak', 'Fe_peak']
+
+def prior_bounds(priors, model='OIII_QSO'):
+    """ Converts the priors dictionary used by QSO_models.log_prior_OIII_QSO (model='OIII_QSO') or
+    log_prior_OIII_Fe_QSO ('OIII_Fe_QSO') to the (ndim, 3) array [low, high, log10] of the compiled priors.
+    """
+    names = prior_names[model]
+    return np.array([[priors[name][1], priors[name][2], name in log_names] for name in names], dtype=float)
+
+@numba.njit(cache=True)
+def box_prior(theta, bounds):
+    """ 0 if low < theta (or log10(theta)) < high for all the parameters, -inf otherwise."""
+    for i in range(len(bounds)):
+        t = theta[i]
+        if bounds[i,2]:
+            t = np.log10(t)
+        if not (bounds[i,0] < t < bounds[i,1]):
+            return -np.inf
+    return 0.0
+
+@numba.njit(cache=True)
+def log_prior_OIII_QSO(theta, bounds):
+    if theta[14]>theta[13]:
+        return -np.inf
+    return box_prior(theta, bounds)
+
+@numba.njit(cache=True)
+def log_prior_OIII_Fe_QSO(theta, bounds):
+    if theta[14]>theta[13]:
+        return -np.inf
+    return box_prior(theta, bounds)
+
+def frozen_prior_code(priors):
+    """ Converts a list of frozen scipy distributions (norm, uniform, truncnorm) as used by
+    QSO_models.log_prior_OIII_QSO_BKPL to a prior code array for log_prior_scipy.
+    """
+    pr_code = np.zeros((len(priors), 5))
+    for i, f in enumerate(priors):
+        args = f.dist._parse_args(*f.args, **f.kwds)
+        shapes, loc, scale = args[0], args[1], args[2]
+        if f.dist.name == 'norm':
+            pr_code[i,:3] = 0, loc, scale
+        elif f.dist.name == 'uniform':
+            pr_code[i,:3] = 1, loc, loc+scale
+        elif f.dist.name == 'truncnorm':
+            a, b = shapes
+            pr_code[i] = 4, loc, scale, loc+a*scale, loc+b*scale
+        else:
+            raise Exception('Frozen distribution not supported by the compiled prior: '+f.dist.name)
+    return pr_code
+
+@numba.njit(cache=True)
+def norm_logcdf_diff(a, b):
+    """ log(Phi(b)-Phi(a)) of the standard normal distribution."""
+    if a > 0:
+        # upper tail - use the complementary error function to keep the precision
+        return np.log(0.5*(math.erfc(a/np.sqrt(2)) - math.erfc(b/np.sqrt(2))))
+    if b < 0:
+        return np.log(0.5*(math.erfc(-b/np.sqrt(2)) - math.erfc(-a/np.sqrt(2))))
+    return np.log(0.5*(math.erf(b/np.sqrt(2)) - math.erf(a/np.sqrt(2))))
+
+@numba.njit(cache=True)
+def log_prior_scipy(theta, priors):
+    """ Compiled equivalent of Fitting.priors.logprior_general_scipy (scipy logpdf of each prior code:
+    0 normal, 1 uniform, 2 lognormal, 3 loguniform, 4 normal_hat, 5 lognormal_hat)."""
+    results = 0.
+    for i in range(len(priors)):
+        p = priors[i]
+        t = theta[i]
+        if (p[0]==2) | (p[0]==3) | (p[0]==5):
+            t = np.log10(t)
+        if (p[0]==1) | (p[0]==3):
+            if p[1]<=t<=p[2]:
+                results += -np.log(p[2]-p[1])
+            else:
+                return -np.inf
+        elif (p[0]==0) | (p[0]==2):
+            results += -np.log(p[2]) - 0.5*np.log(2*np.pi) - 0.5 * ((t-p[1])/p[2])**2
+        elif (p[0]==4) | (p[0]==5):
+            if p[3]<=t<=p[4]:
+                results += -np.log(p[2]) - 0.5*np.log(2*np.pi) - 0.5 * ((t-p[1])/p[2])**2 \
+                           - norm_logcdf_diff((p[3]-p[1])/p[2], (p[4]-p[1])/p[2])
+            else:
+                return -np.inf
+    return results
+
+@numba.njit(cache=True)
+def log_prior_OIII_QSO_BKPL(theta, priors):
+    """ Compiled equivalent of QSO_models.log_prior_OIII_QSO_BKPL - priors from frozen_prior_code."""
+    return log_prior_scipy(theta, priors)
+
+
+# Python model function -> compiled equivalent. Fitting evaluates the compiled model when there is no chi2 kernel.
+compiled_models = {O_models.OIII_gal: OIII_gal,
+                   O_models.OIII_outflow: OIII_outflow,
+                   O_models.OIII_gal_BLR: OIII_gal_BLR,
+                   O_models.OIII_outflow_BLR: OIII_outflow_BLR,
+                   O_models.OIII_gal_BLR_Fe: OIII_gal_BLR_Fe,
+                   O_models.OIII_outflow_BLR_Fe: OIII_outflow_BLR_Fe,
+                   FO_models.Full_optical: Full_optical,
+                   FO_models.Full_optical_outflow: Full_optical_outflow,
+                   QSO_models.BKPLG: BKPLG,
+                   QSO_models.OIII_QSO: OIII_QSO,
+                   QSO_models.OIII_QSO_BKPL: OIII_QSO_BKPL,
+                   QSO_models.OIII_Fe_QSO: OIII_Fe_QSO,
+                   QSO_models.Hal_QSO_BKPL: Hal_QSO_BKPL,
+                   QSO_models.Halpha_OIII_QSO_BKPL: Halpha_OIII_QSO_BKPL}
+
+def evaluate(fitted_model, x, params, template=None, tolerance=None, lsf=None, integrate=False):
+    """ Evaluates fitted_model on x with the parameters params. Models with a compiled equivalent (or a line table,
+    Model_builder) are evaluated with it, with the Gaussians truncated below tolerance times their peak (see Chi2_kernels.window_k), broadened
+    analytically by the instrumental line spread function lsf (Models.LSF.LSF) and, with integrate, averaged
+    over the pixels of x. Other models are evaluated in full with the python function (averaged over 8
+    subpixels with integrate) and convolved with lsf.
+    """
+    extra = (template,) if template else ()
+    model = compiled_models.get(fitted_model)
+    if model is None:
+        from .Model_builder import table_model_of
+        model = table_model_of(fitted_model)
+    if model is None:
+        if integrate and (len(x) > 1):
+            order = np.argsort(x)
+            edges = pixel_edges(np.asarray(x, dtype=float)[order])
+            sub = edges[:-1,None] + (np.arange(8)+0.5)[None,:]/8*np.diff(edges)[:,None]
+            y = np.empty(len(x))
+            y[order] = np.mean(np.reshape(fitted_model(sub.ravel(), *params, *extra), sub.shape), axis=1)
+        else:
+            y = fitted_model(x, *params, *extra)
+        if lsf is not None:
+            y = lsf.convolve(x, y)
+        return y
+
+    x = np.ascontiguousarray(x, dtype=float)
+    k = window_k(tolerance)
+    if ((k > 0) or (lsf is not None) or integrate) and np.any(np.diff(x) < 0):
+        # the windows, the LSF and the pixel edges are found on the sorted grid
+        order = np.argsort(x)
+        y = np.empty(len(x))
+        y[order] = evaluate(fitted_model, x[order], params, template, tolerance, lsf, integrate)
+        return y
+    lsf_grid = lsf.grid(x) if lsf is not None else None
+    edges = pixel_edges(x) if integrate else None
+    return model(x, *params, *extra, k, lsf_grid, edges)
@@ -6,6 +6,10 @@ import emcee
 import scipy.stats as stats
 from multiprocessing import Pool
 from astropy.modeling.powerlaws import PowerLaw1D
+import numba
+import time
+from .. import Utils as sp
+from .Chi2_kernels import add_lines, add_lines_integrated, window_k, broaden, pixel_edges
 
 #Imports needed for testing
 from astropy.io import fits
@@ -48,7 +52,135 @@ class Parameter:
             raise NameError("Prior {} not found".format(self.prior_params[0]))
 
 
+# prior codes of the compiled model
+prior_codes = {'uniform': 0, 'loguniform': 1, 'normal': 2, 'normal_hat': 3}
+
+@numba.njit(cache=True)
+def compiled_log_prior(p, prior_type, prior_par):
+    """ Sum of the log priors of the compiled model (same values as Parameter.log_prior)."""
+    lp = 0.
+    for i in range(len(prior_type)):
+        x = p[i]
+        code = prior_type[i]
+        if code==1:
+            if x<=0:
+                return -np.inf
+            x = np.log10(x)
+        if code<=1:
+            if not (prior_par[i,0]<=x<=prior_par[i,1]):
+                return -np.inf
+            lp += -np.log(prior_par[i,1]-prior_par[i,0])
+        else:
+            if code==3 and not (prior_par[i,2]<=x<=prior_par[i,3]):
+                return -np.inf
+            lp += -0.5*((x-prior_par[i,0])/prior_par[i,1])**2 - prior_par[i,4]
+    return lp
+
+@numba.njit(cache=True)
+def compiled_log_probability(theta, wave, flux, error, static, rest, slots, divisor, cont, prior_type, prior_par, k, lsf, edges):
+    """ Log probability of the compiled model - all the Gaussian components (a doublet is two components)
+    are accumulated into a model buffer (within +-k sigma of their centre if k>0, see Chi2_kernels.add_lines)
+    and the power-law continuum is added in the chi2 pass over the wavelength grid. lsf is the instrumental sigma
+    on wave (None without LSF, see Chi2_kernels.broaden). With edges (the pixel edges of wave) the components are
+    integrated over the pixels (Chi2_kernels.add_lines_integrated).
+
+    The parameters of the components are picked from p = [theta, static] with slots (ncomp, 3) - z, peak and fwhm.
+    cont is [ContNorm slot, ContSlope slot, reference wavelength] (slots -1 without continuum).
+    """
+    p = np.concatenate((theta, static))
+    lp = compiled_log_prior(p, prior_type, prior_par)
+    if not np.isfinite(lp):
+        return -np.inf
+
+    ncomp = len(rest)
+    peaks = np.empty(ncomp)
+    centres = np.empty(ncomp)
+    sigs = np.empty(ncomp)
+    for l in range(ncomp):
+        centres[l] = rest[l]*(1+p[slots[l,0]])
+        peaks[l] = p[slots[l,1]]/divisor[l]
+        sigs[l] = (p[slots[l,2]]/2.355)*centres[l]/(3*10**5)
+    if lsf is not None:
+        peaks, sigs = broaden(wave, lsf, peaks, centres, sigs)
+    if edges is not None:
+        lines = add_lines_integrated(edges, peaks, centres, sigs, k, np.zeros(len(wave)))
+    else:
+        lines = add_lines(wave, peaks, centres, sigs, k, np.zeros(len(wave)))
+
+    chi2 = 0.
+    for i in range(len(wave)):
+        model = lines[i]
+        if cont[0]>=0:
+            model += p[int(cont[0])]*(wave[i]/cont[2])**(-p[int(cont[1])])
+        chi2 += (flux[i]-model)**2/(error[i]*error[i])
+    return lp - 0.5*chi2
+
+@numba.njit(cache=True)
+def compiled_log_probability_batch(thetas, wave, flux, error, static, rest, slots, divisor, cont, prior_type, prior_par, k, lsf, edges):
+    """ compiled_log_probability of a block of walkers (nwalkers, ndim)."""
+    out = np.empty(thetas.shape[0])
+    for w in range(thetas.shape[0]):
+        out[w] = compiled_log_probability(thetas[w], wave, flux, error, static, rest, slots, divisor, cont, prior_type, prior_par, k, lsf, edges)
+    return out
+
+
+# =============================================================================
+# Parallel fits - the spectrum is in shared memory and the workers only get the walker positions
+# =============================================================================
+worker_model = {'model': None, 'shm': None}
+
+def shared_initializer(model, name, npix):
+    """ Initializer of the workers - attaches the (wave, flux, error) block in shared memory to the model."""
+    from multiprocess import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((3, npix), dtype=float, buffer=shm.buf)
+    model.wave, model.flux, model.error = data
+    model.data = (data[0], data[1], data[2])
+    worker_model['model'] = model
+    worker_model['shm'] = shm
+
+def shared_log_probability(thetas):
+    """ Log probability of a batch of walkers in a worker."""
+    model = worker_model['model']
+    if model.compiled is not None:
+        return compiled_log_probability_batch(np.ascontiguousarray(thetas, dtype=float), *model.data, *model.compiled)
+    return np.array([model.log_probability(theta) for theta in thetas])
+
+class BatchedLikelihood:
+    """ Vectorized log probability for emcee - splits the walkers into nbatch batches, one task per batch."""
+    def __init__(self, pool, nbatch):
+        self.pool = pool
+        self.nbatch = nbatch
+        self.ncalls = 0
+
+    def __call__(self, thetas):
+        self.ncalls += len(thetas)
+        batches = np.array_split(thetas, min(self.nbatch, len(thetas)))
+        return np.concatenate(self.pool.map(shared_log_probability, batches))
+
+
 ###########Line models
+def gauss_window(x, k, mu, sig, window):
+    """ Gaussian evaluated only within +-window sigma of mu (0 elsewhere). x has to be sorted in ascending order."""
+    y = np.zeros(np.shape(x))
+    low = np.searchsorted(x, mu-window*abs(sig))
+    high = np.searchsorted(x, mu+window*abs(sig), side='right')
+    y[low:high] = k * np.e**(-((x[low:high]-mu)**2)/(2*sig*sig))
+    return y
+
+def gauss_integrated(edges, k, mu, sig):
+    """ Gaussian averaged over the pixels with the given edges (len(x)+1, see Chi2_kernels.pixel_edges)."""
+    from scipy.special import erf
+    cdf = erf((edges-mu)/(np.sqrt(2)*abs(sig)))
+    return k*abs(sig)*np.sqrt(np.pi/2)*np.diff(cdf)/np.diff(edges)
+
+def lsf_broaden(peak, mu, sig, lsf):
+    """ Peak and sigma of a Gaussian broadened by the instrumental sigma of lsf (Models.LSF.LSF) at mu, keeping its flux."""
+    if lsf is None:
+        return peak, sig
+    sig_obs = np.sqrt(sig**2 + lsf.sigma(mu)**2)
+    return peak*abs(sig)/sig_obs, sig_obs
+
 class LineModel:
     def __init__(self, name, parameters, rest_wav, width_type=""):
         self.name = name
@@ -56,7 +188,11 @@ class LineModel:
         self.parameters = parameters
         self.width_type = width_type
 
-    def gauss(self, x, k, mu, sig):
+    def gauss(self, x, k, mu, sig, window=0, edges=None):
+        if edges is not None:
+            return gauss_integrated(edges, k, mu, sig)
+        if window > 0:
+            return gauss_window(x, k, mu, sig, window)
         expo = -((x-mu)**2)/(2*sig*sig)
         y = k * np.e**expo
         return y
@@ -64,11 +200,12 @@ class LineModel:
     def fwhm_conv(self, fwhm_in, central_wav):
         return (fwhm_in/2.355)*central_wav/(3*10**5)
 
-    def return_value(self, in_wavelenght):
+    def return_value(self, in_wavelenght, window=0, lsf=None, edges=None):
         #print(self.rest_wav)
         cen_wav = self.rest_wav*(1+self.parameters[0])
         sigma = self.fwhm_conv(self.parameters[2], cen_wav)
-        return self.gauss(in_wavelenght, self.parameters[1], cen_wav, sigma)
+        peak, sigma = lsf_broaden(self.parameters[1], cen_wav, sigma, lsf)
+        return self.gauss(in_wavelenght, peak, cen_wav, sigma, window, edges)
 
 class DoubletModel:
     def __init__(self, name, parameters, rest_wav1, rest_wav2, width_type=""):
@@ -78,7 +215,11 @@ class DoubletModel:
         self.parameters = parameters
         self.width_type = width_type
         
-    def gauss(self, x, k, mu, sig):
+    def gauss(self, x, k, mu, sig, window=0, edges=None):
+        if edges is not None:
+            return gauss_integrated(edges, k, mu, sig)
+        if window > 0:
+            return gauss_window(x, k, mu, sig, window)
         expo = -((x-mu)**2)/(2*sig*sig)
         y = k * np.e**expo
         return y
@@ -86,7 +227,7 @@ class DoubletModel:
     def fwhm_conv(self, fwhm_in, central_wav):
         return (fwhm_in/2.355)*central_wav/(3*10**5)
 
-    def return_value(self, in_wavelength):
+    def return_value(self, in_wavelength, window=0, lsf=None, edges=None):
         peak1 = self.parameters[1]
         peak2 = peak1/self.parameters[3]
 
@@ -94,16 +235,26 @@ class DoubletModel:
         sigma1 = self.fwhm_conv(self.parameters[2], cen_wav1)
         cen_wav2 = self.rest_wav2*(1+self.parameters[0])
         sigma2 = self.fwhm_conv(self.parameters[2], cen_wav2)
-        flux = self.gauss(in_wavelength, peak1, cen_wav1, sigma1)+\
-            self.gauss(in_wavelength, peak2, cen_wav2, sigma2)
+        peak1, sigma1 = lsf_broaden(peak1, cen_wav1, sigma1, lsf)
+        peak2, sigma2 = lsf_broaden(peak2, cen_wav2, sigma2, lsf)
+        flux = self.gauss(in_wavelength, peak1, cen_wav1, sigma1, window, edges)+\
+            self.gauss(in_wavelength, peak2, cen_wav2, sigma2, window, edges)
         return flux
 
 ##############Generic 'build your own line' class:
 class Model:
     def __init__(self, model_name, input_parameters):
         self.model_name = model_name #Enter model name
+        self.input_parameters = input_parameters # model definition (part of the chain signature of the backend)
         self.lines = {}
         self.theta = {}
+        self.use_compiled = True # evaluate the log probability with the compiled model (see compile)
+        self.compiled = None
+        self.nbatch = None # number of walker batches sent to the workers at each step when ncpu>1 (default ncpu)
+        self.parallel = None
+        self.tolerance = None # evaluate each Gaussian only where it is above tolerance*peak (see Chi2_kernels.window_k)
+        self.lsf = None # instrumental line spread function (Models.LSF.LSF) added to each line in quadrature
+        self.integrate = False # integrate the lines over the pixels instead of sampling them at the pixel centres
         #input_parameters key format: purpose_narrow/broad_name_type
         line_parameters = {}
         doublet_parameters = {}
@@ -207,8 +358,16 @@ class Model:
     def calculate_values(self, in_wavelength): #Return model values for plotting
         total = 0
         contm = 0
+        window = window_k(self.tolerance)
+        if (window > 0) and np.any(np.diff(in_wavelength) < 0):
+            window = 0 # the windows need a sorted wavelength grid
+        edges = None
+        if self.integrate:
+            if np.any(np.diff(in_wavelength) < 0):
+                raise Exception('integrate needs the wavelength grid sorted in ascending order')
+            edges = pixel_edges(in_wavelength)
         for line in self.lines.values():
-            total += line.return_value(in_wavelength)
+            total += line.return_value(in_wavelength, window, self.lsf, edges)
         if ("ContSlope" and "ContNorm") in self.theta.keys():
             contm = PowerLaw1D.evaluate(in_wavelength, self.theta["ContNorm"].value,
             np.min(in_wavelength), alpha=self.theta["ContSlope"].value)
@@ -244,6 +403,97 @@ class Model:
                 if "fwhm_"+fwhm_type in self.theta.keys():
                     line.parameters[2] = self.theta["fwhm_"+fwhm_type].value
 
+    def compile(self):
+        """ Compiles the model into index arrays for compiled_log_probability. The parameter slots of each line
+        are found by running update_parameters with test values, so the compiled model follows exactly the
+        same rules as update_parameters/calculate_values. Needs self.wave, self.flux and self.error.
+        Sets and returns self.compiled (None if the model cannot be compiled, e.g. unsupported priors).
+        """
+        self.compiled = None
+        names = list(self.theta.keys())
+        ntheta = len(names)
+        values = np.array([par.value for par in self.theta.values()], dtype=float)
+
+        prior_type = np.zeros(ntheta, dtype=np.int64)
+        prior_par = np.zeros((ntheta, 5))
+        for i, par in enumerate(self.theta.values()):
+            prior = par.prior_params
+            if prior[0] not in prior_codes:
+                return None
+            prior_type[i] = prior_codes[prior[0]]
+            prior_par[i,:2] = prior[1], prior[2]
+            # log of the normalisation of the (truncated) normal priors, taken from scipy
+            if prior[0]=='normal':
+                prior_par[i,4] = -stats.norm.logpdf(prior[1], loc=prior[1], scale=prior[2])
+            elif prior[0]=='normal_hat':
+                prior_par[i,2:4] = prior[3], prior[4]
+                x = min(max(prior[1], prior[3]), prior[4])
+                prior_par[i,4] = -0.5*((x-prior[1])/prior[2])**2 - Parameter(x, par.name, prior).log_prior()
+
+        if ("ContNorm" in names) and ("ContSlope" not in names):
+            return None
+
+        # run update_parameters with two sets of test values to find which theta sets each line parameter
+        probes = []
+        for test in [1e6+np.arange(ntheta), 2e6+np.arange(ntheta)]:
+            self.update_parameters(test)
+            probes.append([list(line.parameters) for line in self.lines.values()])
+        self.update_parameters(values)
+
+        static = []
+        def slot(l, j):
+            first, second = probes[0][l][j], probes[1][l][j]
+            if first==second:
+                static.append(float(first))
+                return ntheta+len(static)-1
+            index = int(round(first-1e6))
+            if (0<=index<ntheta) and (first==1e6+index) and (second==2e6+index):
+                return index
+            raise ValueError('Line parameter does not follow a single parameter')
+
+        rest, slots, divisor = [], [], []
+        try:
+            for l, line in enumerate(self.lines.values()):
+                line_slots = [slot(l, 0), slot(l, 1), slot(l, 2)]
+                if isinstance(line, DoubletModel):
+                    ratio = probes[0][l][3]
+                    if ratio != probes[1][l][3]:
+                        return None
+                    rest += [line.rest_wav1, line.rest_wav2]
+                    slots += [line_slots, line_slots]
+                    divisor += [1., ratio]
+                else:
+                    rest.append(line.rest_wav)
+                    slots.append(line_slots)
+                    divisor.append(1.)
+        except ValueError:
+            return None
+
+        cont = np.array([-1., -1., 1.])
+        if "ContNorm" in names:
+            cont = np.array([names.index("ContNorm"), names.index("ContSlope"), np.min(self.wave)], dtype=float)
+
+        self.data = tuple(np.ascontiguousarray(np.asarray(arr, dtype=float)) for arr in [self.wave, self.flux, self.error])
+        k = window_k(self.tolerance)
+        if (k > 0) and np.any(np.diff(self.data[0]) < 0):
+            raise Exception('tolerance needs the wavelength grid sorted in ascending order')
+
+        lsf = None
+        if self.lsf is not None:
+            if np.any(np.diff(self.data[0]) < 0):
+                raise Exception('lsf needs the wavelength grid sorted in ascending order')
+            lsf = self.lsf.grid(self.data[0])
+
+        edges = None
+        if self.integrate:
+            if np.any(np.diff(self.data[0]) < 0):
+                raise Exception('integrate needs the wavelength grid sorted in ascending order')
+            edges = pixel_edges(self.data[0])
+
+        self.compiled = (np.array(static, dtype=float), np.array(rest, dtype=float), np.array(slots, dtype=np.int64).reshape(-1,3),
+                         np.array(divisor, dtype=float), cont, prior_type, prior_par, k, lsf, edges)
+        return self.compiled
+
     #Evaluat
     def log_prior(self):
         logprior = 0
@@ -267,13 +517,25 @@ class Model:
 
     #Function to be called by mcmc
     def log_probability(self, theta):
+        if self.compiled is not None:
+            return compiled_log_probability(np.asarray(theta, dtype=float), *self.data, *self.compiled)
         self.update_parameters(theta)
         lp = self.log_prior()
         if not np.isfinite(lp): return -np.inf
         else:
             return lp+self.log_likelihood()
 
-    def fit_to_data(self, wave, flux, error, N=6000, nwalkers=32, ncpu=1, progress=True):
+    def pool_state(self):
+        """ Model sent to the Fitting.FittingPool workers - with a compiled model only the data and the index
+        arrays read by log_probability, the whole model otherwise."""
+        if self.compiled is None:
+            return self
+        state = Model.__new__(Model)
+        state.data = self.data
+        state.compiled = self.compiled
+        return state
+
+    def fit_to_data(self, wave, flux, error, N=6000, nwalkers=32, ncpu=1, progress=True, pool=None, backend=None):
         self.wave = wave
         self.flux = flux
         self.error = error
@@ -288,20 +550,39 @@ class Model:
         for i in range(nwalkers):
             self.update_parameters(pos_l)
             self.log_prior_test()
+
+        self.compiled = None
+        if self.use_compiled:
+            self.compile()
+
+        # HDF5 file to stream the chains to - a stored run is resumed from its last sample
+        steps = self.N
+        if backend is not None:
+            signature = sp.chain_signature(self.model_name, list(self.theta.keys()),
+                                           [par.prior_params for par in self.theta.values()], self.input_parameters,
+                                           np.asarray(wave), np.asarray(flux), np.asarray(error))
+            backend, iteration = sp.chain_backend(backend, nwalkers, ndim, signature=signature)
+            if iteration>0:
+                pos = backend.get_last_sample()
+                steps = max(self.N - iteration, 0)
         
-        if self.ncpu==1:
+        if pool is not None:
+            # persistent Fitting.FittingPool - the model (pool_state) is sent to the workers once
             sampler = emcee.EnsembleSampler(
-                    nwalkers, ndim, self.log_probability, args=()) 
+                    nwalkers, ndim, pool.likelihood(self, 'log_probability'), args=(), pool=pool, backend=backend)
             
-            sampler.run_mcmc(pos, self.N, progress=self.progress)
+            if steps>0:
+                sampler.run_mcmc(pos, steps, progress=self.progress)
+
+        elif self.ncpu==1:
+            sampler = emcee.EnsembleSampler(
+                    nwalkers, ndim, self.log_probability, args=(), backend=backend) 
+            
+            if steps>0:
+                sampler.run_mcmc(pos, steps, progress=self.progress)
         
         elif self.ncpu>1:
-            from multiprocess import Pool
-            with Pool(self.ncpu) as pool:
-                sampler = emcee.EnsembleSampler(nwalkers, ndim, self.log_probability, 
-            args=(), pool = pool)
-
-                sampler.run_mcmc(pos, self.N, progress=self.progress)
+            sampler = self.run_parallel(pos, steps, backend)
 
         #Extract chains
         self.flat_samples = sampler.get_chain(discard=int(0.25*N), thin=15, flat=True)
@@ -312,5 +593,48 @@ class Model:
             self.chains[self.labels[i]] = self.flat_samples[:,i]
         self.props = self.prop_calc(self.chains) #Calculate properties
         self.update_parameters(self.props['popt']) #Set final parameters to best fit values
-        
-    
\ No newline at end of file
+
+    def run_parallel(self, pos, steps, backend=None):
+        """ Runs the sampler on self.ncpu processes. The spectrum is put once in shared memory, the workers get
+        the model without the data and each step sends only the walker positions in self.nbatch batches.
+        The time per likelihood call is compared to a serial evaluation and stored in self.parallel
+        (with 'faster': True if the parallel run beat serial).
+        """
+        from multiprocess import Pool, shared_memory
+        import copy
+        nwalkers, ndim = np.shape(pos)
+        data = np.array([self.wave, self.flux, self.error], dtype=float)
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        try:
+            np.ndarray(data.shape, dtype=float, buffer=shm.buf)[:] = data
+
+            shared = copy.copy(self)
+            shared.wave = shared.flux = shared.error = shared.data = None
+
+            with Pool(self.ncpu, initializer=shared_initializer, initargs=(shared, shm.name, data.shape[1])) as pool:
+                likelihood = BatchedLikelihood(pool, self.nbatch or self.ncpu)
+                sampler = emcee.EnsembleSampler(nwalkers, ndim, likelihood, args=(), vectorize=True, backend=backend)
+                start = time.time()
+                if steps>0:
+                    sampler.run_mcmc(pos, steps, progress=self.progress)
+                parallel_time = time.time()-start
+        finally:
+            shm.close()
+            shm.unlink()
+
+        # serial reference on the last walker positions
+        last = sampler.get_last_sample().coords if steps>0 else pos
+        self.log_probability(last[0])
+        start = time.time()
+        for theta in last:
+            self.log_probability(theta)
+        serial_call = (time.time()-start)/len(last)
+
+        parallel_call = parallel_time/likelihood.ncalls if likelihood.ncalls else np.nan
+        self.parallel = {'ncpu': self.ncpu, 'nbatch': likelihood.nbatch, 'serial_call': serial_call,
+                         'parallel_call': parallel_call, 'speedup': serial_call/parallel_call,
+                         'faster': bool(parallel_call < serial_call)}
+        print('Parallel fit on %d cpus: %.1f us per likelihood call vs %.1f us serial (x%.2f) - %s' %(
+            self.ncpu, parallel_call*1e6, serial_call*1e6, self.parallel['speedup'],
+            'parallel was faster' if self.parallel['faster'] else 'serial would have been faster, use ncpu=1'))
+        return sampler
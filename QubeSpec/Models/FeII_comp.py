@@ -3,7 +3,25 @@
 import numpy as np
 from astropy.io import fits as pyfits
 from . import FeII_templates as pth
-import pickle
+import hashlib
+import json
+import tempfile
+import shutil
+import contextlib
+import time
+import os
+
+STORE_VERSION = 2
+source_files = {'Veron': 'Veron-cetty_2004.fits', 'Tsuzuki': 'FeII_Tsuzuki_opttemp.txt', 'BG92': 'bg92.con'}
+
+def default_store_path():
+    """ Directory of the template store: Preconvolved_FeII in $QUBESPEC_CACHE if set, otherwise in the user cache
+    directory ($XDG_CACHE_HOME/QubeSpec or ~/.cache/QubeSpec)."""
+    cache = os.environ.get('QUBESPEC_CACHE')
+    if not cache:
+        cache = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'QubeSpec')
+    return os.path.join(cache, 'Preconvolved_FeII')
+
 def find_nearest(array, value):
     """ Find the location of an array closest to a value
 
@@ -13,63 +31,260 @@ def find_nearest(array, value):
     return idx
 
 
-def preconvolve():
+def load_sources():
+    """ Loads the FeII templates - returns {name: (wavelength [A], flux)}"""
     PATH_TO_FeII = pth.__path__[0]+ '/'
-    
+
     Veron_d = pyfits.getdata(PATH_TO_FeII+ 'Veron-cetty_2004.fits')
     Veron_hd = pyfits.getheader(PATH_TO_FeII+'Veron-cetty_2004.fits')
     Veron_wv = np.arange(Veron_hd['CRVAL1'], Veron_hd['CRVAL1']+ Veron_hd['NAXIS1'])
-    
-    
+
     Tsuzuki = np.loadtxt(PATH_TO_FeII+'FeII_Tsuzuki_opttemp.txt')
     Tsuzuki_d = Tsuzuki[:,1]
     Tsuzuki_wv = Tsuzuki[:,0]
-    
-    
-    
+
     BG92 = np.loadtxt(PATH_TO_FeII+'bg92.con')
     BG92_d = BG92[:,1]
     BG92_wv = BG92[:,0]
-    
-    # =============================================================================
-    # Convolution
-    # =============================================================================
-    from astropy.convolution import Gaussian1DKernel
-    from astropy.convolution import convolve
-    from scipy.interpolate import interp1d
-    import tqdm
-    FWHMs = np.arange(2000,8000,5)
-    
+    return {'Veron': (Veron_wv, np.asarray(Veron_d, dtype=float)),
+            'Tsuzuki': (Tsuzuki_wv, Tsuzuki_d),
+            'BG92': (BG92_wv, BG92_d)}
+
+def source_hashes():
+    """ sha256 of the template source files."""
+    PATH_TO_FeII = pth.__path__[0]+ '/'
+    hashes = {}
+    for name, file in source_files.items():
+        with open(PATH_TO_FeII+file, 'rb') as fp:
+            hashes[file] = hashlib.sha256(fp.read()).hexdigest()
+    return hashes
+
+def store_metadata(FWHM_min=2000, FWHM_max=8000, FWHM_step=5):
+    """ Metadata describing a template store built from the current sources with this FWHM grid."""
+    return {'version': STORE_VERSION,
+            'FWHM_min': FWHM_min, 'FWHM_max': FWHM_max, 'FWHM_step': FWHM_step,
+            'sources': source_hashes()}
+
+def read_metadata(path):
+    """ Metadata of the store in path (None if there is no store or it has no metadata)."""
+    try:
+        with open(os.path.join(path, 'metadata.json')) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def gaussian_kernels(sigmas, nfft):
+    """ rfft of the normalised Gaussian kernels (same discretisation and truncation as astropy's
+    Gaussian1DKernel - sampled at the pixel centres out to the odd size >= 8 sigma) for each sigma in pixels,
+    wrapped around 0 on a grid of nfft pixels. Returns (len(sigmas), nfft//2+1).
+    """
+    sizes = np.ceil(8*sigmas).astype(int)
+    sizes[sizes%2==0] += 1
+    half = sizes//2
+    x = np.arange(-half.max(), half.max()+1)
+    kernels = np.exp(-x[None,:]**2/(2*sigmas[:,None]**2))
+    kernels[np.abs(x)[None,:] > half[:,None]] = 0
+    kernels /= kernels.sum(axis=1)[:,None]
+
+    wrapped = np.zeros((len(sigmas), nfft))
+    wrapped[:, x%nfft] = kernels
+    return np.fft.rfft(wrapped, axis=1)
+
+def convolve_chunk(args):
+    """ Convolves one template with a chunk of Gaussian kernels in Fourier space and normalises each
+    convolved template to its maximum between 4900 and 5400 A. Returns (len(sigmas), len(flux)).
+    """
+    wave, flux, sigmas = args
+    from scipy.fft import next_fast_len
+    nfft = next_fast_len(len(flux) + 2*int(np.ceil(4*sigmas.max()))+2)
+    convolved = np.fft.irfft(np.fft.rfft(flux, nfft)[None,:]*gaussian_kernels(sigmas, nfft), nfft, axis=1)[:, :len(flux)]
+    norm = np.max(convolved[:, (wave<5400) &(wave>4900)], axis=1)
+    return convolved/norm[:,None]
+
+def preconvolve(FWHM_min=2000, FWHM_max=8000, FWHM_step=5, ncpu=1, chunk=100, save=True, path=None):
+    """ Convolves the FeII templates with Gaussians of FWHM from FWHM_min to FWHM_max (excluded) in steps of
+    FWHM_step km/s (at 5008 A). All the kernels of a chunk are applied at once with FFTs (zero padded, as the
+    astropy convolve with boundary fill) and the chunks are spread over ncpu processes.
+
+    Parameters
+    ----------
+
+    FWHM_min, FWHM_max, FWHM_step : float - optional
+        FWHM grid in km/s. Default 2000, 8000, 5
+
+    ncpu : int - optional
+        number of processes. Default 1
+
+    chunk : int - optional
+        number of kernels convolved at once (sets the memory used). Default 100
+
+    save : bool - optional
+        write the store read by FeII_models.FeII_store. Default True
+
+    path : str - optional
+        directory of the store. Default default_store_path()
+
+    Returns
+    -------
+    Dictionary with the FWHMs, the wavelength of each template (name_wavelength) and the convolved
+    templates (name_dat, shape (wavelength, FWHM))
+    """
+    start = time.time()
+    FWHMs = np.arange(FWHM_min, FWHM_max, FWHM_step)
+    sigmas = FWHMs/3e5*5008/2.35
+    sources = load_sources()
+
     Dict = {'FWHMs':FWHMs}
-    Dict['Veron_wavelength'] = Veron_wv
-    Dict['Tsuzuki_wavelength'] = Tsuzuki_wv
-    Dict['BG92_wavelength'] = BG92_wv
-    
-    Veron = np.zeros((len(Veron_d), len(FWHMs)))
-    Tsuzuki = np.zeros((len(Tsuzuki_d), len(FWHMs)))
-    BG92 = np.zeros((len(BG92_d), len(FWHMs)))
-    
-    
-    for i in tqdm.tqdm(range(len(FWHMs))):
-        gk = Gaussian1DKernel(stddev=FWHMs[i]/3e5*5008/2.35)
-    
-        convolved = convolve(Veron_d, gk)
-        convolved_veron = convolved/max(convolved[(Veron_wv<5400) &(Veron_wv>4900)])
-        Veron[:,i] = convolved_veron
-    
-        convolved = convolve(Tsuzuki_d, gk)
-        convolved_tsuzuki = convolved/max(convolved[(Tsuzuki_wv<5400) &(Tsuzuki_wv>4900)])
-        Tsuzuki[:,i] = convolved_tsuzuki
-    
-        convolved = convolve(BG92_d, gk)
-        convolved_bg92 = convolved/max(convolved[(BG92_wv<5400) &(BG92_wv>4900)])
-        BG92[:,i] = convolved_bg92
-    
-    
-    Dict['Veron_dat'] = Veron
-    Dict['Tsuzuki_dat'] = Tsuzuki
-    Dict['BG92_dat'] = BG92
-    
-    with open(PATH_TO_FeII+'Preconvolved_FeII.txt', "wb") as fp:
-        pickle.dump(Dict, fp)
+    jobs = []
+    for name, (wave, flux) in sources.items():
+        Dict[name+'_wavelength'] = wave
+        for i in range(0, len(FWHMs), chunk):
+            jobs.append((wave, flux, sigmas[i:i+chunk]))
+
+    if ncpu > 1:
+        from multiprocess import Pool
+        with Pool(ncpu) as pool:
+            results = pool.map(convolve_chunk, jobs)
+    else:
+        results = [convolve_chunk(job) for job in jobs]
+
+    nchunks = len(jobs)//len(sources)
+    for k, name in enumerate(sources):
+        Dict[name+'_dat'] = np.vstack(results[k*nchunks:(k+1)*nchunks]).T
+
+    if save:
+        if path is None:
+            path = default_store_path()
+        save_store(Dict, path, store_metadata(FWHM_min, FWHM_max, FWHM_step))
+    print('FeII templates convolved with %d kernels in %.1f s' %(len(FWHMs), time.time()-start))
+    return Dict
+
+def spline_coefficients(wave, data, out, chunk=100):
+    """ Cubic spline coefficients of each convolved template of data (FWHM, wavelength) resampled on the
+    ln(wavelength) grid of wave (FeII_models.log_grid), as evaluated by FeII_models.spline_eval. The splines of
+    a chunk of FWHMs are fitted at once and written to out (FWHM, 4, nlog-1), e.g. a memory-mapped .npy.
+    """
+    from scipy.interpolate import CubicSpline
+    from .FeII_models import log_grid
+    lnwv0, dlnwv, nlog = log_grid(wave)
+    lnwave_log = lnwv0 + np.arange(nlog)*dlnwv
+    for i in range(0, len(data), chunk):
+        resampled = CubicSpline(wave, data[i:i+chunk], axis=1)(np.exp(lnwave_log))
+        out[i:i+chunk] = np.transpose(CubicSpline(lnwave_log, resampled, axis=1).c, (2,0,1))
+    return out
+
+def save_store(Dict, path, metadata=None):
+    """ Writes the preconvolved templates (dictionary as returned by preconvolve) as the .npy store read by
+    FeII_models.FeII_store, with its metadata (see store_metadata) in metadata.json. The convolved templates
+    are saved as (FWHM, wavelength) together with their spline coefficients (name_coeffs, see
+    spline_coefficients). The store is written to a temporary directory and moved in place, so that
+    processes reading it never see a partial store. An existing store is replaced.
+    """
+    from .FeII_models import log_grid
+    parent = os.path.dirname(os.path.abspath(path))
+    directory = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+    os.chmod(directory, 0o755)
+    for key, value in Dict.items():
+        value = np.asarray(value)
+        if key.endswith('_dat'):
+            value = np.ascontiguousarray(value.T)
+            wave = np.asarray(Dict[key[:-4]+'_wavelength'], dtype=float)
+            coeffs = np.lib.format.open_memmap(os.path.join(directory, key[:-4]+'_coeffs.npy'), mode='w+',
+                                               dtype=float, shape=(len(value), 4, log_grid(wave)[2]-1))
+            spline_coefficients(wave, value, coeffs)
+            coeffs.flush()
+            del coeffs
+        np.save(os.path.join(directory, key+'.npy'), value)
+    if metadata is not None:
+        with open(os.path.join(directory, 'metadata.json'), 'w') as fp:
+            json.dump(metadata, fp, indent=1)
+
+    old = None
+    if os.path.isdir(path):
+        old = tempfile.mkdtemp(prefix='.old_', dir=parent)
+        try:
+            os.rename(path, os.path.join(old, 'store'))
+        except OSError:
+            pass
+    try:
+        os.rename(directory, path)
+    except OSError:
+        # replaced by another process in the meantime
+        shutil.rmtree(directory, ignore_errors=True)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    return path
+
+@contextlib.contextmanager
+def store_lock(path, timeout=600):
+    """ Exclusive lock on the store in path (the file path.lock), held while the store is checked and built so that
+    concurrent processes build it only once. Uses fcntl.flock where available and otherwise an exclusively
+    created lock file, which is considered stale after timeout s. Raises OSError if the lock cannot be created.
+    """
+    lockfile = os.path.abspath(path)+'.lock'
+    os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl is not None:
+        with open(lockfile, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+        return
+
+    while True:
+        try:
+            fd = os.open(lockfile, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time()-os.path.getmtime(lockfile) > timeout:
+                    os.remove(lockfile)
+            except OSError:
+                pass
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        try:
+            os.remove(lockfile)
+        except OSError:
+            pass
+
+def build_store(path=None, FWHM_min=2000, FWHM_max=8000, FWHM_step=5, ncpu=1):
+    """ (Re)builds the .npy template store in path (default default_store_path()) if it is missing or its metadata
+    does not match the current sources and FWHM grid. The store is built under store_lock and written to a
+    temporary directory moved in place (save_store). Returns True if the store was rebuilt. Raises OSError if
+    the store has to be built and path is not writable.
+    """
+    if path is None:
+        path = default_store_path()
+    metadata = store_metadata(FWHM_min, FWHM_max, FWHM_step)
+    if read_metadata(path) == metadata:
+        return False
+    with store_lock(path):
+        # another process may have built it while we waited for the lock
+        if read_metadata(path) == metadata:
+            return False
+        preconvolve(FWHM_min, FWHM_max, FWHM_step, ncpu=ncpu, path=path)
     return True
+
+def memory_store(FWHM_min=2000, FWHM_max=8000, FWHM_step=5, ncpu=1):
+    """ Builds the preconvolved templates and their spline coefficients in memory (preconvolve with save=False),
+    for when the store cannot be written. Returns the FWHMs and {name: (wavelength, coeffs)}.
+    """
+    from .FeII_models import log_grid, template_names
+    Dict = preconvolve(FWHM_min, FWHM_max, FWHM_step, ncpu=ncpu, save=False)
+    templates = {}
+    for name in template_names:
+        wave = np.asarray(Dict[name+'_wavelength'], dtype=float)
+        data = np.ascontiguousarray(Dict[name+'_dat'].T)
+        coeffs = np.empty((len(data), 4, log_grid(wave)[2]-1))
+        templates[name] = (wave, spline_coefficients(wave, data, coeffs))
+    return Dict['FWHMs'], templates
@@ -1,28 +1,15 @@
 # =============================================================================
 # FeII code
 # =============================================================================
-from astropy.convolution import Gaussian1DKernel
-from astropy.convolution import convolve
-from scipy.interpolate import interp1d
-from astropy.io import fits as pyfits
 import numpy as np
-import pickle
+import numba
+import time
+import os
 
 from . import FeII_templates as pth
 PATH_TO_FeII = pth.__path__[0]+ '/'
 
-#Loading the template
-Veron_d = pyfits.getdata(PATH_TO_FeII+ 'Veron-cetty_2004.fits')
-Veron_hd = pyfits.getheader(PATH_TO_FeII+'Veron-cetty_2004.fits')
-Veron_wv = np.arange(Veron_hd['CRVAL1'], Veron_hd['CRVAL1']+ Veron_hd['NAXIS1'])
-
-Tsuzuki = np.loadtxt(PATH_TO_FeII+'FeII_Tsuzuki_opttemp.txt')
-Tsuzuki_d = Tsuzuki[:,1]
-Tsuzuki_wv = Tsuzuki[:,0]
-
-BG92 = np.loadtxt(PATH_TO_FeII+'bg92.con')
-BG92_d = BG92[:,1]
-BG92_wv = BG92[:,0]
+template_names = ['Veron', 'Tsuzuki', 'BG92']
 
 def find_nearest(array, value):
     """ Find the location of an array closest to a value
@@ -32,32 +19,192 @@ def find_nearest(array, value):
     idx = (np.abs(array - value)).argmin()
     return idx
 
-with open(PATH_TO_FeII+'Preconvolved_FeII.txt', "rb") as fp:
-    Templates= pickle.load(fp)
-
-def FeII_Veron(wave,z, FWHM_feii):
-
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['Veron_dat'][:,index]
 
-    fce = interp1d(Veron_wv*(1+z)/1e4, convolved , kind='cubic',fill_value=0, bounds_error=False)
+def log_grid(wave):
+    """ Uniform ln(wavelength) grid of a template tabulated on wave (A) - starts at ln(wave[0]) with the
+    smallest step of ln(wave). Returns (lnwv0, dlnwv, nlog)."""
+    lnwv = np.log(np.asarray(wave, dtype=float))
+    dlnwv = np.min(np.diff(lnwv))
+    return lnwv[0], dlnwv, int(np.floor((lnwv[-1]-lnwv[0])/dlnwv))+1
+
+@numba.njit(cache=True)
+def spline_eval(wave, lnz, lnwv0, dlnwv, coeffs):
+    """ Evaluates the cubic spline coefficients (4, n-1) of a template tabulated on a uniform
+    ln(wavelength [A]) grid starting at lnwv0 with step dlnwv. wave is in microns and the redshift
+    is a shift of lnz = ln(1+z). Outside of the template it returns 0.
+    """
+    n = coeffs.shape[1]
+    y = np.zeros(wave.shape[0])
+    for k in range(wave.shape[0]):
+        u = (np.log(wave[k]*1e4) - lnz - lnwv0)/dlnwv
+        if u<0 or u>n:
+            continue
+        i = min(int(u), n-1)
+        dx = (u-i)*dlnwv
+        y[k] = ((coeffs[0,i]*dx + coeffs[1,i])*dx + coeffs[2,i])*dx + coeffs[3,i]
+    return y
+
+
+class FeII_template:
+    """ Evaluation engine for a preconvolved FeII template.
+
+    The template is resampled on a uniform ln(wavelength) grid (log_grid) so that the redshift becomes a shift and
+    the position of each wavelength on the grid (and of the FWHM on the grid of preconvolved FWHMs) is found by
+    index arithmetic. The cubic spline coefficients of every FWHM column are computed once when the store is
+    built (FeII_comp.spline_coefficients), so an evaluation only indexes them.
+
+    Parameters
+    ----------
+
+    wave : array
+        rest-frame wavelength of the template in A
+
+    coeffs : 3D array
+        cubic spline coefficients of the template convolved with each FWHM on the ln(wavelength) grid - shape
+        (len(FWHMs), 4, nlog-1), usually memory-mapped from the store
+
+    FWHMs : array
+        uniformly spaced FWHMs (km/s) of the columns of coeffs
+
+    interpolate_fwhm : bool - optional
+        linearly interpolate between the two closest FWHM columns instead of taking the nearest one. Default False.
+
+    """
+    def __init__(self, wave, coeffs, FWHMs, interpolate_fwhm=False):
+        self.wave = np.asarray(wave, dtype=float)
+        self.coeffs = coeffs
+        self.FWHMs = np.asarray(FWHMs, dtype=float)
+        self.interpolate_fwhm = interpolate_fwhm
+
+        self.fwhm0 = self.FWHMs[0]
+        self.dfwhm = self.FWHMs[1]-self.FWHMs[0]
+
+        self.lnwv0, self.dlnwv, self.nlog = log_grid(self.wave)
+        if np.shape(coeffs)[1:] != (4, self.nlog-1):
+            raise Exception('FeII template spline coefficients do not match the ln(wavelength) grid of the template')
+
+    def coefficients(self, index):
+        """ Cubic spline coefficients (4, nlog-1) of the FWHM column index on the ln(wavelength) grid."""
+        return self.coeffs[index]
+
+    def index(self, FWHM_feii):
+        """ Index of the closest FWHM column (ties go to the lower FWHM as with find_nearest)."""
+        index = int(np.ceil((FWHM_feii-self.fwhm0)/self.dfwhm - 0.5))
+        return min(max(index, 0), len(self.FWHMs)-1)
+
+    def __call__(self, wave, z, FWHM_feii):
+        wave = np.asarray(wave, dtype=float)
+        shape = wave.shape
+        wave = np.ascontiguousarray(wave.ravel())
+        lnz = np.log(1+z)
+
+        if self.interpolate_fwhm:
+            u = min(max((FWHM_feii-self.fwhm0)/self.dfwhm, 0), len(self.FWHMs)-1)
+            low = min(int(u), len(self.FWHMs)-2)
+            frac = u-low
+            y = (1-frac)*spline_eval(wave, lnz, self.lnwv0, self.dlnwv, self.coefficients(low))
+            if frac>0:
+                y += frac*spline_eval(wave, lnz, self.lnwv0, self.dlnwv, self.coefficients(low+1))
+        else:
+            y = spline_eval(wave, lnz, self.lnwv0, self.dlnwv, self.coefficients(self.index(FWHM_feii)))
+        return y.reshape(shape)
+
+
+class FeII_store:
+    """ Lazily loaded store of the preconvolved FeII templates.
+
+    The templates and their spline coefficients are kept as .npy files in a directory (see FeII_comp.save_store)
+    and memory-mapped read-only, so the pages are shared by all the processes of a pool instead of each worker
+    reading its own copy.
+    Nothing is read until a template is first used. The metadata of the store (version, FWHM grid and hashes
+    of the template sources) is checked on load and the store is rebuilt with FeII_comp.build_store if it
+    is missing or does not match. If the store cannot be written (read-only directory) the templates are
+    built in memory instead (FeII_comp.memory_store) - in every process that uses them.
+
+    Parameters
+    ----------
+
+    path : str - optional
+        directory of the store. Default None - FeII_comp.default_store_path(), i.e. Preconvolved_FeII in
+        $QUBESPEC_CACHE or the user cache directory (~/.cache/QubeSpec)
+
+    FWHM_min, FWHM_max, FWHM_step : float - optional
+        FWHM grid (km/s) of the preconvolved templates. Default 2000, 8000, 5
+
+    ncpu : int - optional
+        number of processes used if the store has to be rebuilt. Default 1
+
+    """
+    def __init__(self, path=None, FWHM_min=2000, FWHM_max=8000, FWHM_step=5, ncpu=1):
+        self.path = path
+        self.FWHM_min = FWHM_min
+        self.FWHM_max = FWHM_max
+        self.FWHM_step = FWHM_step
+        self.ncpu = ncpu
+        self.templates = {}
+        self.load_time = None
+        self.rebuilt = False
+        self.in_memory = False
+
+    @property
+    def loaded(self):
+        return self.load_time is not None
+
+    def load(self):
+        """ Opens the store (rebuilding it if needed) and sets up the FeII_template engines. Returns the load time in s."""
+        from . import FeII_comp
+        start = time.time()
+        if self.path is None:
+            self.path = FeII_comp.default_store_path()
+        try:
+            self.rebuilt = FeII_comp.build_store(self.path, self.FWHM_min, self.FWHM_max, self.FWHM_step, ncpu=self.ncpu)
+        except OSError as err:
+            print('FeII template store %s cannot be written (%s) - building the templates in memory' %(self.path, err))
+            FWHMs, templates = FeII_comp.memory_store(self.FWHM_min, self.FWHM_max, self.FWHM_step, ncpu=self.ncpu)
+            self.templates = {name: FeII_template(wave, coeffs, FWHMs) for name, (wave, coeffs) in templates.items()}
+            self.rebuilt = True
+            self.in_memory = True
+            self.load_time = time.time()-start
+            return self.load_time
+
+        FWHMs = np.load(os.path.join(self.path, 'FWHMs.npy'))
+        self.templates = {}
+        for name in template_names:
+            wave = np.load(os.path.join(self.path, name+'_wavelength.npy'))
+            coeffs = np.load(os.path.join(self.path, name+'_coeffs.npy'), mmap_mode='r')
+            self.templates[name] = FeII_template(wave, coeffs, FWHMs)
+        self.load_time = time.time()-start
+        return self.load_time
+
+    def __getitem__(self, name):
+        if not self.loaded:
+            self.load()
+        return self.templates[name]
+
+    def __repr__(self):
+        if self.loaded:
+            return 'FeII_store(%s, loaded in %.3f s%s)' %(self.path, self.load_time,
+                                                          ' - in memory' if self.in_memory else ' - rebuilt' if self.rebuilt else '')
+        return 'FeII_store(%s, not loaded)' %self.path
+
+    def __getstate__(self):
+        # the memory maps are reopened by each process on first use - templates built in memory are sent along
+        state = self.__dict__.copy()
+        if not self.in_memory:
+            state['templates'] = {}
+            state['load_time'] = None
+        return state
+
+
+Templates = FeII_store()
 
-    return fce(wave)
+def FeII_Veron(wave,z, FWHM_feii):
+    return Templates['Veron'](wave, z, FWHM_feii)
 
 def FeII_Tsuzuki(wave,z, FWHM_feii):
-
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['Tsuzuki_dat'][:,index]
-
-    fce = interp1d(Tsuzuki_wv*(1+z)/1e4, convolved , kind='cubic',fill_value=0, bounds_error=False)
-
-    return fce(wave)
+    return Templates['Tsuzuki'](wave, z, FWHM_feii)
 
 def FeII_BG92(wave,z, FWHM_feii):
+    return Templates['BG92'](wave, z, FWHM_feii)
 
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['BG92_dat'][:,index]
-
-    fce = interp1d(BG92_wv*(1+z)/1e4, convolved , kind='cubic',fill_value=0, bounds_error=False)
-
-    return fce(wave)
\ No newline at end of file
+FeII_functions = {'Veron': FeII_Veron, 'Tsuzuki': FeII_Tsuzuki, 'BG92': FeII_BG92}
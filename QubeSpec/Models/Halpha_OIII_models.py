@@ -90,7 +90,7 @@ def Halpha_OIII(x, z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SI
 
     return contm+Hal_nar+NII_nar_r+NII_nar_b + SII_rg + SII_bg+ OIII_nar + Hbeta_nar 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_OIII(theta, priors):
     z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak = theta
 
@@ -179,7 +179,7 @@ def Halpha_OIII_outflow(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, H
 
     return contm+Nar+ Outflow
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_OIII_outflow(theta, priors):
     z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, SII_rpk, SII_bpk,\
                             Nar_fwhm, outflow_fwhm, outflow_vel, \
@@ -248,7 +248,7 @@ def Halpha_OIII_BLR(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta
     return NLR+Outflow+Hal_blr + Hbe_blr
 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_OIII_BLR(theta, priors):
     z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, SII_rpk, SII_bpk,\
                             Nar_fwhm, outflow_fwhm, outflow_vel, \
@@ -289,7 +289,7 @@ def Halpha_OIII_BLR_simple(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak
                         Nar_fwhm,\
                         BLR_fwhm, zBLR, BLR_hal_peak, BLR_hbe_peak):
 
-    NLR = Halpha_OIII(x, z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak, 0)
+    NLR = Halpha_OIII(x, z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk, OIIIn_peak, Hbeta_peak)
 
     Hal_wv = 6564.52*(1+z)/1e4
     Hbe_wv = 4862.6*(1+z)/1e4
@@ -306,7 +306,7 @@ def Halpha_OIII_BLR_simple(x, z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak
     return NLR+Hal_blr + Hbe_blr
 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_OIII_BLR_simple(theta, priors):
     z, cont,cont_grad,  Hal_peak, NII_peak, OIIIn_peak, Hbeta_peak, SII_rpk, SII_bpk,\
                             Nar_fwhm, \
@@ -109,7 +109,7 @@ def Halpha_BLR_outflow(x,z,cont, cont_grad, Hal_peak, BLR_peak, NII_peak, Nar_fw
 
     return contm + Hal_nar + Hal_blr + NII_rg + NII_bg + SII_rg + SII_bg + outflow
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_BLR(theta, priors):
     z, cont, cont_grad ,Hal_peak, BLR_peak, NII_peak, Nar_fwhm, BLR_fwhm, BLR_offset, SII_rpk, SII_bpk  = theta
 
@@ -157,7 +157,7 @@ def Halpha(x, z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk, SII_bpk
 
     return contm+Hal_nar+NII_nar_r+NII_nar_b + SII_rg + SII_bg
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha(theta, priors):
     z, cont,cont_grad, Hal_peak, NII_peak, Nar_fwhm,  SII_rpk, SII_bpk = theta
 
@@ -217,7 +217,7 @@ def Halpha_outflow(x, z, cont,cont_grad,  Hal_peak, NII_peak, Nar_fwhm, SII_rpk,
     contm = PowerLaw1D.evaluate(x, cont,Hal_wv, alpha=cont_grad)
     return contm+Hal_nar+NII_nar_r+NII_nar_b + SII_rg + SII_bg + outflow
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_Halpha_outflow(theta, priors):
     z, cont,cont_grad, Hal_peak, NII_peak, Nar_fwhm,  SII_rpk, SII_bpk, Hal_out_peak, NII_out_peak, outflow_fwhm, outflow_vel = theta
     if (Hal_peak<0) | (NII_peak<0) | (SII_rpk<0) | (SII_bpk<0) | (Hal_peak<SII_rpk) | (Hal_peak<SII_bpk):
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumental line spread function (LSF).
+
+The models are not convolved with the LSF during the fit. Each Gaussian is broadened analytically at its
+centre, sigma_obs^2 = sigma^2 + sigma_instr^2, and its peak is scaled by sigma/sigma_obs so that the line
+flux is kept (Chi2_kernels.broaden). The fitted peaks and FWHMs are therefore the intrinsic ones.
+sigma_instr is computed once per fit on the observed wavelength grid (LSF.grid) and interpolated at the
+line centres.
+
+The resolution curves below are approximate nominal curves. Pass R (a number, a function of the
+wavelength or a (wavelength, R) table) to use e.g. the dispersion file of the observation instead.
+"""
+
+import numpy as np
+import numba
+
+# (wavelength [um], R) tables of the nominal resolution of each instrument/band - linearly interpolated
+resolution_curves = {
+    # NIRSpec medium/high resolution gratings - close to a constant resolution element across each band
+    ('NIRSPEC', 'g140m'): ([0.70, 1.89], [480, 1300]),
+    ('NIRSPEC', 'g235m'): ([1.66, 3.17], [700, 1340]),
+    ('NIRSPEC', 'g395m'): ([2.87, 5.27], [730, 1340]),
+    ('NIRSPEC', 'g140h'): ([0.70, 1.89], [1300, 3600]),
+    ('NIRSPEC', 'g235h'): ([1.66, 3.17], [1900, 3600]),
+    ('NIRSPEC', 'g395h'): ([2.87, 5.27], [1970, 3600]),
+    ('NIRSPEC', 'prism'): ([0.60, 0.80, 1.00, 1.20, 1.50, 2.00, 3.00, 4.00, 5.00, 5.30],
+                           [80, 45, 33, 30, 35, 50, 100, 180, 300, 330]),
+    ('KMOS', 'iz'): ([0.78, 1.08], [3400, 3400]),
+    ('KMOS', 'yj'): ([1.00, 1.36], [3600, 3600]),
+    ('KMOS', 'h'): ([1.46, 1.85], [4000, 4000]),
+    ('KMOS', 'k'): ([1.92, 2.46], [4200, 4200]),
+    ('KMOS', 'hk'): ([1.46, 2.46], [2000, 2000]),
+    ('Sinfoni', 'j'): ([1.10, 1.40], [2000, 2000]),
+    ('Sinfoni', 'h'): ([1.45, 1.85], [3000, 3000]),
+    ('Sinfoni', 'k'): ([1.95, 2.45], [4000, 4000]),
+    ('Sinfoni', 'hk'): ([1.45, 2.45], [1500, 1500]),
+    ('MIRI', 'mrs'): ([4.9, 7.6, 11.7, 18.0, 28.0], [3700, 3500, 2800, 2000, 1500]),
+}
+
+instrument_names = {'NIRSPEC': 'NIRSPEC', 'NIRSPEC_IFU': 'NIRSPEC', 'NIRSPEC_IFU_fl': 'NIRSPEC', 'NIRSPEC05': 'NIRSPEC',
+                    'KMOS': 'KMOS', 'Sinfoni': 'Sinfoni', 'MIRI': 'MIRI'}
+
+
+class LSF:
+    """ Instrumental line spread function of an instrument/band.
+
+    Parameters
+    ----------
+
+    instrument : str
+        instrument flag as in Cube - 'NIRSPEC_IFU', 'KMOS', 'Sinfoni', 'MIRI' - or 'NIRSPEC' for the MSA
+
+    band : str - optional
+        grating/band - NIRSpec 'g140m', 'g235m', 'g395m', 'g140h', 'g235h', 'g395h' or 'prism' (filter suffixes
+        such as 'g395m_f290lp' or 'prism_clear' are fine); KMOS 'IZ', 'YJ', 'H', 'K', 'HK'; Sinfoni 'J', 'H',
+        'K', 'HK' (or 'Hsin', 'Ksin'). Not needed for MIRI or if R is given.
+
+    R : float, function or (wavelength, R) table - optional
+        resolution to use instead of the tabulated curve
+
+    """
+    def __init__(self, instrument, band=None, R=None):
+        self.instrument = instrument
+        self.band = band
+        self.R = R
+
+        if R is None:
+            name = instrument_names.get(instrument)
+            if name is None:
+                raise Exception('Instrument flag not understood by LSF. Available: '+', '.join(instrument_names))
+            if name == 'MIRI':
+                band = 'mrs'
+            if band is None:
+                raise Exception('LSF of '+instrument+' needs the band/grating')
+            band = band.lower().split('_')[0]
+            if (name == 'Sinfoni') and band.endswith('sin'):
+                band = band[:-3]
+            if (name, band) not in resolution_curves:
+                raise Exception('No resolution curve for '+instrument+' '+str(self.band)+' - give R instead')
+            self.R = resolution_curves[(name, band)]
+
+    def resolution(self, wave):
+        """ Resolution R=lambda/FWHM at wave (um)."""
+        wave = np.asarray(wave, dtype=float)
+        if callable(self.R):
+            return np.asarray(self.R(wave), dtype=float)*np.ones(wave.shape)
+        if np.ndim(self.R) == 0:
+            return np.full(wave.shape, float(self.R))
+        table_wave, table_R = self.R
+        return np.interp(wave, table_wave, table_R)
+
+    def sigma(self, wave):
+        """ Instrumental Gaussian sigma at wave (same units as wave)."""
+        wave = np.asarray(wave, dtype=float)
+        return wave/self.resolution(wave)/2.35482
+
+    def grid(self, wave):
+        """ sigma on the (sorted) wavelength grid of a fit as a contiguous array for the kernels."""
+        return np.ascontiguousarray(self.sigma(wave), dtype=float)
+
+    def convolve(self, wave, y):
+        """ Convolves a model y evaluated on wave with the LSF - for models evaluated outside of the kernels
+        (e.g. Fitting.yeval of models without a compiled equivalent). Not used in the fits."""
+        wave = np.asarray(wave, dtype=float)
+        order = np.argsort(wave)
+        out = np.empty(len(wave))
+        out[order] = lsf_convolve(np.ascontiguousarray(wave[order]), np.ascontiguousarray(np.asarray(y, dtype=float)[order]),
+                                  self.grid(wave[order]))
+        return out
+
+    def __repr__(self):
+        return 'LSF(%s, %s)' %(self.instrument, self.band)
+
+
+@numba.njit(cache=True)
+def lsf_convolve(x, y, sig):
+    """ Spreads each pixel of y (on the sorted grid x) with a normalised Gaussian of width sig at that pixel
+    out to +-5 sigma - a convolution with a variable LSF that keeps the flux."""
+    n = len(x)
+    dx = np.empty(n)
+    for i in range(n):
+        dx[i] = 0.5*(x[min(i+1, n-1)] - x[max(i-1, 0)])
+    out = np.zeros(n)
+    for j in range(n):
+        if y[j] == 0:
+            continue
+        low = np.searchsorted(x, x[j]-5*sig[j])
+        high = np.searchsorted(x, x[j]+5*sig[j], side='right')
+        norm = 0.
+        for i in range(low, high):
+            norm += np.exp(-0.5*((x[i]-x[j])/sig[j])**2)*dx[i]
+        for i in range(low, high):
+            out[i] += y[j]*dx[j]*np.exp(-0.5*((x[i]-x[j])/sig[j])**2)/norm
+    return out
@@ -0,0 +1,797 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Line table driven emission line models.
+
+A model is described by a LineTable - the Gaussian lines (rest wavelength, peak, FWHM, redshift, velocity
+shift and the ties between them), the power-law continuum and the broken power law BLRs of the QSO models -
+instead of a hand written model function. build turns the table into a LineTableModel, which holds the table
+as a few small arrays (slots of theta) read by one generic numba kernel (table_model, table_chi2). The kernel
+is compiled once for all the tables and built models are cached by the signature of their table, so all the
+spaxels of a cube fitted with the same table use the same LineTableModel.
+
+A Line with the parameters z, vel and fwhm is placed at
+
+    centre = wave*(1+z)/1e4 + vel/3e5*vel_wave*(1+z)/1e4
+    sigma = fwhm/3e5*width_wave*(1+width_z)/1e4*(1+vel/3e5)/2.35482
+
+(the last factor only with width_vel) with peak*ratio*ratio_par as its peak. vel_wave, width_wave and width_z
+default to the wavelength and redshift of the line - the other choices reproduce the way the existing models
+place their lines, e.g. the [SII] doublet of the Halpha models with the width of Halpha.
+
+line_tables at the bottom reproduces every named model of Fitting.fitting_Halpha, fitting_OIII,
+fitting_Halpha_OIII and fitting_optical (and the QSO models) - with the labels of those methods, the initial
+positions of the walkers and the python model function the table replaces (reference).
+
+Example - narrow Hbeta and [OIII] with an outflow
+
+    table = LineTable([Line('OIII_r', 'OIII_peak', 'Nar_fwhm'),
+                       Line('OIII_b', 'OIII_peak', 'Nar_fwhm', ratio=1/2.99),
+                       Line('OIII_r', 'OIII_out_peak', 'outflow_fwhm', vel='outflow_vel'),
+                       Line('OIII_b', 'OIII_out_peak', 'outflow_fwhm', vel='outflow_vel', ratio=1/2.99),
+                       Line('Hbeta', 'Hbeta_peak', 'Nar_fwhm')],
+                      continuum=Continuum('OIII_r'))
+    model = build(table)
+    Fits.fitting_general(model)
+"""
+
+import numpy as np
+import numba
+
+from . import Halpha_models as H_models
+from . import OIII_models as O_models
+from . import Halpha_OIII_models as HO_models
+from . import Full_optical as FO_models
+from . import QSO_models
+from . import FeII_models as Fem
+from .Chi2_kernels import chi2_lines, add_lines, add_lines_integrated, broaden
+from .Compiled_models import lines_model, BKPLG
+
+# rest wavelengths (A, vacuum) of the lines used by the models
+rest_waves = {'Halpha': 6564.52,
+              'NII_r': 6585.27,
+              'NII_b': 6549.86,
+              'SII_r': 6732.67,
+              'SII_b': 6718.29,
+              'OIII_r': 5008.24,
+              'OIII_b': 4960.3,
+              'Hbeta': 4862.6,
+              'Hgamma': 4341.647191,
+              'Hdelta': 4102.859855,
+              'NeIII_r': 3869.68,
+              'NeIII_b': 3968.68,
+              'OII_b': 3727.1,
+              'OII_r': 3729.875,
+              'OIII_auroral': 4364.436,
+              'HeI': 3889.73,
+              'HeII': 4686.0}
+
+def rest_wave(wave):
+    """ Rest wavelength in A of a line name in rest_waves or a number."""
+    if isinstance(wave, str):
+        if wave not in rest_waves:
+            raise Exception('Line '+wave+' not in rest_waves - give the rest wavelength in A instead')
+        return rest_waves[wave]
+    return float(wave)
+
+
+class Line:
+    """ One Gaussian line of a LineTable.
+
+    Parameters
+    ----------
+
+    wave : str or float
+        line name in rest_waves or rest wavelength in A
+
+    peak : str
+        label of the peak parameter
+
+    fwhm : str
+        label of the FWHM (km/s) parameter
+
+    z : str - optional
+        label of the redshift of the line. Default 'z'
+
+    ratio : float - optional
+        fixed ratio of the peak to the peak parameter (e.g. 1/3 for [NII]6550). Default 1
+
+    ratio_par : str - optional
+        label of a free ratio multiplying the peak (e.g. OII_rat). Default None
+
+    vel : str - optional
+        label of a velocity shift (km/s). Default None - no shift
+
+    vel_wave : str or float - optional
+        rest wavelength the velocity shift is computed at. Default the wavelength of the line
+
+    width_wave : str or float - optional
+        rest wavelength the FWHM is converted to a sigma at. Default the wavelength of the line
+
+    width_z : str - optional
+        label of the redshift used for the width. Default z
+
+    width_vel : bool - optional
+        the width is taken at the shifted centre (True) or at the unshifted one (False). Default True
+
+    """
+    def __init__(self, wave, peak, fwhm, z='z', ratio=1., ratio_par=None, vel=None, vel_wave=None, width_wave=None,
+                 width_z=None, width_vel=True):
+        self.wave = rest_wave(wave)
+        self.peak = peak
+        self.fwhm = fwhm
+        self.z = z
+        self.ratio = float(ratio)
+        self.ratio_par = ratio_par
+        self.vel = vel
+        self.vel_wave = self.wave if vel_wave is None else rest_wave(vel_wave)
+        self.width_wave = self.wave if width_wave is None else rest_wave(width_wave)
+        self.width_z = z if width_z is None else width_z
+        self.width_vel = bool(width_vel)
+
+    def parameters(self):
+        return [self.z, self.peak, self.ratio_par, self.vel, self.fwhm, self.width_z]
+
+    def signature(self):
+        return ('Line', self.wave, self.peak, self.fwhm, self.z, self.ratio, self.ratio_par, self.vel, self.vel_wave,
+                self.width_wave, self.width_z, self.width_vel)
+
+
+class Continuum:
+    """ Power-law continuum cont*(x/cont_wave)**(-cont_grad) with cont_wave = wave*(1+z)/1e4.
+
+    Parameters
+    ----------
+
+    wave : str or float
+        line name in rest_waves or rest wavelength in A of the pivot
+
+    norm, grad, z : str - optional
+        labels of the normalisation, the slope and the redshift. Default 'cont', 'cont_grad', 'z'
+
+    """
+    def __init__(self, wave, norm='cont', grad='cont_grad', z='z'):
+        self.wave = rest_wave(wave)
+        self.norm = norm
+        self.grad = grad
+        self.z = z
+
+    def parameters(self):
+        return [self.z, self.norm, self.grad]
+
+    def signature(self):
+        return ('Continuum', self.wave, self.norm, self.grad, self.z)
+
+
+class BKPL:
+    """ Broken power law convolved with a Gaussian (Compiled_models.BKPLG) as used for the BLRs of the QSO models.
+
+    Parameters
+    ----------
+
+    peak, sig, alp1, alp2 : str
+        labels of the peak, the Gaussian sigma (pixels) and the two slopes
+
+    centre : list of (wave, z)
+        the break is at the sum of wave*(1+z)/1e4 over these terms (line name or A, label of the redshift) -
+        the QSO models place it at the sum of two line wavelengths
+
+    """
+    def __init__(self, peak, sig, alp1, alp2, centre):
+        self.peak = peak
+        self.sig = sig
+        self.alp1 = alp1
+        self.alp2 = alp2
+        self.centre = [(rest_wave(wave), z) for wave, z in centre]
+
+    def parameters(self):
+        return [self.peak, self.sig, self.alp1, self.alp2] + [z for wave, z in self.centre]
+
+    def signature(self):
+        return ('BKPL', self.peak, self.sig, self.alp1, self.alp2, tuple(self.centre))
+
+
+class LineTable:
+    """ Declarative description of an emission line model - see build.
+
+    Parameters
+    ----------
+
+    lines : list of Line
+
+    continuum : Continuum - optional
+        Default None - no continuum
+
+    bkpl : list of BKPL - optional
+        broken power law BLRs. Default none
+
+    labels : list - optional
+        order of the parameters in theta. Default the order in which they appear in continuum, lines and bkpl
+
+    FeII : bool - optional
+        add a FeII template (FeII_models.FeII_functions) scaled by 'Fe_peak' and broadened to 'Fe_fwhm' - the last
+        two labels - at the redshift of the continuum, which has to be the first label. Default False
+
+    init : dict - optional
+        initial position of the labels - see LineTableModel.initial. Labels that are not in init (and entries of init
+        that are not labels) fall back to the generic recipes of default_init
+
+    reference : function - optional
+        python model function reproduced by the table (used as Fitting.fitted_model for the named models)
+
+    name : str - optional
+        name of the table
+
+    """
+    def __init__(self, lines, continuum=None, bkpl=(), labels=None, FeII=False, init=None, reference=None, name=None):
+        self.lines = list(lines)
+        self.continuum = continuum
+        self.bkpl = list(bkpl)
+        self.FeII = FeII
+        self.reference = reference
+        self.name = name
+
+        used = []
+        for component in ([continuum] if continuum is not None else []) + self.lines + self.bkpl:
+            for par in component.parameters():
+                if (par is not None) and (par not in used):
+                    used.append(par)
+        if FeII:
+            used += ['Fe_peak', 'Fe_fwhm']
+
+        if labels is None:
+            labels = used
+        labels = list(labels)
+        missing = [par for par in used if par not in labels]
+        if missing:
+            raise Exception('Parameters missing from the labels of the line table: '+', '.join(missing))
+        if len(set(labels)) != len(labels):
+            raise Exception('Labels of the line table are not unique')
+        if FeII and ((labels[-2:] != ['Fe_peak', 'Fe_fwhm']) or (continuum is None) or (labels[0] != continuum.z)):
+            raise Exception('FeII tables need the redshift of the continuum first and Fe_peak, Fe_fwhm last in the labels')
+        self.labels = labels
+
+        self.init = {name: default_init(name, self) for name in labels}
+        if init is not None:
+            self.init.update({name: init[name] for name in labels if name in init})
+
+    def redshifts(self):
+        """ Labels used as redshifts."""
+        zs = [self.continuum.z] if self.continuum is not None else []
+        for line in self.lines:
+            zs += [line.z, line.width_z]
+        for component in self.bkpl:
+            zs += [z for wave, z in component.centre]
+        return set(zs)
+
+    def signature(self):
+        """ Hashable description of the table - build caches the models by it."""
+        return (self.name, tuple(self.labels), self.continuum.signature() if self.continuum is not None else None,
+                tuple(line.signature() for line in self.lines), tuple(component.signature() for component in self.bkpl),
+                self.FeII, tuple((name, tuple(np.atleast_1d(self.init[name]).tolist())) for name in self.labels))
+
+
+def default_init(name, table):
+    """ Generic initial position recipe of a label: redshifts at the scale 'z' (walkers in a 0.001 ball), the
+    continuum normalisation at 'cont', peaks at half of 'peak', anything else at the central value of its prior.
+    """
+    if name in table.redshifts():
+        return ('z', 1., 0.001)
+    if (table.continuum is not None) and (name == table.continuum.norm):
+        return ('cont', 1.)
+    if (table.continuum is not None) and (name == table.continuum.grad):
+        return (0.01, 1.)
+    if 'peak' in name:
+        return ('peak', 0.5)
+    return ('prior', 1.)
+
+
+@numba.njit(cache=True)
+def table_lines(theta, lines):
+    """ Peaks, centres and sigmas of the lines of a table (LineTableModel.lines) for the parameters theta."""
+    n = lines.shape[0]
+    peaks = np.empty(n)
+    centres = np.empty(n)
+    sigs = np.empty(n)
+    for l in range(n):
+        z = theta[int(lines[l,1])]
+        peak = theta[int(lines[l,2])]*lines[l,3]
+        if lines[l,4] >= 0:
+            peak *= theta[int(lines[l,4])]
+        centre = lines[l,0]*(1+z)/1e4
+        width = lines[l,8]*(1+theta[int(lines[l,9])])/1e4
+        if lines[l,5] >= 0:
+            vel = theta[int(lines[l,5])]/3e5
+            centre += vel*(lines[l,6]*(1+z)/1e4)
+            if lines[l,10]:
+                width *= 1+vel
+        peaks[l] = peak
+        centres[l] = centre
+        sigs[l] = theta[int(lines[l,7])]/3e5*width/2.35482
+    return peaks, centres, sigs
+
+@numba.njit(cache=True)
+def table_continuum(theta, cont):
+    """ Normalisation, pivot wavelength and slope of the continuum of a table (LineTableModel.cont)."""
+    if cont[0] < 0:
+        return 0., 1., 0.
+    return theta[int(cont[0])], cont[3]*(1+theta[int(cont[2])])/1e4, theta[int(cont[1])]
+
+@numba.njit(cache=True)
+def add_bkpl(x, theta, bkpl, out):
+    """ Adds the broken power laws of a table (LineTableModel.bkpl) to out."""
+    for b in range(bkpl.shape[0]):
+        centre = 0.
+        for t in range(4, bkpl.shape[1], 2):
+            if bkpl[b,t+1] >= 0:
+                centre += bkpl[b,t]*(1+theta[int(bkpl[b,t+1])])/1e4
+        out += BKPLG(x, theta[int(bkpl[b,0])], centre, theta[int(bkpl[b,1])], theta[int(bkpl[b,2])], theta[int(bkpl[b,3])])
+    return out
+
+@numba.njit(cache=True)
+def table_model(x, theta, lines, cont, bkpl, k=0., lsf=None, edges=None):
+    """ Model of a line table on x - k, lsf and edges as in Compiled_models.lines_model (the broken power laws are
+    not truncated, broadened or integrated, as in Compiled_models)."""
+    peaks, centres, sigs = table_lines(theta, lines)
+    c, c_wv, c_grad = table_continuum(theta, cont)
+    y = lines_model(x, c, c_wv, c_grad, peaks, centres, sigs, k, lsf, edges)
+    return add_bkpl(x, theta, bkpl, y)
+
+@numba.njit(cache=True)
+def table_chi2(x, flux, error, theta, lines, cont, bkpl, k=0., lsf=None, edges=None):
+    """ chi2 of a line table model - the fused Chi2_kernels.chi2_lines unless the table has broken power laws."""
+    peaks, centres, sigs = table_lines(theta, lines)
+    c, c_wv, c_grad = table_continuum(theta, cont)
+    if bkpl.shape[0] == 0:
+        return chi2_lines(x, flux, error, c, c_wv, c_grad, peaks, centres, sigs, k, lsf, edges)
+
+    model = lines_model(x, c, c_wv, c_grad, peaks, centres, sigs, k, lsf, edges)
+    add_bkpl(x, theta, bkpl, model)
+    chi2 = 0.
+    for i in range(len(x)):
+        term = (flux[i]-model[i])**2/(error[i]*error[i])
+        if not np.isnan(term):
+            chi2 += term
+    return chi2
+
+@numba.njit(cache=True)
+def table_chi2_block(x, flux, error, thetas, lines, cont, bkpl, k=0., lsf=None, edges=None):
+    """ table_chi2 of each walker of the block thetas (nwalkers, ndim)."""
+    chi2 = np.empty(thetas.shape[0])
+    for w in range(thetas.shape[0]):
+        chi2[w] = table_chi2(x, flux, error, thetas[w], lines, cont, bkpl, k, lsf, edges)
+    return chi2
+
+@numba.njit(cache=True)
+def table_design(x, theta, lines, cont, bkpl, column, k=0., lsf=None, edges=None):
+    """ Model of a line table split by amplitude (Fitting linear mode). column maps each index of theta to its
+    row of the design matrix (-1 for the parameters that are not amplitudes). Returns the part of the model that
+    does not scale with the amplitudes (offset) and the model of each amplitude set to 1 (design, (namps, len(x))).
+    The amplitudes have to be line peaks, continuum normalisations or broken power law peaks only."""
+    unit = theta.copy()
+    namps = 0
+    for i in range(len(column)):
+        if column[i] >= 0:
+            unit[i] = 1.
+            namps = max(namps, column[i]+1)
+    offset = np.zeros(len(x))
+    design = np.zeros((namps, len(x)))
+
+    peaks, centres, sigs = table_lines(unit, lines)
+    if lsf is not None:
+        peaks, sigs = broaden(x, lsf, peaks, centres, sigs)
+    for l in range(lines.shape[0]):
+        c = column[int(lines[l,2])]
+        out = offset if c < 0 else design[c]
+        if edges is not None:
+            add_lines_integrated(edges, peaks[l:l+1], centres[l:l+1], sigs[l:l+1], k, out)
+        else:
+            add_lines(x, peaks[l:l+1], centres[l:l+1], sigs[l:l+1], k, out)
+
+    if cont[0] >= 0:
+        c = column[int(cont[0])]
+        out = offset if c < 0 else design[c]
+        norm, c_wv, c_grad = table_continuum(unit, cont)
+        for i in range(len(x)):
+            out[i] += norm*(x[i]/c_wv)**(-c_grad)
+
+    for b in range(bkpl.shape[0]):
+        c = column[int(bkpl[b,0])]
+        add_bkpl(x, unit, bkpl[b:b+1], offset if c < 0 else design[c])
+    return offset, design
+
+
+class LineTableModel:
+    """ Compiled model of a LineTable - use build to get one.
+
+    Called as model(x, *params) - with the FeII template name after the parameters for FeII tables - it returns the
+    model like the python model functions. k, lsf and edges can follow as in Compiled_models, so it can be used
+    wherever a compiled model is. chi2 is the fused model+chi2 kernel with the Chi2_kernels signature (without
+    the FeII template, see Chi2_kernels.FeII_kernel).
+
+    Attributes
+    ----------
+
+    labels : list
+        names of the parameters in theta
+
+    lines : 2D array
+        one row per line - wave, z, peak, ratio, ratio_par, vel, vel_wave, fwhm, width_wave, width_z, width_vel -
+        with the parameters as indices of theta (-1 if not used)
+
+    cont : array
+        norm, grad, z (indices of theta, -1 if there is no continuum) and the rest wavelength of the pivot
+
+    bkpl : 2D array
+        one row per broken power law - peak, sig, alp1, alp2 (indices of theta) and (wave, z) of each term of the break
+
+    """
+    vectorized = False # evaluated walker by walker (Fitting.model_eval_vectorized)
+
+    def __init__(self, table):
+        self.table = table
+        self.labels = list(table.labels)
+        self.FeII = table.FeII
+        self.reference = table.reference
+        if table.name is not None:
+            self.__name__ = table.name
+        index = {name: i for i, name in enumerate(self.labels)}
+        slot = lambda name: -1 if name is None else index[name]
+
+        self.lines = np.array([[line.wave, slot(line.z), slot(line.peak), line.ratio, slot(line.ratio_par), slot(line.vel),
+                                line.vel_wave, slot(line.fwhm), line.width_wave, slot(line.width_z), line.width_vel]
+                               for line in table.lines], dtype=float).reshape(len(table.lines), 11)
+
+        continuum = table.continuum
+        if continuum is None:
+            self.cont = np.array([-1., -1., -1., 1.])
+        else:
+            self.cont = np.array([slot(continuum.norm), slot(continuum.grad), slot(continuum.z), continuum.wave], dtype=float)
+
+        nterms = max([len(component.centre) for component in table.bkpl], default=0)
+        self.bkpl = np.full((len(table.bkpl), 4+2*nterms), -1.)
+        for b, component in enumerate(table.bkpl):
+            self.bkpl[b,:4] = [slot(component.peak), slot(component.sig), slot(component.alp1), slot(component.alp2)]
+            for t, (wave, z) in enumerate(component.centre):
+                self.bkpl[b,4+2*t:6+2*t] = wave, slot(z)
+
+    def theta(self, params):
+        theta = np.asarray(params, dtype=float)
+        if theta.ndim != 1:
+            raise ValueError('LineTableModel does not broadcast over walkers')
+        return np.ascontiguousarray(theta)
+
+    def __call__(self, x, *args):
+        n = len(self.labels)
+        theta = self.theta(args[:n])
+        rest = args[n:]
+        if self.FeII:
+            template, rest = rest[0], rest[1:]
+        k, lsf, edges = tuple(rest) + (0., None, None)[len(rest):]
+        x = np.ascontiguousarray(x, dtype=float)
+        y = table_model(x, theta, self.lines, self.cont, self.bkpl, k, lsf, edges)
+        if self.FeII:
+            y = y + theta[-2]*Fem.FeII_functions[template](x, theta[0], theta[-1])
+        return y
+
+    def chi2(self, x, flux, error, theta, k=0., lsf=None, edges=None):
+        return table_chi2(x, flux, error, self.theta(theta), self.lines, self.cont, self.bkpl, k, lsf, edges)
+
+    def chi2_block(self, x, flux, error, thetas, k=0., lsf=None, edges=None):
+        """ chi2 of a block of walkers thetas (nwalkers, ndim) in one compiled call (Chi2_kernels.chi2_block)."""
+        thetas = np.ascontiguousarray(thetas, dtype=float)
+        return table_chi2_block(x, flux, error, thetas, self.lines, self.cont, self.bkpl, k, lsf, edges)
+
+    def nonlinear_slots(self):
+        """ Indices of theta the model is not linear in - all but the line, continuum and broken power law peaks."""
+        slots = set(self.lines[:, [1,4,5,7,9]].ravel()) | set(self.cont[1:3]) | set(self.bkpl[:,1:4].ravel()) | \
+                set(self.bkpl[:,5::2].ravel())
+        if self.FeII:
+            slots |= {0, len(self.labels)-1}
+        return sorted(int(slot) for slot in slots if slot >= 0)
+
+    def design(self, x, theta, column, template=None, k=0., lsf=None, edges=None):
+        """ offset and design matrix of the amplitudes of theta marked in column (see table_design) on x - with
+        the FeII template (theta[-2] is its amplitude) for FeII tables."""
+        x = np.ascontiguousarray(x, dtype=float)
+        theta = self.theta(theta)
+        offset, design = table_design(x, theta, self.lines, self.cont, self.bkpl, column, k, lsf, edges)
+        if self.FeII:
+            FeII = Fem.FeII_functions[template](x, theta[0], theta[-1])
+            c = column[len(self.labels)-2]
+            if c < 0:
+                offset += theta[-2]*FeII
+            else:
+                design[c] += FeII
+        return offset, design
+
+    def initial(self, scales, priors=None):
+        """ Initial position of the walkers (pos_l of the fitting methods). The recipe of each label (LineTable.init)
+        is (source, factor) or (source, factor, ball) with source a key of scales (e.g. 'z', 'cont', 'peak'),
+        'prior' (the central value of the prior) or a number, times factor. A label with a nonzero central value in
+        priors starts there instead, as in the fitting methods.
+        """
+        pos_l = np.zeros(len(self.labels))
+        for i, name in enumerate(self.labels):
+            source, factor = self.table.init[name][:2]
+            if isinstance(source, str):
+                value = priors[name][0] if source == 'prior' else scales[source]
+            else:
+                value = source
+            pos_l[i] = value*factor
+            if (priors is not None) and (name in priors) and (priors[name][0] != 0):
+                pos_l[i] = priors[name][0]
+        return pos_l
+
+    def walkers(self, pos_l, nwalkers):
+        """ Walkers in a 10% ball around pos_l - or in the absolute ball of the recipe (e.g. the redshifts)."""
+        pos = np.random.normal(pos_l, abs(pos_l*0.1), (nwalkers, len(pos_l)))
+        for i, name in enumerate(self.labels):
+            recipe = self.table.init[name]
+            if (len(recipe) > 2) and (recipe[2] is not None):
+                pos[:,i] = np.random.normal(pos_l[i], recipe[2], nwalkers)
+        return pos
+
+    def __repr__(self):
+        return 'LineTableModel(%s, %d lines, %d parameters)' %(self.table.name, len(self.lines), len(self.labels))
+
+
+# table signature -> LineTableModel
+built_models = {}
+
+def build(table):
+    """ Compiled model (LineTableModel) of a LineTable - cached by the signature of the table, so building the same
+    table again returns the same object."""
+    key = table.signature()
+    model = built_models.get(key)
+    if model is None:
+        model = LineTableModel(table)
+        built_models[key] = model
+    return model
+
+# =============================================================================
+#  Named models
+# =============================================================================
+def Halpha_NII(peak, NII_peak, fwhm, width_wave=None, **kwargs):
+    """ Halpha and the [NII] doublet (1:3) with the same kinematics."""
+    return [Line('Halpha', peak, fwhm, width_wave=width_wave, **kwargs),
+            Line('NII_r', NII_peak, fwhm, width_wave=width_wave, **kwargs),
+            Line('NII_b', NII_peak, fwhm, ratio=1/3, width_wave=width_wave, **kwargs)]
+
+def SII(SIIr_peak, SIIb_peak, fwhm, **kwargs):
+    """ [SII] doublet with the width taken at Halpha as in the Halpha models."""
+    return [Line('SII_r', SIIr_peak, fwhm, width_wave='Halpha', **kwargs),
+            Line('SII_b', SIIb_peak, fwhm, width_wave='Halpha', **kwargs)]
+
+def OIII(peak, fwhm, blue='OIII_b', width_wave=None, **kwargs):
+    """ [OIII] doublet (1:3). The OIII_models place the blue line 48 A below the red one (blue=5008.24-48)."""
+    return [Line('OIII_r', peak, fwhm, width_wave=width_wave, **kwargs),
+            Line(blue, peak, fwhm, ratio=1/3, width_wave=width_wave, **kwargs)]
+
+def add_table(name, lines, reference=None, **kwargs):
+    line_tables[name] = LineTable(lines, reference=reference, name=name, **kwargs)
+
+# name -> LineTable
+line_tables = {}
+
+# -------------------------------- Halpha --------------------------------
+Halpha_init = {'z': ('z', 1., 0.001), 'cont': ('cont', 1.), 'cont_grad': (0.01, 1.), 'Hal_peak': ('peak', 1/2),
+               'NII_peak': ('peak', 1/4), 'Nar_fwhm': ('prior', 1.), 'SIIr_peak': ('peak', 1/6), 'SIIb_peak': ('peak', 1/6),
+               'Hal_out_peak': ('peak', 1/8), 'NII_out_peak': ('peak', 1/8), 'outflow_fwhm': ('prior', 1.),
+               'outflow_vel': ('prior', 1.)}
+Halpha_BLR_init = dict(Halpha_init, cont_grad=(0.001, 1.), BLR_Hal_peak=('peak', 1/4), BLR_fwhm=('prior', 1.),
+                       zBLR=('prior', 1., 0.001), Halpha_out_peak=('peak', 1/6), NII_out_peak=('peak', 1/6),
+                       outflow_fwhm=(700., 1.), outflow_vel=(-100., 1.))
+
+add_table('Halpha', Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm') + SII('SIIr_peak', 'SIIb_peak', 'Nar_fwhm'),
+          reference=H_models.Halpha, continuum=Continuum('Halpha'),
+          labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak'],
+          init={name: Halpha_init[name] for name in ['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak']})
+
+add_table('Halpha_outflow', line_tables['Halpha'].lines +
+          Halpha_NII('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel', width_vel=False),
+          reference=H_models.Halpha_outflow, continuum=Continuum('Halpha'),
+          labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel'],
+          init=Halpha_init)
+
+Halpha_BLR_lines = Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm', width_wave='Halpha') + SII('SIIr_peak', 'SIIb_peak', 'Nar_fwhm') + \
+                   [Line('Halpha', 'BLR_Hal_peak', 'BLR_fwhm', z='zBLR', width_z='z')]
+Halpha_BLR_labels = ['z', 'cont','cont_grad', 'Hal_peak','BLR_Hal_peak', 'NII_peak', 'Nar_fwhm', 'BLR_fwhm', 'zBLR', 'SIIr_peak', 'SIIb_peak']
+
+add_table('Halpha_wBLR', Halpha_BLR_lines, reference=H_models.Halpha_wBLR, continuum=Continuum('Halpha'),
+          labels=Halpha_BLR_labels, init={name: Halpha_BLR_init[name] for name in Halpha_BLR_labels})
+
+add_table('Halpha_BLR_outflow', Halpha_BLR_lines +
+          Halpha_NII('Halpha_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel', width_vel=False),
+          reference=H_models.Halpha_BLR_outflow, continuum=Continuum('Halpha'),
+          labels=Halpha_BLR_labels + ['Halpha_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel'],
+          init={name: Halpha_BLR_init[name] for name in Halpha_BLR_labels + ['Halpha_out_peak', 'NII_out_peak', 'outflow_fwhm', 'outflow_vel']})
+
+add_table('Hal_QSO_BKPL', Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm') +
+          Halpha_NII('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel', vel_wave='Halpha', width_vel=False),
+          bkpl=[BKPL('BLR_Hal_peak', 'BLR_sig', 'BLR_alp1', 'BLR_alp2', centre=[('Halpha', 'z'), ('Halpha', 'zBLR')])],
+          reference=QSO_models.Hal_QSO_BKPL, continuum=Continuum('Halpha'),
+          labels=['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'Hal_out_peak', 'NII_out_peak',
+                  'outflow_fwhm', 'outflow_vel', 'BLR_Hal_peak', 'zBLR', 'BLR_alp1', 'BLR_alp2', 'BLR_sig'],
+          init=dict(Halpha_init, Hal_out_peak=('peak', 1/6), NII_out_peak=('peak', 1/6), BLR_Hal_peak=('peak', 1.),
+                    zBLR=('prior', 1., 0.001), BLR_alp1=('prior', 1.), BLR_alp2=('prior', 1.), BLR_sig=('prior', 1.)))
+
+# -------------------------------- [OIII] --------------------------------
+OIII_init = {'z': ('z', 1., 0.001), 'cont': ('cont', 1.), 'cont_grad': (0.001, 1.), 'OIII_peak': ('peak', 1/2),
+             'OIII_out_peak': ('peak', 1/6), 'Nar_fwhm': ('prior', 1.), 'outflow_fwhm': ('prior', 1.), 'outflow_vel': ('prior', 1.),
+             'Hbeta_peak': ('peak_beta', 1.), 'Hbeta_out_peak': ('peak_beta', 1/3), 'zBLR': ('z', 1., 0.001),
+             'BLR_Hbeta_peak': ('peak_beta', 1/2), 'BLR_fwhm': ('prior', 1.), 'Fe_peak': ('cont', 1.), 'Fe_fwhm': ('prior', 1.),
+             'BLR_peak': ('peak_beta', 1.), 'BLR_alp1': ('prior', 1.), 'BLR_alp2': ('prior', 1.), 'BLR_sig': ('prior', 1.),
+             'Hb_nar_peak': ('peak_beta', 1/4), 'Hb_out_peak': ('peak_beta', 1/4)}
+
+OIII_gal_lines = OIII('OIII_peak', 'Nar_fwhm', blue=5008.24-48) + [Line('Hbeta', 'Hbeta_peak', 'Nar_fwhm')]
+OIII_outflow_lines = OIII_gal_lines + OIII('OIII_out_peak', 'outflow_fwhm', blue=5008.24-48, vel='outflow_vel') + \
+                     [Line('Hbeta', 'Hbeta_out_peak', 'outflow_fwhm', vel='outflow_vel')]
+OIII_BLR_lines = [Line('Hbeta', 'BLR_Hbeta_peak', 'BLR_fwhm', z='zBLR')]
+OIII_gal_labels = ['z', 'cont','cont_grad', 'OIII_peak', 'Nar_fwhm', 'Hbeta_peak']
+OIII_outflow_labels = ['z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel', 'Hbeta_peak', 'Hbeta_out_peak']
+
+def OIII_table(name, lines, labels, reference, **kwargs):
+    add_table(name, lines, reference=reference, continuum=Continuum('OIII_r'), labels=labels,
+              init={label: OIII_init[label] for label in labels}, **kwargs)
+
+OIII_table('OIII_gal', OIII_gal_lines, OIII_gal_labels, O_models.OIII_gal)
+OIII_table('OIII_outflow', OIII_outflow_lines, OIII_outflow_labels, O_models.OIII_outflow)
+OIII_table('OIII_gal_BLR', OIII_gal_lines + OIII_BLR_lines, OIII_gal_labels + ['zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm'], O_models.OIII_gal_BLR)
+OIII_table('OIII_outflow_BLR', OIII_outflow_lines + OIII_BLR_lines, OIII_outflow_labels + ['zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm'],
+           O_models.OIII_outflow_BLR)
+OIII_table('OIII_gal_BLR_Fe', OIII_gal_lines + OIII_BLR_lines, OIII_gal_labels + ['zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm', 'Fe_peak', 'Fe_fwhm'],
+           O_models.OIII_gal_BLR_Fe, FeII=True)
+OIII_table('OIII_outflow_BLR_Fe', OIII_outflow_lines + OIII_BLR_lines,
+           OIII_outflow_labels + ['zBLR', 'BLR_Hbeta_peak', 'BLR_fwhm', 'Fe_peak', 'Fe_fwhm'], O_models.OIII_outflow_BLR_Fe, FeII=True)
+
+def OIII_QSO_lines(peak, out_peak, fwhm, out_fwhm, vel):
+    """ Narrow and outflow [OIII] of the QSO models - widths at [OIII]5008 and the outflow shifted by vel at [OIII]5008."""
+    return OIII(peak, fwhm, width_wave='OIII_r') + \
+           OIII(out_peak, out_fwhm, width_wave='OIII_r', vel=vel, vel_wave='OIII_r', width_vel=False)
+
+OIII_QSO_BKPL_labels = ['z', 'cont','cont_grad', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel',
+                        'BLR_peak', 'zBLR', 'BLR_alp1', 'BLR_alp2', 'BLR_sig', 'Hb_nar_peak', 'Hb_out_peak']
+OIII_table('OIII_QSO_BKPL', OIII_QSO_lines('OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel') +
+           [Line('Hbeta', 'Hb_nar_peak', 'Nar_fwhm', z='zBLR', width_z='z'),
+            Line('Hbeta', 'Hb_out_peak', 'outflow_fwhm', z='zBLR', width_z='z', vel='outflow_vel', width_vel=False)],
+           OIII_QSO_BKPL_labels, QSO_models.OIII_QSO_BKPL,
+           bkpl=[BKPL('BLR_peak', 'BLR_sig', 'BLR_alp1', 'BLR_alp2', centre=[('Hbeta', 'zBLR'), ('Hbeta', 'zBLR')])])
+
+OIII_QSO_lines_Hb = OIII_QSO_lines('OIIIn_peak', 'OIIIw_peak', 'OIII_fwhm', 'OIII_out', 'out_vel') + \
+                    [Line('Hbeta', 'Hb_BLR1_peak', 'Hb_BLR1_fwhm', vel='Hb_BLR_vel', width_vel=False),
+                     Line('Hbeta', 'Hb_BLR2_peak', 'Hb_BLR2_fwhm', vel='Hb_BLR_vel', width_vel=False),
+                     Line('Hbeta', 'Hb_nar_peak', 'OIII_fwhm'),
+                     Line('Hbeta', 'Hb_out_peak', 'OIII_out', vel='out_vel', width_vel=False)]
+OIII_QSO_labels = ['z', 'cont', 'cont_grad', 'OIIIn_peak', 'OIIIw_peak', 'OIII_fwhm', 'OIII_out', 'out_vel',
+                   'Hb_BLR1_peak', 'Hb_BLR2_peak', 'Hb_BLR1_fwhm', 'Hb_BLR2_fwhm', 'Hb_BLR_vel', 'Hb_nar_peak', 'Hb_out_peak']
+add_table('OIII_QSO', OIII_QSO_lines_Hb, reference=QSO_models.OIII_QSO, continuum=Continuum('OIII_r'), labels=OIII_QSO_labels)
+add_table('OIII_Fe_QSO', OIII_QSO_lines_Hb, reference=QSO_models.OIII_Fe_QSO, continuum=Continuum('OIII_r'),
+          labels=OIII_QSO_labels + ['Fe_peak', 'Fe_fwhm'], FeII=True)
+
+# ---------------------------- Halpha + [OIII] ----------------------------
+Halpha_OIII_init = {'z': ('z', 1., 0.001), 'cont': ('cont', 1.), 'cont_grad': (-0.1, 1.), 'Hal_peak': ('peak_hal', 0.7),
+                    'NII_peak': ('peak_hal', 0.3), 'Nar_fwhm': ('prior', 1.), 'SIIr_peak': ('peak_hal', 0.2),
+                    'SIIb_peak': ('peak_hal', 0.2), 'OIII_peak': ('peak_OIII', 0.8), 'Hbeta_peak': ('peak_hal', 0.2),
+                    'outflow_fwhm': ('prior', 1.), 'outflow_vel': ('prior', 1.), 'Hal_out_peak': ('peak_hal', 0.3),
+                    'NII_out_peak': ('peak_hal', 0.3), 'OIII_out_peak': ('peak_OIII', 0.2), 'Hbeta_out_peak': ('peak_hal', 0.05),
+                    'BLR_fwhm': ('prior', 1.), 'zBLR': ('prior', 1., 0.00001), 'BLR_Hal_peak': ('peak_hal', 0.3),
+                    'BLR_Hbeta_peak': ('peak_hal', 0.1), 'Fe_peak': ('cont', 1.), 'Fe_fwhm': ('prior', 1.)}
+
+def Halpha_OIII_lines(peak, NII_peak, fwhm, SIIr_peak, SIIb_peak, OIII_peak, Hbeta_peak, **kwargs):
+    """ Lines of HO_models.Halpha_OIII - [SII] widths at Halpha and [OIII] widths at [OIII]5008."""
+    lines = Halpha_NII(peak, NII_peak, fwhm, **kwargs)
+    if SIIr_peak is not None:
+        lines += SII(SIIr_peak, SIIb_peak, fwhm, **kwargs)
+    return lines + OIII(OIII_peak, fwhm, width_wave='OIII_r', **kwargs) + [Line('Hbeta', Hbeta_peak, fwhm, **kwargs)]
+
+Halpha_OIII_narrow = Halpha_OIII_lines('Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'OIII_peak', 'Hbeta_peak')
+Halpha_OIII_BLR_lines = [Line('Halpha', 'BLR_Hal_peak', 'BLR_fwhm', z='zBLR', width_z='z'),
+                         Line('Hbeta', 'BLR_Hbeta_peak', 'BLR_fwhm', z='zBLR', width_z='z')]
+Halpha_OIII_labels = ['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak','OIII_peak', 'Hbeta_peak','SIIr_peak', 'SIIb_peak', 'Nar_fwhm']
+
+def Halpha_OIII_table(name, lines, labels, reference, init=None, continuum=Continuum('Halpha'), **kwargs):
+    init = dict(Halpha_OIII_init, **(init or {}))
+    add_table(name, lines, reference=reference, continuum=continuum, labels=labels,
+              init={label: init[label] for label in labels}, **kwargs)
+
+Halpha_OIII_table('Halpha_OIII', Halpha_OIII_narrow,
+                  ['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'Nar_fwhm', 'SIIr_peak', 'SIIb_peak', 'OIII_peak', 'Hbeta_peak'],
+                  HO_models.Halpha_OIII, init={'SIIr_peak': ('peak_hal', 0.15)})
+
+# the narrow [OIII]4960 of Halpha_OIII_outflow has its own width and the outflow widths are taken at the unshifted lines
+Halpha_OIII_table('Halpha_OIII_outflow', Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm') + SII('SIIr_peak', 'SIIb_peak', 'Nar_fwhm') +
+                  OIII('OIII_peak', 'Nar_fwhm') + [Line('Hbeta', 'Hbeta_peak', 'Nar_fwhm')] +
+                  Halpha_NII('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel', width_vel=False) +
+                  OIII('OIII_out_peak', 'outflow_fwhm', vel='outflow_vel', width_vel=False) +
+                  [Line('Hbeta', 'Hbeta_out_peak', 'outflow_fwhm', vel='outflow_vel', width_vel=False)],
+                  Halpha_OIII_labels + ['outflow_fwhm', 'outflow_vel', 'Hal_out_peak','NII_out_peak', 'OIII_out_peak', 'Hbeta_out_peak'],
+                  HO_models.Halpha_OIII_outflow)
+
+Halpha_OIII_table('Halpha_OIII_BLR', Halpha_OIII_narrow +
+                  Halpha_OIII_lines('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', None, None, 'OIII_out_peak', 'Hbeta_out_peak', vel='outflow_vel') +
+                  Halpha_OIII_BLR_lines,
+                  Halpha_OIII_labels + ['outflow_fwhm', 'outflow_vel', 'Hal_out_peak','NII_out_peak', 'OIII_out_peak', 'Hbeta_out_peak',
+                                        'BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak'],
+                  HO_models.Halpha_OIII_BLR, init={'Hbeta_peak': ('peak_hal', 0.3), 'Hbeta_out_peak': ('peak_hal', 0.1)})
+
+Halpha_OIII_table('Halpha_OIII_BLR_simple', Halpha_OIII_narrow + Halpha_OIII_BLR_lines,
+                  Halpha_OIII_labels + ['BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak'],
+                  HO_models.Halpha_OIII_BLR_simple, init={'Hbeta_peak': ('peak_hal', 0.3)})
+
+Halpha_OIII_table('Halpha_OIII_BLR_simple_Fe', Halpha_OIII_narrow + Halpha_OIII_BLR_lines,
+                  Halpha_OIII_labels + ['BLR_fwhm', 'zBLR', 'BLR_Hal_peak', 'BLR_Hbeta_peak', 'Fe_peak', 'Fe_fwhm'],
+                  None, init={'Hbeta_peak': ('peak_hal', 0.3)}, FeII=True)
+
+Halpha_OIII_table('Halpha_OIII_QSO_BKPL', Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm') +
+                  Halpha_NII('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel', vel_wave='Halpha', width_vel=False) +
+                  OIII_QSO_lines('OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel') +
+                  [Line('Hbeta', 'Hbeta_peak', 'Nar_fwhm', z='BLR_vel', width_z='z'),
+                   Line('Hbeta', 'Hbeta_out_peak', 'outflow_fwhm', z='BLR_vel', width_z='z', vel='outflow_vel', width_vel=False)],
+                  ['z', 'cont','cont_grad', 'Hal_peak', 'NII_peak', 'OIII_peak','Hbeta_peak', 'Nar_fwhm',
+                   'Hal_out_peak', 'NII_out_peak','OIII_out_peak', 'Hbeta_out_peak', 'outflow_fwhm', 'outflow_vel',
+                   'Hal_BLR_peak', 'Hbeta_BLR_peak',  'BLR_vel', 'BLR_alp1', 'BLR_alp2', 'BLR_sig'],
+                  QSO_models.Halpha_OIII_QSO_BKPL, continuum=Continuum('OIII_r'),
+                  init={'Hbeta_peak': ('peak_OIII', 0.3), 'Hal_out_peak': ('peak_hal', 0.2), 'OIII_out_peak': ('peak_OIII', 0.4),
+                        'Hbeta_out_peak': ('peak_OIII', 0.2), 'Hal_BLR_peak': ('peak_hal', 0.4), 'Hbeta_BLR_peak': ('peak_OIII', 0.4),
+                        'BLR_vel': ('prior', 1.), 'BLR_alp1': ('prior', 1.), 'BLR_alp2': ('prior', 1.), 'BLR_sig': ('prior', 1.)},
+                  bkpl=[BKPL('Hal_BLR_peak', 'BLR_sig', 'BLR_alp1', 'BLR_alp2', centre=[('Halpha', 'z'), ('Halpha', 'BLR_vel')]),
+                        BKPL('Hbeta_BLR_peak', 'BLR_sig', 'BLR_alp1', 'BLR_alp2', centre=[('Hbeta', 'BLR_vel'), ('Hbeta', 'BLR_vel')])])
+
+# ----------------------------- Full optical -----------------------------
+Full_optical_narrow = Halpha_NII('Hal_peak', 'NII_peak', 'Nar_fwhm') + \
+                      [Line('Hgamma', 'Hgamma_peak', 'Nar_fwhm'), Line('Hdelta', 'Hdelta_peak', 'Nar_fwhm')] + \
+                      OIII('OIII_peak', 'Nar_fwhm') + \
+                      [Line('Hbeta', 'Hbeta_peak', 'Nar_fwhm'),
+                       Line('NeIII_r', 'NeIII_peak', 'Nar_fwhm'), Line('NeIII_b', 'NeIII_peak', 'Nar_fwhm', ratio=0.322),
+                       Line('OII_b', 'OII_peak', 'Nar_fwhm'), Line('OII_r', 'OII_peak', 'Nar_fwhm', ratio_par='OII_rat'),
+                       Line('OIII_auroral', 'OIIIaur_peak', 'Nar_fwhm'), Line('HeI', 'HeI_peak', 'Nar_fwhm'), Line('HeII', 'HeII_peak', 'Nar_fwhm')]
+Full_optical_labels = ['z', 'cont','cont_grad',  'Hal_peak', 'NII_peak', 'OIII_peak', 'Hbeta_peak','Hgamma_peak', 'Hdelta_peak',
+                       'NeIII_peak','OII_peak','OII_rat','OIIIaur_peak', 'HeI_peak','HeII_peak', 'Nar_fwhm']
+Full_optical_init = {'z': ('z', 1., 0.001), 'cont': ('cont', 1.), 'cont_grad': (0.01, 1.), 'Hal_peak': ('peak', 1/2),
+                     'NII_peak': ('peak', 1/4), 'OIII_peak': ('peak', 1/2), 'Hbeta_peak': ('peak', 1/6), 'OII_rat': ('prior', 1.),
+                     'Nar_fwhm': ('prior', 1.), 'outflow_fwhm': ('prior', 1.), 'outflow_vel': ('prior', 1.)}
+
+add_table('Full_optical', Full_optical_narrow, reference=FO_models.Full_optical, continuum=Continuum('Halpha'),
+          labels=Full_optical_labels,
+          init={label: Full_optical_init.get(label, ('peak', 1/8)) for label in Full_optical_labels})
+
+Full_optical_outflow_labels = Full_optical_labels + ['Hal_out_peak', 'OIII_out_peak', 'NII_out_peak', 'Hbeta_out_peak', 'outflow_vel', 'outflow_fwhm']
+add_table('Full_optical_outflow', Full_optical_narrow +
+          Halpha_NII('Hal_out_peak', 'NII_out_peak', 'outflow_fwhm', vel='outflow_vel') +
+          OIII('OIII_out_peak', 'outflow_fwhm', vel='outflow_vel') + [Line('Hbeta', 'Hbeta_out_peak', 'outflow_fwhm', vel='outflow_vel')],
+          reference=FO_models.Full_optical_outflow, continuum=Continuum('Halpha'), labels=Full_optical_outflow_labels,
+          init={label: Full_optical_init.get(label, ('peak', 1/8)) for label in Full_optical_outflow_labels})
+
+# python model function -> name of the table reproducing it
+reference_tables = {table.reference: name for name, table in line_tables.items() if table.reference is not None}
+
+# python model function -> built LineTableModel, filled by table_model_of
+reference_models = {}
+
+def table_model_of(fitted_model):
+    """ LineTableModel of a fitted model - itself if it is one, the built table of a python model function in
+    line_tables or None."""
+    if isinstance(fitted_model, LineTableModel):
+        return fitted_model
+    try:
+        model = reference_models.get(fitted_model)
+        name = reference_tables.get(fitted_model)
+    except TypeError:
+        return None
+    if (model is None) and (name is not None):
+        model = reference_models[fitted_model] = build(line_tables[name])
+    return model
+
+def register(name, table):
+    """ Adds a LineTable to line_tables under name, so that Fitting results of its model can be loaded back
+    (FitResult.model imports the model by name from this module)."""
+    table.name = name
+    line_tables[name] = table
+    return build(table)
+
+def __getattr__(name):
+    # the built models of line_tables as module attributes (Fitting.result.model_name)
+    if name in line_tables:
+        return build(line_tables[name])
+    raise AttributeError(name)
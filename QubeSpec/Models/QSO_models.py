@@ -59,54 +59,8 @@ import numba
 # =============================================================================
 from astropy.convolution import Gaussian1DKernel
 from astropy.convolution import convolve
-from scipy.interpolate import interp1d
-#Loading the template
-from . import FeII_templates as pth
-PATH_TO_FeII = pth.__path__[0]+ '/'
-
-Veron_d = pyfits.getdata(PATH_TO_FeII+ 'Veron-cetty_2004.fits')
-Veron_hd = pyfits.getheader(PATH_TO_FeII+'Veron-cetty_2004.fits')
-Veron_wv = np.arange(Veron_hd['CRVAL1'], Veron_hd['CRVAL1']+ Veron_hd['NAXIS1'])
-
-
-Tsuzuki = np.loadtxt(PATH_TO_FeII+'FeII_Tsuzuki_opttemp.txt')
-Tsuzuki_d = Tsuzuki[:,1]
-Tsuzuki_wv = Tsuzuki[:,0]
-
-BG92 = np.loadtxt(PATH_TO_FeII+'bg92.con')
-BG92_d = BG92[:,1]
-BG92_wv = BG92[:,0]
-
-with open(PATH_TO_FeII+'Preconvolved_FeII.txt', "rb") as fp:
-    Templates= pickle.load(fp)
-
-
-def FeII_Veron(wave,z, FWHM_feii):
-
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['Veron_dat'][:,index]
-
-    fce = interp1d(Veron_wv*(1+z)/1e4, convolved , kind='cubic')
-
-    return fce(wave)
-
-def FeII_Tsuzuki(wave,z, FWHM_feii):
-
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['Tsuzuki_dat'][:,index]
-
-    fce = interp1d(Tsuzuki_wv*(1+z)/1e4, convolved , kind='cubic')
-
-    return fce(wave)
-
-def FeII_BG92(wave,z, FWHM_feii):
-
-    index = find_nearest(Templates['FWHMs'],FWHM_feii)
-    convolved = Templates['BG92_dat'][:,index]
-
-    fce = interp1d(BG92_wv*(1+z)/1e4, convolved , kind='cubic')
-
-    return fce(wave)
+# the templates and their evaluation engine are shared with the OIII models
+from .FeII_models import FeII_Veron, FeII_Tsuzuki, FeII_BG92
 
 
 # =============================================================================
@@ -162,7 +116,7 @@ def OIII_QSO(x, z, cont,cont_grad,\
 
 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_OIII_QSO(theta,priors):
     z, cont,cont_grad,OIIIn_peak, OIIIw_peak, OIII_fwhm,OIII_out, out_vel,\
         Hb_BLR1_peak, Hb_BLR2_peak, Hb_BLR_fwhm1, Hb_BLR_fwhm2, Hb_BLR_vel,\
@@ -241,7 +195,7 @@ def OIII_QSO_BKPL(x, z, cont,cont_grad,\
     return contm+ OIII_nar + OIII_out + Hbeta_BLR + Hbeta_NLR
 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_OIII_QSO_BKPL(theta,priors):
     z, cont,cont_grad,OIIIn_peak, OIIIw_peak, OIII_fwhm,OIII_out, out_vel,\
         Hb_BLR_peak, Hb_BLR_vel, Hb_BLR_alp1, Hb_BLR_alp2, Hb_BLR_sig,\
@@ -264,7 +218,7 @@ def log_prior_OIII_QSO_BKPL(theta,priors):
     return -np.inf
 
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_OIII_QSO_BKPL(theta, priors):
     z, cont,cont_grad,OIIIn_peak, OIIIw_peak, OIII_fwhm,OIII_out, out_vel,\
         Hb_BLR_peak, Hb_BLR_vel, Hb_BLR_alp1, Hb_BLR_alp2, Hb_BLR_sig,\
@@ -339,7 +293,7 @@ def OIII_Fe_QSO(x, z, cont,cont_grad,\
 
     return contm+ OIII_nar + OIII_out + Hbeta_BLR + Hbeta_NLR+ FeII
 
-@numba.njit
+@numba.njit(cache=True)
 def log_prior_OIII_Fe_QSO(theta,priors):
     z, cont,cont_grad,OIIIn_peak, OIIIw_peak, OIII_fwhm,OIII_out, out_vel,\
         Hb_BLR1_peak, Hb_BLR2_peak, Hb_BLR_fwhm1, Hb_BLR_fwhm2, Hb_BLR_vel,\
@@ -408,7 +362,6 @@ def Hal_QSO_BKPL(x, z, cont,cont_grad, Hal_peak, NII_peak, Nar_fwhm, Hal_out_pea
     return contm+Hal_nar+NII_nar_r+NII_nar_b + outflow+ Ha_BLR
 
 
-@numba.njit
 def Halpha_OIII_QSO_BKPL(x, z, cont,cont_grad, Hal_peak, NII_peak, OIII_peak,Hbeta_peak, Nar_fwhm, \
                       Hal_out_peak, NII_out_peak,OIII_out_peak, Hbeta_out_peak,\
                       outflow_fwhm, outflow_vel,\
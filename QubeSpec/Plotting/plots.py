@@ -36,6 +36,7 @@ k= 1.38*10**-23
 arrow = u'$\u2193$'
 
 from ..Models import OIII_models as O_models
+from ..Models import Compiled_models
 
 def gauss(x, k, mu,FWHM):
     sig = FWHM/3e5*mu/2.35482
@@ -408,7 +409,12 @@ def plotting_Halpha_OIII(res, ax,errors=False, residual='none', axres=None, temp
 
         ax.plot(wv_rest[fit_loc], Hal_blr+Hbe_blr, linestyle='dashed',color='lightblue')
 
-def plotting_general(wave, fluxs, ax, sol,fitted_model,error=np.array([1]), residual='none', axres='none'):
+def plotting_general(wave, fluxs, ax, sol,fitted_model,error=np.array([1]), residual='none', axres='none', template=None, tolerance=None, lsf=None, integrate=False):
+    """ Plots the spectrum and the model fitted_model with the parameters sol['popt']. Models with a compiled
+    equivalent are re-evaluated with it, with the Gaussians truncated below tolerance times their peak
+    and broadened by the instrumental lsf if given, integrated over the pixels with integrate (see
+    Models.Compiled_models.evaluate).
+    """
     
     popt = sol['popt']
     z = popt[0]
@@ -425,8 +431,8 @@ def plotting_general(wave, fluxs, ax, sol,fitted_model,error=np.array([1]), resi
     
     ax.plot(wv_rst_sc[fit_loc_sc],flux[fit_loc_sc], drawstyle='steps-mid')
     
-    y_tot = fitted_model(wave[fit_loc], *popt)
-    y_tot_rs = fitted_model(wv_rst_sc[fit_loc_sc]*(1+z)/1e4, *popt)
+    y_tot = Compiled_models.evaluate(fitted_model, wave[fit_loc], popt, template, tolerance, lsf, integrate)
+    y_tot_rs = Compiled_models.evaluate(fitted_model, wv_rst_sc[fit_loc_sc]*(1+z)/1e4, popt, template, tolerance, lsf, integrate)
 
     ax.plot(wv_rest[fit_loc], y_tot, 'r--')
     
@@ -48,18 +48,7 @@ SII_r = 6731
 SII_b = 6718.29
 import time
 
-from .Models import FeII_templates as pth
-try:
-    PATH_TO_FeII = pth.__path__[0]+ '/'
-    with open(PATH_TO_FeII+'/Preconvolved_FeII.txt', "rb") as fp:
-        Templates= pickle.load(fp)
-    has_FeII = True
-    print(has_FeII)
-
-except FileNotFoundError:
-    from .Models.FeII_comp import *
-    its = preconvolve()
-    print(its)
+# The FeII templates are loaded (and built if needed) on first use - see Models.FeII_models.FeII_store
 
 
 
@@ -148,6 +137,8 @@ class Cube:
         self.band = Band
         self.Cube_path = Full_path
         self.flux_norm= norm
+        self.lsf = None # instrumental line spread function used in the fits - see set_lsf
+        self.integrate = False # integrate the lines over the pixels in the fits (Fitting integrate)
 
         if not os.path.isdir(self.savepath+'Diagnostics'):
             os.mkdir(self.savepath+'Diagnostics')
@@ -270,6 +261,32 @@ class Cube:
         else:
             self.save_dummy = 0
 
+    def set_lsf(self, band=None, R=None):
+        """ Sets the instrumental line spread function (Models.LSF.LSF) used by all the following fits of the
+        cube (collapsed and spaxel by spaxel). The lines are then broadened by the instrumental resolution
+        in the models and the fitted FWHMs are the intrinsic ones.
+
+        Parameters
+        ----------
+
+        band : str - optional
+            grating/band. Defaults to self.band, or to the GRATING keyword of the header for NIRSpec.
+
+        R : float, function or (wavelength, R) table - optional
+            resolution to use instead of the tabulated curve of the instrument
+
+        Returns
+        -------
+        The LSF instance (also kept in self.lsf). Set self.lsf = None to fit without it.
+        """
+        from .Models.LSF import LSF
+        if band is None:
+            band = self.band
+            if (self.instrument in ['NIRSPEC_IFU', 'NIRSPEC_IFU_fl']) and hasattr(self, 'header'):
+                band = self.header.get('GRATING', band)
+        self.lsf = LSF(self.instrument, band, R=R)
+        return self.lsf
+
     def divider(self):
         return np.nan
 
@@ -1016,7 +1033,7 @@ class Cube:
 
             plt.tight_layout()
 
-    def fitting_collapse_Halpha(self, plot=1, models = 'BLR', progress=True,er_scale=1, N=6000, priors= {'z': [0,'normal_hat',0, 0, 0,0]}):
+    def fitting_collapse_Halpha(self, plot=1, models = 'BLR', progress=True,er_scale=1, N=6000, priors= {'z': [0,'normal_hat',0, 0, 0,0]}, pool=None):
         
         priors= {'z':[0, 'normal_hat', 0,0,0,0],\
                 'cont':[0,'loguniform',-3,1],\
@@ -1052,11 +1069,11 @@ class Cube:
         
         if models=='BLR':
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='gal')
             
             
-            Fits_blr = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_blr = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_blr.fitting_Halpha(model='BLR')
             
             
@@ -1120,11 +1137,11 @@ class Cube:
                  self.dBIC = BICM-BICS
             '''       
         elif models=='Outflow':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='gal')
             
             
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_Halpha(model='outflow')
             
             
@@ -1158,7 +1175,7 @@ class Cube:
                 self.dBIC = Fits_out.BIC-Fits_sig.BIC
                 
         elif models=='Single_only':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='gal')
         
             self.D1_fit_results = Fits_sig.props
@@ -1173,7 +1190,7 @@ class Cube:
             self.dBIC = 3
         
         elif models=='Outflow_only':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='outflow')
         
             self.D1_fit_results = Fits_sig.props
@@ -1189,7 +1206,7 @@ class Cube:
             
         elif models=='BLR_only':
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='BLR')
         
             self.D1_fit_results = Fits_sig.props
@@ -1205,7 +1222,7 @@ class Cube:
             
         elif models=='QSO_BKPL':
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha(model='QSO_BKPL')
         
             self.D1_fit_results = Fits_sig.props
@@ -1256,7 +1273,7 @@ class Cube:
 
             
             
-    def fitting_collapse_Halpha_OIII(self, plot=1, progress=True,N=6000,models='Single_only', priors= {'z': [0,'normal_hat',0, 0, 0,0]}):
+    def fitting_collapse_Halpha_OIII(self, plot=1, progress=True,N=6000,models='Single_only', priors= {'z': [0,'normal_hat',0, 0, 0,0]}, pool=None):
         
         priors={'z':[0,'normal_hat', 0, 0.,0,0],\
             'cont':[0,'loguniform', -3,1],\
@@ -1295,7 +1312,7 @@ class Cube:
         
         if models=='Single_only':   
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha_OIII(model='gal' )
             
             self.D1_fit_results = Fits_sig.props
@@ -1315,7 +1332,7 @@ class Cube:
             
             
         elif models=='Outflow_only':   
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_Halpha_OIII(model='outflow' )
             
             self.D1_fit_results = Fits_sig.props
@@ -1334,7 +1351,7 @@ class Cube:
             self.dBIC = 3
             
         elif (models=='BLR') | (models=='BLR_only'):   
-             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
              Fits_sig.fitting_Halpha_OIII(model='BLR' )
              
              self.D1_fit_results = Fits_sig.props
@@ -1352,7 +1369,7 @@ class Cube:
              self.dBIC = 3
 
         elif models=='BLR_simple':   
-             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
              Fits_sig.fitting_Halpha_OIII(model='BLR_simple' )
              
              self.D1_fit_results = Fits_sig.props
@@ -1370,7 +1387,7 @@ class Cube:
              self.dBIC = 3
 
         elif models=='QSO_BKPL':   
-             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+             Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
              Fits_sig.fitting_Halpha_OIII(model='QSO_BKPL' )
              
              self.D1_fit_full = Fits_sig
@@ -1424,7 +1441,7 @@ class Cube:
          
         self.fit_plot = [f,baxes]
         
-    def fitting_collapse_OIII(self, plot=1, models='Outflow',simple=1, Fe_template=0,progress=True, N=6000,priors= {'z': [0,'normal_hat',0, 0, 0,0]}):
+    def fitting_collapse_OIII(self, plot=1, models='Outflow',simple=1, Fe_template=0,progress=True, N=6000,priors= {'z': [0,'normal_hat',0, 0, 0,0]}, pool=None):
         
         priors= {'z': [0,'normal_hat',0, 0, 0,0],\
                 'cont':[0,'loguniform',-3,1],\
@@ -1451,10 +1468,10 @@ class Cube:
     
         if models=='Outflow':
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_OIII(model='gal')
                 
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_OIII(model='outflow')
             
             if Fits_out.BIC-Fits_sig.BIC <-2:
@@ -1515,7 +1532,7 @@ class Cube:
             
             
         elif models=='Single_only':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_OIII(model='gal' )
                
             self.D1_fit_results = Fits_sig.props
@@ -1530,7 +1547,7 @@ class Cube:
             self.dBIC = 3
             
         elif models=='Outflow_only':
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_OIII(model='outflow', Fe_template=Fe_template )
                 
             print('BICM', Fits_out.BIC)
@@ -1546,10 +1563,10 @@ class Cube:
             self.dBIC = 3
             
         elif models=='QSO':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_OIII(model='BLR_simple', Fe_template=Fe_template )
                 
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_OIII(model='BLR_outflow', Fe_template=Fe_template )
             
             if Fits_out.BIC-Fits_sig.BIC <-2:
@@ -1581,7 +1598,7 @@ class Cube:
                 self.dBIC = Fits_out.BIC-Fits_sig.BIC
            
         elif models=='QSO_bkp':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_OIII(model='QSO_BKPL',Fe_template=Fe_template)
                 
             self.D1_fit_results = Fits_sig.props
@@ -1614,7 +1631,7 @@ class Cube:
 
         self.fit_plot = [f,ax1,ax2]  
     
-    def fitting_collapse_optical(self, plot=1, models='Outflow', progress=True, N=6000,priors= {'z': [0,'normal_hat',0, 0, 0,0]}):
+    def fitting_collapse_optical(self, plot=1, models='Outflow', progress=True, N=6000,priors= {'z': [0,'normal_hat',0, 0, 0,0]}, pool=None):
         
         priors= {'z': [0,'normal_hat',0, 0, 0,0],\
                 'cont':[0,'loguniform',-3,1],\
@@ -1641,10 +1658,10 @@ class Cube:
     
         if models=='Outflow':
             
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_optical(model='gal')
                 
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_optical(model='outflow')
             
             if Fits_out.BIC-Fits_sig.BIC <-2:
@@ -1679,7 +1696,7 @@ class Cube:
             
             
         elif models=='Single_only':
-            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_sig = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_sig.fitting_optical(model='gal' )
                
             self.D1_fit_results = Fits_sig.props
@@ -1692,7 +1709,7 @@ class Cube:
             self.dBIC = 3
             
         elif models=='Outflow_only':
-            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors)
+            Fits_out = emfit.Fitting(wave, flux, error, self.z,N=N,progress=progress, priors=priors, pool=pool, lsf=self.lsf, integrate=self.integrate)
             Fits_out.fitting_optical(model='outflow' )
                 
             print('BICM', Fits_out.BIC)
@@ -1721,7 +1738,7 @@ class Cube:
         self.fit_plot = [f,ax1,ax2]  
             
     
-    def fitting_collapse_general(self,fitted_model, labels, priors, logprior, nwalkers=64,use=np.array([]), N=6000 ):
+    def fitting_collapse_general(self,fitted_model, labels, priors, logprior, nwalkers=64,use=np.array([]), N=6000, pool=None ):
         wave = self.obs_wave.copy()
         flux = self.D1_spectrum.copy()
         error = self.D1_spectrum_er.copy()
@@ -1730,7 +1747,7 @@ class Cube:
         if len(use)==0:
             use = np.linspace(0, len(wave)-1, len(wave), dtype=int)
             
-        Fits_gen = emfit.Fitting(wave[use], flux[use], error[use], z, priors=priors, N=10000)
+        Fits_gen = emfit.Fitting(wave[use], flux[use], error[use], z, priors=priors, N=10000, pool=pool, lsf=self.lsf, integrate=self.integrate)
         Fits_gen.fitting_general(fitted_model, labels, logprior, nwalkers=nwalkers)
         
         self.D1_fit_results = Fits_gen.props
@@ -1947,7 +1964,9 @@ class Cube:
         
 
     def unwrap_cube(self, rad=0.4,mask_manual=0, sp_binning='Nearest', add='', binning_pix=1, err_range=[0], boundary=2.4,instrument='NIRSPEC05'):
-        """ Unwrapping the cube to prep it for spaxel-by-spaxel fitting. Saves the output as a pickle .txt object. 
+        """ Unwrapping the cube to prep it for spaxel-by-spaxel fitting. Saves the spectra as a memory-mapped
+        unwrapped cube (directory <ID>_<band>_Unwrapped_cube<add>, see Fitting.unwrapped). Older pickled
+        _Unwrapped_cube<add>.txt files are converted when they are first opened (or with emfit.convert_unwrapped).
 
 
         Parameters
@@ -1985,7 +2004,6 @@ class Cube:
         shapes = self.dim
 
 
-        ThD_mask = self.sky_clipped.copy()
         z = self.z
         wv_obs = self.obs_wave.copy()
 
@@ -2025,43 +2043,30 @@ class Cube:
         plt.figure()
         plt.imshow(np.ma.array(data=self.Median_stack_white, mask=Spax_mask), origin='lower')
 
-        Unwrapped_cube = []
-        for i in tqdm.tqdm(x):
-            for j in y:
-                if Spax_mask[i,j]==False:
-                   
-                    Spax_mask_pick = ThD_mask.copy()
-                    Spax_mask_pick[:,:,:] = True
-                    if sp_binning=='Nearest':
-                        Spax_mask_pick[:, i-step:i+step, j-step:j+step] = False
-                    if sp_binning=='Single':
-                        Spax_mask_pick[:, i, j] = False
-
-                    if self.instrument=='NIRSPEC_IFU':
-                        total_mask = np.logical_or(Spax_mask_pick, self.sky_clipped)
-                        flx_spax_t = np.ma.array(data=flux.data,mask=total_mask)
-
-                        flx_spax = np.ma.median(flx_spax_t, axis=(1,2))
-                        flx_spax_m = np.ma.array(data = flx_spax.data, mask=self.sky_clipped_1D)
-                        nspaxel= np.sum(np.logical_not(total_mask[22,:,:]))
-                        Var_er = np.sqrt(np.ma.sum(np.ma.array(data=self.error_cube.data, mask= total_mask)**2, axis=(1,2))/nspaxel)
-
-                        error = sp.error_scaling(self.obs_wave, flx_spax_m, Var_er, err_range, boundary,\
-                                                   exp=0)
-
-                    else:
-                        flx_spax_t = np.ma.array(data=flux.data,mask=Spax_mask_pick)
-                        flx_spax = np.ma.median(flx_spax_t, axis=(1,2))
-                        flx_spax_m = np.ma.array(data = flx_spax.data, mask=msk)
+        # spectra of all selected spaxels at once - medians over the binning windows (sp.binned_spectra)
+        spaxels = np.argwhere(Spax_mask[:len(x),:len(y)]==False)
+        if self.instrument=='NIRSPEC_IFU':
+            flx_spax, npix, error_sq = sp.binned_spectra(flux.data, spaxels, step, sp_binning, mask=self.sky_clipped,
+                                                         error=self.error_cube.data)
+            flx_spax_m = np.ma.array(data=flx_spax, mask=np.repeat(self.sky_clipped_1D[None,:], len(spaxels), axis=0))
+            nspaxel = npix[:,22]
+            Var_er = np.ma.sqrt(np.ma.array(data=error_sq, mask=npix==0)/nspaxel[:,None])
+            Var_er.data[nspaxel==0] = 0 # masked as np.ma divided by a zero nspaxel
 
-                        error = stats.sigma_clipped_stats(flx_spax_m,sigma=3)[2] * np.ones(len(flx_spax))
+            error = sp.error_scaling(self.obs_wave, flx_spax_m, Var_er, err_range, boundary,\
+                                       exp=0)
 
-                    Unwrapped_cube.append([i,j,flx_spax_m, error,wv_obs, z])
+        else:
+            flx_spax = sp.binned_spectra(flux.data, spaxels, step, sp_binning)[0]
+            flx_spax_m = np.ma.array(data=flx_spax, mask=np.repeat(msk[None,:], len(spaxels), axis=0))
 
+            error = np.ma.getdata(stats.sigma_clipped_stats(flx_spax_m,sigma=3, axis=1)[2])[:,None] * np.ones(flx_spax.shape)
 
+        Unwrapped_cube = emfit.UnwrappedCube.create(self.savepath+self.ID+'_'+self.band+'_Unwrapped_cube'+add,
+                                                    len(spaxels), wv_obs, z)
+        Unwrapped_cube.set_rows(0, spaxels, flx_spax_m, error)
+        Unwrapped_cube.flush()
         print(len(Unwrapped_cube))
-        with open(self.savepath+self.ID+'_'+self.band+'_Unwrapped_cube'+add+'.txt', "wb") as fp:
-            pickle.dump(Unwrapped_cube, fp)
      
 
     def Regional_Spec(self, center=[30,30], rad=0.4, err_range=None, manual_mask=np.array([]), boundary=None):
@@ -2218,6 +2223,8 @@ class Cube:
         with open(file_path, "rb") as file:
             dataPickle = file.read()
             self.__dict__ = pickle.loads(dataPickle)
+        self.__dict__.setdefault('lsf', None) # cubes saved before the LSF was added
+        self.__dict__.setdefault('integrate', False)
         
         
         
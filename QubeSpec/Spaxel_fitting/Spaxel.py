@@ -9,6 +9,11 @@ import warnings
 import matplotlib.pyplot as plt 
 
 from ..Fitting import Fitting
+from ..Fitting.pool import numba_warmup
+from ..Fitting.result import FitResult, compact_results
+from ..Fitting.unwrapped import UnwrappedCube, RowReader, open_unwrapped
+from .store import ResultStore
+from .waves import warm_schedule
 
 import pickle
 
@@ -19,7 +24,132 @@ from .. import Utils as sp
 import time
 
 
+def fit_pool(fit_spaxel, Unwrapped_cube, Ncores, progress, store=None, serial=False, rows=None, waves=None, seeds=None,
+             lsf=None, integrate=False):
+    """ Fits all of the spaxels in Unwrapped_cube with fit_spaxel on a Pool of Ncores workers. The numba
+    functions are compiled (or loaded from the on-disk cache) first in the main process and then in the 
+    initializer of each worker. The compile time of the run and the latency of the first spaxel are printed.
+    For a memory-mapped UnwrappedCube only the row numbers are sent to the workers, which read the spectra
+    from the mapped files themselves.
+
+    With a ResultStore (store) the spaxels already fitted are skipped and every new row is appended to the
+    store as soon as it is fitted. rows - row numbers of Unwrapped_cube - fits only those spaxels, fitted
+    or not (top-ups). serial=True fits in the main process without a Pool (debugging).
+
+    waves - list of arrays of row numbers (e.g. waves.spaxel_waves) - fits the spaxels wave after wave on the
+    same Pool, each wave once the previous one is in the store. seeds(spaxel) then returns the warm starts
+    passed to fit_spaxel(row, seeds=...) of each spaxel (i,j), computed when its wave starts.
+    lsf and integrate are the settings of the fits (Fitting lsf/integrate), so the numba warm-up also compiles
+    the LSF broadened / pixel integrated kernels they use.
+    Returns the rows fitted in this call.
+    """
+    start_time = time.time()
+
+    tasks = Unwrapped_cube
+    if isinstance(Unwrapped_cube, UnwrappedCube):
+        spaxels = [tuple(ij) for ij in Unwrapped_cube.index.tolist()]
+        fit_spaxel = RowReader(Unwrapped_cube.path, fit_spaxel)
+        tasks = range(len(Unwrapped_cube))
+    else:
+        spaxels = [tuple(row[:2]) for row in Unwrapped_cube]
+
+    if waves is None:
+        waves = [range(len(spaxels)) if rows is None else rows]
+    if (rows is None) and (store is not None):
+        done = store.done()
+        waves = [[n for n in wave if spaxels[n] not in done] for wave in waves]
+        ntasks = sum(len(wave) for wave in waves)
+        if ntasks < len(spaxels):
+            print('%i of %i spaxels already fitted in %s' %(len(spaxels)-ntasks, len(spaxels), store.path))
+    waves = [wave for wave in waves if len(wave)]
+    ntasks = sum(len(wave) for wave in waves)
+
+    def fit_waves(imap):
+        # the tasks (and seeds) of a wave are only made once the previous wave has been consumed by collect
+        for wave in waves:
+            if seeds is None:
+                yield from imap(fit_spaxel, [tasks[n] for n in wave])
+            else:
+                yield from imap(WarmStart(fit_spaxel), [(tasks[n], seeds(spaxels[n])) for n in wave])
+
+    cube_res = []
+    def collect(results):
+        for res in progress(results, total=ntasks):
+            if len(cube_res)==0:
+                print("--- First spaxel fitted in %s seconds ---" % (time.time() - start_time))
+            if store is not None:
+                store.append(res)
+            cube_res.append(res)
+
+    if serial:
+        collect(fit_waves(map))
+        return cube_res
+    if ntasks==0:
+        return cube_res
+
+    compile_time = numba_warmup(lsf=lsf is not None, integrate=integrate)
+    queue = mp.Manager().Queue()
+    with Pool(Ncores, initializer=numba_warmup, initargs=(queue, lsf is not None, integrate)) as pool:
+        collect(fit_waves(pool.imap))
+
+    while not queue.empty():
+        compile_time += queue.get()
+    print("--- numba compilation/cache load in %s seconds (summed over processes) ---" % compile_time)
+    return cube_res
+
+def store_signature(kind, models, priors, N, **settings):
+    """ Signature of the ResultStore of a Spaxel_fitting run: the kind and models followed by a hash
+    (Utils.chain_signature) of the priors, the number of steps N and the other settings of the fits (nwalkers,
+    lsf, integrate, template, ...), so that a run with other priors or settings does not resume the stored one.
+    """
+    return (kind, models, sp.chain_signature(sorted(priors.items()), N, sorted(settings.items())))
+
+class WarmStart:
+    """ Callable sent to the pool workers for the tasks (task, seeds) of a wave: calls fit(task, seeds=seeds)."""
+    def __init__(self, fit):
+        self.fit = fit
+
+    def __call__(self, task):
+        task, seeds = task
+        return self.fit(task, seeds=seeds)
+
+
+def refit_spaxels(fit_spaxel, store, Unwrapped_cube, to_fit, Ncores, progress, plot=False, lsf=None, integrate=False):
+    """ Refits the spaxels to_fit - list of (x,y), i.e. (column, row) as in the maps - on the worker pool of
+    fit_pool and replaces their rows in the store. Each refitted spaxel is plotted if plot. lsf and integrate
+    are passed to fit_pool for the warm-up. Returns the new rows.
+    """
+    spaxels = [(y, x) for x, y in to_fit]
+    rows = Unwrapped_cube.find(spaxels)
+    missing = [(x, y) for (x, y), n in zip(to_fit, rows) if n is None]
+    if missing:
+        print('Spaxels (x,y) not in the unwrapped cube: ', missing)
+    rows = sorted(set(n for n in rows if n is not None))
+
+    cube_res = fit_pool(fit_spaxel, Unwrapped_cube, Ncores, progress, store=store, rows=rows, lsf=lsf, integrate=integrate)
+    if plot:
+        for row in cube_res:
+            plot_refit(row, Unwrapped_cube)
+    return cube_res
+
+def plot_refit(row, Unwrapped_cube):
+    """ Plots the spectrum of a refitted spaxel row with the model of its first fit."""
+    i, j, res = row[:3]
+    if not isinstance(res, FitResult):
+        print('Failed fit x='+str(j)+', y='+str(i))
+        return
+    flux, error, wave = Unwrapped_cube[Unwrapped_cube.find([(i, j)])[0]][2:5]
+    Fits_sig = res.to_fitting(wave, flux, error)
+    f,ax = plt.subplots(1, figsize=(10,5))
+    ax.plot(wave, flux, drawstyle='steps-mid')
+    ax.plot(wave, Fits_sig.yeval, 'r--')
+
+    ax.text(wave[10], 0.9*np.nanmax(Fits_sig.yeval), 'x='+str(j)+', y='+str(i) )
+
+
 class Halpha_OIII:
+    N = 10000 # steps of the emcee of each spaxel fit
+
     def Spaxel_fitting(self, Cube,add='',Ncores=(mp.cpu_count() - 2),models='Single',priors= {'z':[0, 'normal', 0,0.003],\
                                                                                         'cont':[0,'loguniform',-4,1],\
                                                                                         'cont_grad':[0,'normal',0,0.3], \
@@ -61,6 +191,16 @@ class Halpha_OIII:
         Ncores : int - optional
             number of cpus to use to fit - default number of available cpu -1
 
+        restart : bool - optional keyword
+            the fitted spaxels are stored as they finish (ResultStore) and a rerun with the same add only fits
+            the missing or failed spaxels - restart=True discards the stored fits and starts again
+
+        schedule : str - optional keyword
+            'rows' (default) fits the spaxels in the order of the unwrapped cube. 'waves' fits them in rings
+            outward from Cube.center_data (find_center) and starts the walkers of each spaxel from the fits of its
+            fitted neighbours (or from Cube.D1_fit_full without the amplitudes), with a shorter burn-in - see
+            Spaxel_fitting.waves
+
         priors: dict - optional
             dictionary with all of the priors to update
             
@@ -68,12 +208,14 @@ class Halpha_OIII:
                                     
         import pickle
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt', "rb") as fp:
-            Unwrapped_cube= pickle.load(fp)
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
 
         print('import of the unwrap cube - done')
 
         self.priors = priors
+
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
         self.models = models
 
         if Ncores<1:
@@ -82,28 +224,27 @@ class Halpha_OIII:
         progress = kwargs.get('progress', True)
         progress = tqdm.tqdm if progress else lambda x, total=0: x
 
-        with Pool(Ncores) as pool:
-            cube_res = list(progress(
-                pool.imap(
-                    self.fit_spaxel, Unwrapped_cube),
-                total=len(Unwrapped_cube)))
-
-    
-
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha_OIII'+add+'.txt', "wb") as fp:
-            pickle.dump( cube_res,fp)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha_OIII'+add+'.txt',
+                            signature=store_signature('Halpha_OIII', models, priors, self.N, lsf=self.lsf, integrate=self.integrate),
+                            restart=kwargs.get('restart', False))
+        waves, seeds = None, None
+        if kwargs.get('schedule', 'rows')=='waves':
+            waves, seeds = warm_schedule(Cube, Unwrapped_cube, store, 2 if models in ['outflow_both', 'BLR_both'] else 1)
+        fit_pool(self.fit_spaxel, Unwrapped_cube, Ncores, progress, store=store, waves=waves, seeds=seeds,
+                 lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
 
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
     
-    def fit_spaxel(self, lst, progress=False):
+    def fit_spaxel(self, lst, progress=False, compact=True, seeds=None):
 
         i,j,flx_spax_m, error, wave, z = lst
+        seeds = seeds or [None, None] # warm starts of the fits (schedule='waves')
 
         if self.models=='Single':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha_OIII(model='gal' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
             except Exception as _exc_:
@@ -112,9 +253,8 @@ class Halpha_OIII:
                 
         elif self.models=='BLR':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha_OIII(model='BLR' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -124,9 +264,8 @@ class Halpha_OIII:
                 
         elif self.models=='BLR_simple':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha_OIII(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -136,13 +275,11 @@ class Halpha_OIII:
 
         elif self.models=='outflow_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha_OIII(model='gal' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_Halpha_OIII(model='outflow' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -152,13 +289,11 @@ class Halpha_OIII:
         
         elif self.models=='BLR_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha_OIII(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_Halpha_OIII(model='BLR' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -166,6 +301,8 @@ class Halpha_OIII:
                 cube_res = [i,j, {'Failed fit':0}, {'Failed fit':0}]
                 print('Failed fit')
                 
+        if compact:
+            cube_res = compact_results([cube_res])[0]
         return cube_res
 
     
@@ -191,42 +328,35 @@ class Halpha_OIII:
                                                                                         'SIIr_peak':[0,'loguniform', -3,1],\
                                                                                         'SIIb_peak':[0,'loguniform', -3,1],\
                                                                                         'BLR_Hbeta_peak':[0,'loguniform', -3,1]}, **kwargs):
-        import pickle
+        """ Refits the spaxels to_fit - list of (x,y) - in parallel on the same worker pool as Spaxel_fitting and
+        replaces their rows in the results (ResultStore, started from the results file of Spaxel_fitting), which
+        is rewritten at the end. plot=True (keyword) plots each refitted spaxel.
+        """
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw'+add+'.txt', "rb") as fp:
-            Cube_res= pickle.load(fp)
-            
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha_OIII'+add+'.txt', legacy=True)
         print('import of the unwrap cube - done')
-        
-        for j, to_fit_sig in enumerate(to_fit):
-            print(to_fit_sig)
-            for i, row in enumerate(Cube_res):
-                if len(row)==3:
-                    y,x, res = row
-                if len(row)==4:
-                    y,x, res,res2 = row
-                if to_fit_sig[0]==x and to_fit_sig[1]==y:
-                    lst = [x,y, res.fluxs, res.error, res.wave, Cube.z]
-
-                    Cube_res[i] = self.fit_spaxel(lst, progress=True)
-
-                    Fits_sig = Cube_res[i][2]
-                    f,ax = plt.subplots(1, figsize=(10,5))
-                    ax.plot(Fits_sig.wave, Fits_sig.flux, drawstyle='steps-mid')
-                    ax.plot(Fits_sig.wave, Fits_sig.yeval, 'r--')
-
-                    ax.text(Fits_sig.wave[10], 0.9*max(Fits_sig.yeval), 'x='+str(x)+', y='+str(y) )
-
-                    break
-        
-                
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "wb") as fp:
-            pickle.dump( Cube_res,fp)  
+
+        self.priors = priors
+        self.models = models
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
+
+        if Ncores<1:
+            Ncores=1
+        progress = kwargs.get('progress', True)
+        progress = tqdm.tqdm if progress else lambda x, total=0: x
+
+        refit_spaxels(self.fit_spaxel, store, Unwrapped_cube, to_fit, Ncores, progress, plot=kwargs.get('plot', False),
+                      lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
         
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
 
 
 class OIII:
+    N = 10000 # steps of the emcee of each spaxel fit
+
     def __init__(self):
         self.status = 'ok'
 
@@ -261,18 +391,30 @@ class OIII:
         Ncores : int - optional
             number of cpus to use to fit - default number of available cpu -1
 
+        restart : bool - optional keyword
+            the fitted spaxels are stored as they finish (ResultStore) and a rerun with the same add only fits
+            the missing or failed spaxels - restart=True discards the stored fits and starts again
+
+        schedule : str - optional keyword
+            'rows' (default) fits the spaxels in the order of the unwrapped cube. 'waves' fits them in rings
+            outward from Cube.center_data (find_center) and starts the walkers of each spaxel from the fits of its
+            fitted neighbours (or from Cube.D1_fit_full without the amplitudes), with a shorter burn-in - see
+            Spaxel_fitting.waves
+
         priors: dict - optional
             dictionary with all of the priors to update
             
         """
         import pickle
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt', "rb") as fp:
-            Unwrapped_cube= pickle.load(fp)
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
 
         print('import of the unwrap cube - done')
 
         self.priors = priors
+
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
         self.template = template
         self.models = models
 
@@ -282,27 +424,27 @@ class OIII:
         progress = kwargs.get('progress', True)
         progress = tqdm.tqdm if progress else lambda x, total=0: x
 
-        with Pool(Ncores) as pool:
-            cube_res = list(progress(
-                pool.imap(
-                    self.fit_spaxel, Unwrapped_cube),
-                total=len(Unwrapped_cube)))
-                
-
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_OIII'+add+'.txt', "wb") as fp:
-            pickle.dump( cube_res,fp)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_OIII'+add+'.txt',
+                            signature=store_signature('OIII', models, priors, self.N, template=template, lsf=self.lsf,
+                                                      integrate=self.integrate), restart=kwargs.get('restart', False))
+        waves, seeds = None, None
+        if kwargs.get('schedule', 'rows')=='waves':
+            waves, seeds = warm_schedule(Cube, Unwrapped_cube, store, 2 if models in ['outflow_both', 'BLR_both'] else 1)
+        fit_pool(self.fit_spaxel, Unwrapped_cube, Ncores, progress, store=store, waves=waves, seeds=seeds,
+                 lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
 
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
 
-    def fit_spaxel(self, lst, progress=False):
+    def fit_spaxel(self, lst, progress=False, compact=True, seeds=None):
 
         i,j,flx_spax_m, error, wave, z = lst
+        seeds = seeds or [None, None] # warm starts of the fits (schedule='waves')
 
         if self.models=='Single':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_OIII(model='gal' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
             except Exception as _exc_:
@@ -311,9 +453,8 @@ class OIII:
                 
         elif self.models=='BLR':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_OIII(model='BLR' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -323,9 +464,8 @@ class OIII:
                 
         elif self.models=='BLR_simple':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_OIII(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -335,13 +475,11 @@ class OIII:
 
         elif self.models=='outflow_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_OIII(model='gal' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_OIII(model='outflow' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -351,13 +489,11 @@ class OIII:
         
         elif self.models=='BLR_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_OIII(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_OIII(model='BLR' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -365,6 +501,8 @@ class OIII:
                 cube_res = [i,j, {'Failed fit':0}, {'Failed fit':0}]
                 print('Failed fit')
                 
+        if compact:
+            cube_res = compact_results([cube_res])[0]
         return cube_res
 
     def Spaxel_toptup(self, Cube, to_fit ,add='', Ncores=(mp.cpu_count() - 2),models='Single',priors= {'z':[0, 'normal', 0,0.003],\
@@ -389,41 +527,35 @@ class OIII:
                                                                                         'SIIr_peak':[0,'loguniform', -3,1],\
                                                                                         'SIIb_peak':[0,'loguniform', -3,1],\
                                                                                         'BLR_Hbeta_peak':[0,'loguniform', -3,1]}, **kwargs):
-        import pickle
+        """ Refits the spaxels to_fit - list of (x,y) - in parallel on the same worker pool as Spaxel_fitting and
+        replaces their rows in the results (ResultStore, started from the results file of Spaxel_fitting), which
+        is rewritten at the end. plot=True (keyword) plots each refitted spaxel.
+        """
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw'+add+'.txt', "rb") as fp:
-            Cube_res= pickle.load(fp)
-            
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_OIII'+add+'.txt', legacy=True)
         print('import of the unwrap cube - done')
-        
-        for j, to_fit_sig in enumerate(to_fit):
-            print(to_fit_sig)
-            for i, row in enumerate(Cube_res):
-                if len(row)==3:
-                    y,x, res = row
-                if len(row)==4:
-                    y,x, res,res2 = row
-                if to_fit_sig[0]==x and to_fit_sig[1]==y:
-                    lst = [x,y, res.fluxs, res.error, res.wave, Cube.z]
-
-                    Cube_res[i] = self.fit_spaxel(lst, progress=True)
-
-                    Fits_sig = Cube_res[i][2]
-                    f,ax = plt.subplots(1, figsize=(10,5))
-                    ax.plot(Fits_sig.wave, Fits_sig.flux, drawstyle='steps-mid')
-                    ax.plot(Fits_sig.wave, Fits_sig.yeval, 'r--')
-
-                    ax.text(Fits_sig.wave[10], 0.9*max(Fits_sig.yeval), 'x='+str(x)+', y='+str(y) )
-
-                    break
-        
-                
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "wb") as fp:
-            pickle.dump( Cube_res,fp)  
+
+        self.priors = priors
+        self.models = models
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
+        self.template = kwargs.get('template', getattr(self, 'template', 0))
+
+        if Ncores<1:
+            Ncores=1
+        progress = kwargs.get('progress', True)
+        progress = tqdm.tqdm if progress else lambda x, total=0: x
+
+        refit_spaxels(self.fit_spaxel, store, Unwrapped_cube, to_fit, Ncores, progress, plot=kwargs.get('plot', False),
+                      lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
         
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
   
 class Halpha:
+    N = 10000 # steps of the emcee of each spaxel fit
+
     def __init__(self):
         self.status = 'ok'
 
@@ -459,18 +591,30 @@ class Halpha:
         Ncores : int - optional
             number of cpus to use to fit - default number of available cpu -1
 
+        restart : bool - optional keyword
+            the fitted spaxels are stored as they finish (ResultStore) and a rerun with the same add only fits
+            the missing or failed spaxels - restart=True discards the stored fits and starts again
+
+        schedule : str - optional keyword
+            'rows' (default) fits the spaxels in the order of the unwrapped cube. 'waves' fits them in rings
+            outward from Cube.center_data (find_center) and starts the walkers of each spaxel from the fits of its
+            fitted neighbours (or from Cube.D1_fit_full without the amplitudes), with a shorter burn-in - see
+            Spaxel_fitting.waves
+
         priors: dict - optional
             dictionary with all of the priors to update
             
         """
         import pickle
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt', "rb") as fp:
-            Unwrapped_cube= pickle.load(fp)
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
 
         print('import of the unwrap cube - done')
 
         self.priors = priors
+
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
         self.models = models
 
         if Ncores<1:
@@ -479,26 +623,27 @@ class Halpha:
         progress = kwargs.get('progress', True)
         progress = tqdm.tqdm if progress else lambda x, total=0: x
 
-        with Pool(Ncores) as pool:
-            cube_res = list(progress(
-                pool.imap(
-                    self.fit_spaxel, Unwrapped_cube),
-                total=len(Unwrapped_cube)))
-
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha'+add+'.txt', "wb") as fp:
-            pickle.dump( cube_res,fp)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha'+add+'.txt',
+                            signature=store_signature('Halpha', models, priors, self.N, lsf=self.lsf, integrate=self.integrate),
+                            restart=kwargs.get('restart', False))
+        waves, seeds = None, None
+        if kwargs.get('schedule', 'rows')=='waves':
+            waves, seeds = warm_schedule(Cube, Unwrapped_cube, store, 2 if models in ['outflow_both', 'BLR_both'] else 1)
+        fit_pool(self.fit_spaxel, Unwrapped_cube, Ncores, progress, store=store, waves=waves, seeds=seeds,
+                 lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
 
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
 
-    def fit_spaxel(self, lst, progress=False):
+    def fit_spaxel(self, lst, progress=False, compact=True, seeds=None):
 
         i,j,flx_spax_m, error, wave, z = lst
+        seeds = seeds or [None, None] # warm starts of the fits (schedule='waves')
 
         if self.models=='Single':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha(model='gal' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
             except Exception as _exc_:
@@ -507,9 +652,8 @@ class Halpha:
                 
         elif self.models=='BLR':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha(model='BLR' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -519,9 +663,8 @@ class Halpha:
                 
         elif self.models=='BLR_simple':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
                 cube_res  = [i,j, Fits_sig]
                 
@@ -531,13 +674,11 @@ class Halpha:
 
         elif self.models=='outflow_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha(model='gal' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_Halpha(model='outflow' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -547,13 +688,11 @@ class Halpha:
         
         elif self.models=='BLR_both':
             try:
-                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_sig = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
                 Fits_sig.fitting_Halpha(model='BLR_simple' )
-                Fits_sig.fitted_model = 0
                 
-                Fits_out = Fitting(wave, flx_spax_m, error, z,N=10000,progress=progress, priors=self.priors)
+                Fits_out = Fitting(wave, flx_spax_m, error, z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[1])
                 Fits_out.fitting_Halpha(model='BLR' )
-                Fits_out.fitted_model = 0
                 
                 cube_res  = [i,j,Fits_sig, Fits_out ]
             except Exception as _exc_:
@@ -561,6 +700,8 @@ class Halpha:
                 cube_res = [i,j, {'Failed fit':0}, {'Failed fit':0}]
                 print('Failed fit')
                 
+        if compact:
+            cube_res = compact_results([cube_res])[0]
         return cube_res
     
     def Spaxel_toptup(self, Cube, to_fit ,add='', Ncores=(mp.cpu_count() - 2),models='Single',priors= {'z':[0, 'normal', 0,0.003],\
@@ -585,37 +726,28 @@ class Halpha:
                                                                                         'SIIr_peak':[0,'loguniform', -3,1],\
                                                                                         'SIIb_peak':[0,'loguniform', -3,1],\
                                                                                         'BLR_Hbeta_peak':[0,'loguniform', -3,1]}, **kwargs):
-        import pickle
+        """ Refits the spaxels to_fit - list of (x,y) - in parallel on the same worker pool as Spaxel_fitting and
+        replaces their rows in the results (ResultStore, started from the results file of Spaxel_fitting), which
+        is rewritten at the end. plot=True (keyword) plots each refitted spaxel.
+        """
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw'+add+'.txt', "rb") as fp:
-            Cube_res= pickle.load(fp)
-            
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_Halpha'+add+'.txt', legacy=True)
         print('import of the unwrap cube - done')
-        
-        for j, to_fit_sig in enumerate(to_fit):
-            print(to_fit_sig)
-            for i, row in enumerate(Cube_res):
-                if len(row)==3:
-                    y,x, res = row
-                if len(row)==4:
-                    y,x, res,res2 = row
-                if to_fit_sig[0]==x and to_fit_sig[1]==y:
-                    lst = [x,y, res.fluxs, res.error, res.wave, Cube.z]
-
-                    Cube_res[i] = self.fit_spaxel(lst, progress=True)
-
-                    Fits_sig = Cube_res[i][2]
-                    f,ax = plt.subplots(1, figsize=(10,5))
-                    ax.plot(Fits_sig.wave, Fits_sig.flux, drawstyle='steps-mid')
-                    ax.plot(Fits_sig.wave, Fits_sig.yeval, 'r--')
-
-                    ax.text(Fits_sig.wave[10], 0.9*max(Fits_sig.yeval), 'x='+str(x)+', y='+str(y) )
-
-                    break
-        
-                
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "wb") as fp:
-            pickle.dump( Cube_res,fp)  
+
+        self.priors = priors
+        self.models = models
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
+
+        if Ncores<1:
+            Ncores=1
+        progress = kwargs.get('progress', True)
+        progress = tqdm.tqdm if progress else lambda x, total=0: x
+
+        refit_spaxels(self.fit_spaxel, store, Unwrapped_cube, to_fit, Ncores, progress, plot=kwargs.get('plot', False),
+                      lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
         
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
        
@@ -653,16 +785,28 @@ class general:
 
         Ncores : int - optional
             number of cpus to use to fit - default number of available cpu -1
+
+        restart : bool - optional keyword
+            the fitted spaxels are stored as they finish (ResultStore) and a rerun with the same add only fits
+            the missing or failed spaxels - restart=True discards the stored fits and starts again
+
+        schedule : str - optional keyword
+            'rows' (default) fits the spaxels in the order of the unwrapped cube. 'waves' fits them in rings
+            outward from Cube.center_data (find_center) and starts the walkers of each spaxel from the fits of its
+            fitted neighbours (or from Cube.D1_fit_full without the amplitudes), with a shorter burn-in - see
+            Spaxel_fitting.waves
             
         """
         import pickle
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add+'.txt', "rb") as fp:
-            Unwrapped_cube= pickle.load(fp)
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
             
         print('import of the unwrap cube - done')
         
         self.priors= priors
+        
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
         self.fitted_model = fitted_model
         self.labels = labels
         self.logprior = logprior
@@ -680,31 +824,36 @@ class general:
             warnings.warn(
                 '\u001b[5;33mDebug mode - no multiprocessing!\033[0;0m',
                 UserWarning)
-            cube_res = list(progress(
-                self.fit_spaxel, Unwrapped_cube),
-                    total=len(Unwrapped_cube))
-        else:
-            with Pool(Ncores) as pool:
-                cube_res = list(progress(
-                    pool.imap(
-                        self.fit_spaxel, Unwrapped_cube),
-                    total=len(Unwrapped_cube)))
-                
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "wb") as fp:
-            pickle.dump( cube_res,fp)  
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt',
+                            signature=store_signature('general', getattr(fitted_model, '__name__', str(fitted_model)), priors, N,
+                                                      labels=tuple(labels), logprior=getattr(logprior, '__name__', str(logprior)),
+                                                      nwalkers=nwalkers, use=tuple(np.asarray(use).tolist()), lsf=self.lsf,
+                                                      integrate=self.integrate),
+                            restart=kwargs.get('restart', False))
+        waves, seeds = None, None
+        if kwargs.get('schedule', 'rows')=='waves':
+            waves, seeds = warm_schedule(Cube, Unwrapped_cube, store, 1)
+        fit_pool(self.fit_spaxel, Unwrapped_cube, Ncores, progress, store=store, serial=debug, waves=waves, seeds=seeds,
+                 lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
         
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
 
 
     def Spaxel_topup(self, Cube, to_fit ,fitted_model, labels, priors, logprior, nwalkers=64,use=np.array([]), N=10000, add='',Ncores=(mp.cpu_count() - 2), **kwargs):
-        import pickle
+        """ Refits the spaxels to_fit - list of (x,y) - in parallel on the same worker pool as Spaxel_fitting and
+        replaces their rows in the results (ResultStore, started from the results file of Spaxel_fitting), which
+        is rewritten at the end. plot=True (keyword) plots each refitted spaxel.
+        """
         start_time = time.time()
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "rb") as fp:
-            Cube_res= pickle.load(fp)
-            
+        Unwrapped_cube = open_unwrapped(Cube.savepath+Cube.ID+'_'+Cube.band+'_Unwrapped_cube'+add)
+        store = ResultStore(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', legacy=True)
         print('import of the unwrap cube - done')
         
         self.priors= priors
+        
+        self.lsf = getattr(Cube, 'lsf', None) # instrumental LSF of the cube (Cube.set_lsf)
+        self.integrate = getattr(Cube, 'integrate', False) # integrate the lines over the pixels
         self.fitted_model = fitted_model
         self.labels = labels
         self.logprior = logprior
@@ -712,45 +861,31 @@ class general:
         self.use = use
         self.N = N     
 
-        for j, to_fit_sig in enumerate(to_fit):
-            print(to_fit_sig)
-            for i, row in enumerate(Cube_res):
-                if len(row)==3:
-                    y,x, res = row
-                
-                if to_fit_sig[0]==x and to_fit_sig[1]==y:
-                    lst = [x,y, res.fluxs, res.error, res.wave, Cube.z]
-
-                    Cube_res[i] = self.fit_spaxel(lst, progress=True)
-
-                    Fits_sig = Cube_res[i][2]
-                    f,ax = plt.subplots(1, figsize=(10,5))
-                    ax.plot(Fits_sig.wave, Fits_sig.flux, drawstyle='steps-mid')
-                    ax.plot(Fits_sig.wave, Fits_sig.yeval, 'r--')
-
-                    ax.text(Fits_sig.wave[10], 0.9*max(Fits_sig.yeval), 'x='+str(x)+', y='+str(y) )
+        if Ncores<1:
+            Ncores=1
+        progress = kwargs.get('progress', True)
+        progress = tqdm.tqdm if progress else lambda x, total=0: x
 
-                    break
-                
-        with open(Cube.savepath+Cube.ID+'_'+Cube.band+'_spaxel_fit_raw_general'+add+'.txt', "wb") as fp:
-            pickle.dump( Cube_res,fp)  
+        refit_spaxels(self.fit_spaxel, store, Unwrapped_cube, to_fit, Ncores, progress, plot=kwargs.get('plot', False),
+                      lsf=self.lsf, integrate=self.integrate)
+        store.finalize(Unwrapped_cube.index)
         
         print("--- Cube fitted in %s seconds ---" % (time.time() - start_time))
     
-    def fit_spaxel(self, lst, progress=False):
+    def fit_spaxel(self, lst, progress=False, compact=True, seeds=None):
         with open(os.getenv("HOME")+'/priors.pkl', "rb") as fp:
             data= pickle.load(fp) 
 
         i,j,flx_spax_m, error, wave, z = lst
+        seeds = seeds or [None] # warm start of the fit (schedule='waves')
         
 
         if len(self.use)==0:
             self.use = np.linspace(0, len(wave)-1, len(wave), dtype=int)
 
         try:
-            Fits_sig = Fitting(wave[self.use], flx_spax_m[self.use], error[self.use], z,N=self.N,progress=progress, priors=self.priors)
+            Fits_sig = Fitting(wave[self.use], flx_spax_m[self.use], error[self.use], z,N=self.N,progress=progress, priors=self.priors, lsf=self.lsf, integrate=self.integrate, warm_start=seeds[0])
             Fits_sig.fitting_general(self.fitted_model, self.labels, self.logprior, nwalkers=self.nwalkers)
-            Fits_sig.fitted_model = 0
         
                 
             cube_res  = [i,j,Fits_sig ]
@@ -759,6 +894,8 @@ class general:
             cube_res = [i,j, {'Failed fit':0}, {'Failed fit':0}]
             print('Failed fit')
         
+        if compact:
+            cube_res = compact_results([cube_res])[0]
         return cube_res
 
 def Spaxel_ppxf(Cube, ncpu=2):
@@ -1 +1,2 @@
-from .Spaxel import *
\ No newline at end of file
+from .Spaxel import *
+from .store import ResultStore
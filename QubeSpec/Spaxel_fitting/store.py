@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only store of the spaxel fits.
+
+Spaxel_fitting appends each spaxel row [i, j, FitResult, ...] to <spaxel_fit_raw file>.store as soon as it comes
+back from the pool, so an interrupted run only loses the spaxels that were being fitted. Running Spaxel_fitting
+again with the same add skips the spaxels already in the store and refits the failed ones. ResultStore.finalize
+writes the legacy spaxel_fit_raw pickle from the store. The rows are indexed by spaxel (i,j), so single spaxels
+can be looked up and replaced (appending a new row for a spaxel replaces the old one) e.g. by the top-ups.
+"""
+import os
+import pickle
+
+
+def failed(row):
+    """ True if any of the fits in the spaxel row [i, j, fit, ...] failed."""
+    return any(isinstance(res, dict) and ('Failed fit' in res) for res in row[2:])
+
+
+class ResultStore:
+    """ Append-only store of spaxel rows, written next to the legacy results file.
+
+    Parameters
+    ----------
+
+    file_path : str
+        legacy results file (..._spaxel_fit_raw_<kind><add>.txt) - the store is file_path with .store
+        instead of .txt and finalize writes file_path
+
+    signature : tuple - optional
+        what was fitted and how (Spaxel.store_signature - class, models and a hash of the priors and fit settings) -
+        resuming a store written with another signature raises
+
+    restart : bool - optional
+        discard the stored fits and start again
+
+    legacy : bool - optional
+        if there is no store yet, fill it with the rows of an existing legacy results file (file_path)
+
+    """
+    def __init__(self, file_path, signature=None, restart=False, legacy=False):
+        self.file_path = file_path
+        self.path = (file_path[:-4] if file_path.endswith('.txt') else file_path)+'.store'
+        self.signature = signature
+        self.rows = {} # last stored row of each spaxel (i,j)
+
+        if restart and os.path.isfile(self.path):
+            os.remove(self.path)
+        if legacy and (not os.path.isfile(self.path)) and os.path.isfile(file_path):
+            self.import_legacy()
+        self.load()
+
+    def import_legacy(self):
+        """ Starts the store from the rows of the legacy results file (Fitting instances are compacted)."""
+        from ..Fitting.result import compact_results
+        with open(self.file_path, "rb") as fp:
+            rows = pickle.load(fp)
+        with open(self.path, 'wb') as fp:
+            pickle.dump({'signature': self.signature}, fp)
+            for row in compact_results(rows):
+                pickle.dump(row, fp)
+
+    def load(self):
+        """ Reads the store. A record cut short by a crash is dropped (and truncated from the file)."""
+        if not os.path.isfile(self.path):
+            self.write_header()
+            return
+
+        with open(self.path, 'rb') as fp:
+            try:
+                header = pickle.load(fp)
+            except Exception:
+                header = None
+            if not isinstance(header, dict) or ('signature' not in header):
+                fp.close()
+                self.write_header()
+                return
+            if (self.signature is not None) and (header['signature'] is not None) and (tuple(header['signature'])!=tuple(self.signature)):
+                raise Exception('Results in '+self.path+' were fitted with '+str(header['signature'])+' not '+str(self.signature)+\
+                                '. Use a different add or restart=True.')
+            end = fp.tell()
+            while True:
+                try:
+                    row = pickle.load(fp)
+                except EOFError:
+                    break
+                except Exception:
+                    print('Dropping the incomplete last record of '+self.path)
+                    break
+                self.rows[tuple(row[:2])] = row
+                end = fp.tell()
+
+        if end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(end)
+
+    def write_header(self):
+        with open(self.path, 'wb') as fp:
+            pickle.dump({'signature': self.signature}, fp)
+        self.rows = {}
+
+    def append(self, row):
+        """ Appends a spaxel row (replacing any earlier row of the same spaxel) and makes sure it is on disk."""
+        with open(self.path, 'ab') as fp:
+            pickle.dump(row, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.rows[tuple(row[:2])] = row
+
+    def done(self):
+        """ Set of the spaxels (i,j) with a successful fit in the store."""
+        return {key for key, row in self.rows.items() if not failed(row)}
+
+    def finalize(self, order=None):
+        """ Writes the legacy results file (pickled list of spaxel rows) from the store and returns the rows.
+
+        Parameters
+        ----------
+
+        order : list of (i,j) - optional
+            spaxels to write and their order, e.g. the index of the unwrapped cube. Default all spaxels in the
+            order they were stored.
+        """
+        keys = list(self.rows) if order is None else [tuple(int(v) for v in key) for key in order]
+        missing = [key for key in keys if key not in self.rows]
+        if missing:
+            print(len(missing), 'spaxels are not in '+self.path+' and are left out of '+self.file_path)
+        rows = [self.rows[key] for key in keys if key in self.rows]
+
+        with open(self.file_path, "wb") as fp:
+            pickle.dump(rows, fp)
+        return rows
+
+    def __getitem__(self, spaxel):
+        return self.rows[tuple(spaxel)]
+
+    def __contains__(self, spaxel):
+        return tuple(spaxel) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return 'ResultStore(%s, %i spaxels)' %(self.path, len(self))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spatially ordered fitting of the spaxels (Spaxel_fitting schedule='waves').
+
+The spaxels are fitted in waves - square rings around the centre of the galaxy (Cube.find_center) - one wave after
+the other on the same worker pool. The walkers of each spaxel start from the posteriors of its already fitted
+neighbours (median of their medians and 1 sigma widths, see neighbour_seeds), read from the ResultStore, and the
+fit is then run with the shorter burn-in of Fitting warm_start. Spaxels without a fitted neighbour (the centre,
+islands of the mask) start the non-amplitude parameters (redshift, widths, velocities) from the 1D fit of the
+cube (Cube.D1_fit_full) and keep the full burn-in.
+"""
+import numpy as np
+
+from ..Fitting.result import FitResult
+
+
+def spaxel_waves(index, center):
+    """ Row numbers of the spaxels index ((N,2) array of (i,j)) grouped in waves of increasing distance from
+    center ((x,y), i.e. (column, row) as Cube.center_data[1:3]). The distance is the Chebyshev distance, so every
+    spaxel of a wave touches a spaxel of the previous one. Returns a list of arrays, empty waves are left out.
+    """
+    index = np.asarray(index)
+    ring = np.rint(np.maximum(abs(index[:,0]-center[1]), abs(index[:,1]-center[0]))).astype(int)
+    order = np.argsort(ring, kind='stable')
+    bounds = np.flatnonzero(np.diff(ring[order]))+1
+    return np.split(order, bounds)
+
+def amplitude(name):
+    """ True for the labels that scale with the flux of the spaxel (line peaks and continuum)."""
+    return ('_peak' in name) | (name=='cont')
+
+def reference_seed(Fits):
+    """ Warm start (label: (value, sigma)) from the 1D fit of the cube (Fitting or FitResult, e.g.
+    Cube.D1_fit_full) - without the amplitudes, which do not apply to a single spaxel. None if there is no fit."""
+    props = getattr(Fits, 'props', None)
+    if not props:
+        return None
+    seed = {}
+    for name in getattr(Fits, 'labels', []):
+        if amplitude(name) or (name not in props):
+            continue
+        p50, p16, p84 = np.asarray(props[name], dtype=float)[:3]
+        seed[name] = (p50, 0.5*(p16+p84))
+    return seed
+
+def neighbour_seeds(store, spaxel, nfits, reference=None):
+    """ Warm starts of the nfits fits of spaxel (i,j) from the successful fits of its 8 neighbours in store:
+    the median of their medians with sigma the median 1 sigma width combined with the scatter between them.
+    Fits without a fitted neighbour get reference (see reference_seed). Returns a list of nfits dict or None.
+    """
+    i, j = spaxel
+    rows = [store.rows.get((i+di, j+dj)) for di in (-1,0,1) for dj in (-1,0,1) if di or dj]
+    rows = [row for row in rows if row is not None]
+
+    seeds = []
+    for k in range(nfits):
+        results = [row[2+k] for row in rows if (len(row)>2+k) and isinstance(row[2+k], FitResult)]
+        if len(results)==0:
+            seeds.append(reference)
+            continue
+        seed = {}
+        for name in results[0].labels:
+            p = np.array([res.percentiles[res.labels.index(name)] for res in results if name in res.labels], dtype=float)
+            seed[name] = (np.median(p[:,0]), np.hypot(np.median(0.5*(p[:,1]+p[:,2])), np.std(p[:,0])))
+        seeds.append(seed)
+    return seeds
+
+def warm_schedule(Cube, Unwrapped_cube, store, nfits):
+    """ Waves (spaxel_waves around Cube.center_data) and seeds function (spaxel -> neighbour_seeds) of
+    Spaxel_fitting schedule='waves', to pass to fit_pool."""
+    center = getattr(Cube, 'center_data', None)
+    if center is None:
+        center = np.median(Unwrapped_cube.index, axis=0)[::-1]
+        print('Cube.center_data not set (find_center) - the waves start from the middle of the spaxels x,y=', center)
+    else:
+        center = center[1:3]
+    reference = reference_seed(getattr(Cube, 'D1_fit_full', None))
+    waves = spaxel_waves(Unwrapped_cube.index, center)
+    return waves, lambda spaxel: neighbour_seeds(store, spaxel, nfits, reference)
@@ -876,38 +876,92 @@ def pickle_save(file_path, stuff):
     with open(file_path, "wb") as fp:
         pickle.dump(stuff, fp)
 
+def chain_signature(*items):
+    """ Hash (hex string) identifying a fit for chain_backend - e.g. the labels, model name, priors and the fitted
+    data. Arrays are hashed by their float64 values, everything else by its repr.
+    """
+    import hashlib
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            digest.update(np.ascontiguousarray(np.ma.getdata(item), dtype=float).tobytes())
+        else:
+            digest.update(repr(item).encode())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+def chain_backend(file_path, nwalkers, ndim, name='mcmc', signature=None):
+    """ Opens the emcee HDF5 backend (file_path, group name) where the chains and log probabilities are 
+    appended as the sampler runs. If the file already holds a chain with the same number of walkers and
+    dimensions and the same signature (chain_signature of the fit, stored in the attributes of the group) it is
+    kept so the run can be resumed, otherwise the backend is reset and the new signature is stored.
+
+    Returns
+    -------
+    backend : emcee.backends.HDFBackend
+
+    iteration : int
+        number of steps already stored in the backend
+    """
+    import emcee
+    backend = emcee.backends.HDFBackend(file_path, name=name)
+    try:
+        with backend.open() as f:
+            stored = f[name].attrs.get('signature', None)
+        if (backend.shape == (nwalkers, ndim)) & (backend.iteration>0) & (stored == signature):
+            return backend, backend.iteration
+        if backend.iteration>0:
+            print('Chain in '+file_path+' ('+name+') is from a different fit - starting again')
+    except (OSError, KeyError):
+        pass
+    backend.reset(nwalkers, ndim)
+    if signature is not None:
+        with backend.open('a') as f:
+            f[name].attrs['signature'] = signature
+    return backend, 0
+
 def error_scaling(obs_wave,flux, error_var, err_range, boundary, exp=0):
+    """ Rescales the propagated error (error_var) to the scatter of the flux in err_range (the whole spectrum if
+    err_range has neither 2 nor 4 elements). flux and error_var can also be (Nspax, Nwave) arrays of spectra,
+    which are all rescaled at once.
+    """
     error= np.zeros_like(flux)
     from astropy import stats
 
+    axis = None if np.ndim(flux)==1 else -1
+    def clipped_stat(data, stat):
+        value = stats.sigma_clipped_stats(data, sigma=3, axis=axis)[stat]
+        return value if axis is None else np.ma.getdata(value)[:,None]
+
     if len(err_range)==2:
-        error1 = stats.sigma_clipped_stats(flux[(err_range[0]<obs_wave) \
-                                                    &(obs_wave<err_range[1])],sigma=3)[2]
+        error1 = clipped_stat(flux[...,(err_range[0]<obs_wave) \
+                                                    &(obs_wave<err_range[1])], 2)
         
-        average_var1 = stats.sigma_clipped_stats(error_var[(err_range[0]<obs_wave) \
-                                                    &(obs_wave<err_range[1])],sigma=3)[1]
+        average_var1 = clipped_stat(error_var[...,(err_range[0]<obs_wave) \
+                                                    &(obs_wave<err_range[1])], 1)
         error = error_var*(error1/average_var1)
 
     elif len(err_range)==4:
-        error1 = stats.sigma_clipped_stats(flux[(err_range[0]<obs_wave) \
-                                                    &(obs_wave<err_range[1])],sigma=3)[2]
-        error2 = stats.sigma_clipped_stats(flux[(err_range[2]<obs_wave) \
-                                                    &(obs_wave<err_range[3])],sigma=3)[2]
-        
-        average_var1 = stats.sigma_clipped_stats(error_var[(err_range[0]<obs_wave) \
-                                                    &(obs_wave<err_range[1])],sigma=3)[1]
-        average_var2 = stats.sigma_clipped_stats(error_var[(err_range[2]<obs_wave) \
-                                                    &(obs_wave<err_range[3])],sigma=3)[1]
-        
-        error[obs_wave<boundary] = error_var[obs_wave<boundary]*(error1/average_var1)
-        error[obs_wave>boundary] = error_var[obs_wave>boundary]*(error2/average_var2)
+        error1 = clipped_stat(flux[...,(err_range[0]<obs_wave) \
+                                                    &(obs_wave<err_range[1])], 2)
+        error2 = clipped_stat(flux[...,(err_range[2]<obs_wave) \
+                                                    &(obs_wave<err_range[3])], 2)
+        
+        average_var1 = clipped_stat(error_var[...,(err_range[0]<obs_wave) \
+                                                    &(obs_wave<err_range[1])], 1)
+        average_var2 = clipped_stat(error_var[...,(err_range[2]<obs_wave) \
+                                                    &(obs_wave<err_range[3])], 1)
+        
+        error[...,obs_wave<boundary] = error_var[...,obs_wave<boundary]*(error1/average_var1)
+        error[...,obs_wave>boundary] = error_var[...,obs_wave>boundary]*(error2/average_var2)
     else:
-        error1 = stats.sigma_clipped_stats(flux,sigma=3)[2]
+        error1 = clipped_stat(flux, 2)
                 
-        average_var1 = stats.sigma_clipped_stats(flux,sigma=3)[1]
+        average_var1 = clipped_stat(flux, 1)
         error = error_var/(error1/average_var1)
             
-    error[error==0] = np.mean(error)*10
+    zero = error==0
+    error[zero] = np.broadcast_to(np.mean(error, axis=-1, keepdims=True)*10, error.shape)[zero]
 
     if exp==1:
         try:
@@ -917,6 +971,116 @@ def error_scaling(obs_wave,flux, error_var, err_range, boundary, exp=0):
 
     return error
 
+def slice_bounds(index, n):
+    """ Start of python slices index:... on an axis of length n (negative values counted from the end, clipped to
+    the axis), element wise for an array of index."""
+    index = np.where(index<0, index+n, index)
+    return np.clip(index, 0, n)
+
+def binning_windows(shape, spaxels, step=1, sp_binning='Nearest'):
+    """ Spatial binning window of each spaxel in Cube.unwrap_cube.
+
+    Parameters
+    ----------
+
+    shape : tuple
+        spatial shape of the cube
+
+    spaxels : (N,2) array
+        (i,j) of the spaxels
+
+    step : int
+        binning_pix of unwrap_cube
+
+    sp_binning : str
+        'Nearest' - the box [i-step:i+step, j-step:j+step] (with python slicing rules at the edges), 'Single' - the spaxel
+
+    Returns
+    -------
+    start : (N,2) array
+        first row and column of each window
+
+    size : (N,2) array
+        number of rows and columns of each window
+    """
+    spaxels = np.asarray(spaxels, dtype=int).reshape(-1,2)
+    if sp_binning=='Single':
+        return spaxels, np.ones_like(spaxels)
+    if sp_binning!='Nearest':
+        raise Exception('sp_binning not understood. Available: Nearest, Single')
+    start = np.empty_like(spaxels)
+    size = np.empty_like(spaxels)
+    for axis in range(2):
+        start[:,axis] = slice_bounds(spaxels[:,axis]-step, shape[axis])
+        size[:,axis] = np.maximum(slice_bounds(spaxels[:,axis]+step, shape[axis])-start[:,axis], 0)
+    return start, size
+
+def binned_spectra(data, spaxels, step=1, sp_binning='Nearest', mask=None, error=None, max_size=2e7):
+    """ Median spectra of the spatial binning windows (binning_windows) of all spaxels at once. The windows
+    of the same size are gathered in blocks of spaxels from the (Nwave, Ny, Nx) cube and reduced together, giving
+    the same medians as np.ma.median over the cube masked outside of each window.
+
+    Parameters
+    ----------
+
+    data : (Nwave, Ny, Nx) array
+        flux cube
+
+    spaxels, step, sp_binning :
+        see binning_windows
+
+    mask : (Nwave, Ny, Nx) bool array - optional
+        pixels to leave out of the medians (e.g. Cube.sky_clipped)
+
+    error : (Nwave, Ny, Nx) array - optional
+        error cube to sum in quadrature over the same pixels
+
+    max_size : float - optional
+        maximum number of gathered pixels in one block
+
+    Returns
+    -------
+    spectra : (N, Nwave) array
+        median spectra - 0 where all of the pixels of the window are masked (as in np.ma.median)
+
+    npix : (N, Nwave) int array
+        number of unmasked pixels in each window
+
+    error_sq : (N, Nwave) array or None
+        sum of error**2 over the unmasked pixels of each window
+    """
+    nwave = data.shape[0]
+    start, size = binning_windows(data.shape[1:], spaxels, step, sp_binning)
+    spectra = np.zeros((len(start), nwave))
+    npix = np.zeros((len(start), nwave), dtype=int)
+    error_sq = None if error is None else np.zeros((len(start), nwave))
+
+    for window in np.unique(size, axis=0):
+        members = np.where((size==window).all(axis=1))[0]
+        npixel = window[0]*window[1]
+        if npixel==0:
+            continue
+        block = max(1, int(max_size//(nwave*npixel)))
+        for first in range(0, len(members), block):
+            sel = members[first:first+block]
+            rows = start[sel,0,None,None] + np.arange(window[0])[None,:,None]
+            cols = start[sel,1,None,None] + np.arange(window[1])[None,None,:]
+            pixels = data[:, rows, cols].reshape(nwave, len(sel), npixel)
+            if mask is None:
+                spectra[sel] = np.median(pixels, axis=-1).T
+                npix[sel] = npixel
+                if error is not None:
+                    error_sq[sel] = np.sum(error[:, rows, cols].reshape(nwave, len(sel), npixel)**2, axis=-1).T
+            else:
+                pixel_mask = mask[:, rows, cols].reshape(nwave, len(sel), npixel)
+                npix[sel] = np.sum(~pixel_mask, axis=-1).T
+                median = np.ma.median(np.ma.masked_array(pixels, mask=pixel_mask), axis=-1)
+                spectra[sel] = np.where(npix[sel]>0, np.ma.getdata(median).T, 0)
+                if error is not None:
+                    errors = np.ma.masked_array(error[:, rows, cols].reshape(nwave, len(sel), npixel), mask=pixel_mask)
+                    error_sq[sel] = np.ma.getdata(np.ma.sum(errors**2, axis=-1)).T
+    return spectra, npix, error_sq
+
 def where(array, lmin, lmax):
     use = np.where( (array>lmin) & (array<lmax))
     return use
\ No newline at end of file
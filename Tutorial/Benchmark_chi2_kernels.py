@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Before/after benchmark of the fused numba chi2 kernels (QubeSpec.Models.Chi2_kernels)
+on the [OIII] of the example KMOS cube XID 208.
+
+Run from the root of the repository (with QubeSpec installed):
+    python Tutorial/Benchmark_chi2_kernels.py
+"""
+import time
+import numpy as np
+from astropy.io import fits
+from astropy import stats
+
+import QubeSpec.Fitting as emfit
+
+PATH = 'QubeSpec/Example_cubes/XID_208_YJband.fits'
+z = 1.533
+N = 2000
+
+with fits.open(PATH) as hdulist:
+    header = hdulist[1].header
+    data = hdulist[1].data/1e-13
+
+wave = header['CRVAL3'] + (np.arange(header['NAXIS3']) - (header['CRPIX3'] - 1.0))*header['CDELT3']
+flux = np.ma.masked_invalid(np.nansum(data[:,5:10,5:10], axis=(1,2)))
+error = stats.sigma_clipped_stats(flux[(wave>1.20)&(wave<1.24)], sigma=3)[2]*np.ones(len(flux))
+
+for model in ['gal', 'outflow']:
+    timing = {}
+    for use_kernels in [False, True]:
+        np.random.seed(1)
+        Fits = emfit.Fitting(wave, flux.copy(), error, z, N=N, progress=False)
+        Fits.use_kernels = use_kernels
+        start = time.time()
+        Fits.fitting_OIII(model=model)
+        total = time.time()-start
+
+        theta = Fits.flat_samples[:200]
+        start = time.time()
+        for th in theta:
+            Fits.log_probability_general(th)
+        per_call = (time.time()-start)/len(theta)
+
+        timing[use_kernels] = [total, per_call]
+        print(model, 'kernels' if use_kernels else 'python ', ': fit %.1f s, %.0f us per likelihood call, BIC %.1f' %(total, per_call*1e6, Fits.BIC))
+
+    print(model, 'speed-up: fit x%.1f, likelihood x%.1f' %(timing[False][0]/timing[True][0], timing[False][1]/timing[True][1]))
@@ -32,6 +32,7 @@ setup(name='QubeSpec',
         'numba>=0.56.3',
         'tqdm>=4.40.0',
         'emcee>=3.1.0',
+        'h5py',
         'brokenaxes>=0.5.0',
         'corner>=2.2.1',
         'scipy>=1.9.1',
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXAMPLE_CUBE = os.path.join(ROOT, 'QubeSpec', 'Example_cubes', 'XID_208_YJband.fits')
+
+
+@pytest.fixture(scope='session')
+def xid208_spectrum():
+    """ [OIII] spectrum of the example KMOS cube XID 208 (z=1.533) summed over the central spaxels, as in
+    Tutorial/Benchmark_chi2_kernels.py. Returns wave, flux, error and z."""
+    from astropy.io import fits
+    from astropy import stats
+
+    with fits.open(EXAMPLE_CUBE) as hdulist:
+        header = hdulist[1].header
+        data = hdulist[1].data/1e-13
+    wave = header['CRVAL3'] + (np.arange(header['NAXIS3']) - (header['CRPIX3'] - 1.0))*header['CDELT3']
+    flux = np.ma.masked_invalid(np.nansum(data[:,5:10,5:10], axis=(1,2)))
+    error = stats.sigma_clipped_stats(flux[(wave>1.20)&(wave<1.24)], sigma=3)[2]*np.ones(len(flux))
+    return wave, flux, error, 1.533
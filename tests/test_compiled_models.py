@@ -0,0 +1,168 @@
+"""
+The numba compiled models and priors (QubeSpec.Models.Compiled_models), the fused chi2 kernels and the line
+table models (Models.Model_builder) against the python/astropy reference functions on random parameters.
+"""
+import inspect
+
+import numpy as np
+import pytest
+from scipy.stats import norm, uniform, truncnorm
+
+from QubeSpec.Models import Compiled_models, Model_builder, QSO_models
+from QubeSpec.Models.Chi2_kernels import chi2_kernels, chi2_block
+from QubeSpec.Fitting.priors import Prior, logprior_general, logprior_general_scipy
+
+NTRIAL = 20
+TOL = 1e-10
+x = np.linspace(1.0, 4.2, 6000)
+templates = ['BG92', 'Tsuzuki', 'Veron']
+
+
+def random_parameter(rng, name, z):
+    """ Random value of the model parameter name in a range where the lines fall on x."""
+    if name in ['z', 'zBLR']:
+        return z + rng.uniform(-0.005, 0.005)
+    if name=='cont_grad':
+        return rng.uniform(-1, 1)
+    if name=='OII_rat':
+        return rng.uniform(0.5, 1.5)
+    if name=='FeII_fwhm':
+        return rng.uniform(2000, 7900)
+    if ('fwhm' in name) | (name=='OIII_out'):
+        return rng.uniform(200, 5000)
+    if 'vel' in name:
+        return rng.uniform(-500, 200)
+    if ('alp' in name) | (name in ['a1', 'a2']):
+        return rng.uniform(-2, 2)
+    if ('sig' in name):
+        return rng.uniform(1, 10)
+    if name=='center':
+        return rng.uniform(1.4, 1.6)
+    return rng.uniform(0.1, 2)
+
+def relative_difference(expected, result):
+    expected = np.asarray(expected, dtype=float)
+    result = np.asarray(result, dtype=float)
+    return np.max(abs(expected-result))/max(np.max(abs(expected)), 1e-300)
+
+
+@pytest.mark.parametrize('model', list(Compiled_models.compiled_models), ids=lambda model: model.__name__)
+def test_compiled_model(model):
+    rng = np.random.default_rng(1)
+    compiled = Compiled_models.compiled_models[model]
+    names = list(inspect.signature(model).parameters)[1:]
+    for i in range(NTRIAL):
+        z = rng.uniform(1.2, 2.0)
+        params = [random_parameter(rng, name, z) for name in names if name!='template']
+        if 'template' in names:
+            params.append(templates[i%len(templates)])
+        assert relative_difference(model(x, *params), compiled(x, *params)) < TOL
+
+
+@pytest.mark.parametrize('model', list(chi2_kernels), ids=lambda model: model.__name__)
+def test_chi2_kernel(model):
+    """ The fused kernels, alone and on a block of walkers, give the chi2 of the python model."""
+    rng = np.random.default_rng(2)
+    names = list(inspect.signature(model).parameters)[1:]
+    thetas = []
+    for i in range(NTRIAL):
+        z = rng.uniform(1.2, 2.0)
+        thetas.append([random_parameter(rng, name, z) for name in names])
+    thetas = np.array(thetas)
+    flux = model(x, *thetas[0]) + rng.normal(0, 0.1, len(x))
+    error = np.full(len(x), 0.1)
+    expected = np.array([np.sum((flux-model(x, *theta))**2/error**2) for theta in thetas])
+    kernel = chi2_kernels[model]
+    assert relative_difference(expected, [kernel(x, flux, error, theta) for theta in thetas]) < TOL
+    assert relative_difference(expected, chi2_block(kernel, x, flux, error, thetas)) < TOL
+
+    table = Model_builder.table_model_of(model)
+    if table is not None:
+        assert relative_difference(expected, chi2_block(table.chi2, x, flux, error, thetas)) < TOL
+
+
+def random_box_priors(rng, names, theta):
+    """ priors dictionary of the QSO_models box priors near theta - about a tenth of the bounds shifted well away."""
+    priors = {}
+    for name, t in zip(names, theta):
+        t = np.log10(t) if name in Compiled_models.log_names else t
+        shift = rng.uniform(-1, 1)*(1 if rng.uniform()<0.9 else 3)
+        priors[name] = [0, t+shift-1, t+shift+1]
+    return priors
+
+@pytest.mark.parametrize('model', ['OIII_QSO', 'OIII_Fe_QSO'])
+def test_compiled_box_prior(model):
+    rng = np.random.default_rng(3)
+    python_prior = getattr(QSO_models, 'log_prior_'+model).py_func
+    compiled_prior = getattr(Compiled_models, 'log_prior_'+model)
+    names = Compiled_models.prior_names[model]
+    for i in range(10*NTRIAL):
+        theta = np.array([rng.uniform(0.1, 2) if name in Compiled_models.log_names else rng.uniform(-1, 1)
+                          for name in names])
+        priors = random_box_priors(rng, names, theta)
+        assert python_prior(theta, priors) == compiled_prior(theta, Compiled_models.prior_bounds(priors, model))
+
+
+def random_prior_code(rng, theta):
+    """ Random prior code (types 0-5, see Fitting.priors) for the parameters theta (all >0)."""
+    pr_code = np.zeros((len(theta), 5))
+    for i, t in enumerate(theta):
+        kind = rng.integers(0, 6)
+        c = np.log10(t) if kind in [2, 3, 5] else t
+        centre = c + rng.uniform(-0.5, 0.5)
+        if kind in [1, 3]:
+            pr_code[i,:3] = kind, centre-1, centre+1
+        elif kind in [0, 2]:
+            pr_code[i,:3] = kind, centre, rng.uniform(0.1, 1)
+        else:
+            pr_code[i] = kind, centre, rng.uniform(0.1, 1), centre-rng.uniform(0.2, 1), centre+rng.uniform(0.2, 1)
+    return pr_code
+
+def test_log_prior_scipy():
+    rng = np.random.default_rng(4)
+    for i in range(10*NTRIAL):
+        theta = rng.uniform(0.1, 3, size=15)
+        pr_code = random_prior_code(rng, theta)
+        expected = logprior_general_scipy(theta, pr_code)
+        result = Compiled_models.log_prior_scipy(theta, pr_code)
+        assert np.isfinite(expected) == np.isfinite(result)
+        if np.isfinite(expected):
+            assert relative_difference([expected], [result]) < TOL
+
+def test_compiled_prior():
+    """ Prior (single vector and block of walkers) against logprior_general and the constraints."""
+    rng = np.random.default_rng(5)
+    labels = ['p%i' %i for i in range(15)]
+    constraints = [('p0', 'p1', 0.5), ('p2', None, 0.2)]
+    for i in range(10*NTRIAL):
+        thetas = rng.uniform(0.1, 3, size=(8, 15))
+        prior = Prior(random_prior_code(rng, thetas[0]), labels, constraints)
+        block = prior(thetas)
+        for theta, value in zip(thetas, block):
+            expected = logprior_general(theta, prior.pr_code)
+            if (theta[0] < 0.5*theta[1]) | (theta[2] < 0.2):
+                expected = -np.inf
+            assert np.isfinite(expected) == np.isfinite(value) == np.isfinite(prior(theta))
+            if np.isfinite(expected):
+                assert relative_difference([expected], [value]) < TOL
+                assert relative_difference([expected], [prior(theta)]) < TOL
+
+def test_log_prior_OIII_QSO_BKPL():
+    rng = np.random.default_rng(6)
+    for i in range(10*NTRIAL):
+        theta = rng.uniform(0.1, 3, size=15)
+        priors = []
+        for t in theta:
+            kind = rng.integers(0, 3)
+            loc, scale = t + rng.uniform(-0.5, 0.5), rng.uniform(0.1, 1)
+            if kind==0:
+                priors.append(norm(loc, scale))
+            elif kind==1:
+                priors.append(uniform(loc-1, 2))
+            else:
+                priors.append(truncnorm(-rng.uniform(0.2, 2), rng.uniform(0.2, 2), loc=loc, scale=scale))
+        expected = QSO_models.log_prior_OIII_QSO_BKPL.py_func(theta, priors)
+        result = Compiled_models.log_prior_OIII_QSO_BKPL(theta, Compiled_models.frozen_prior_code(priors))
+        assert np.isfinite(expected) == np.isfinite(result)
+        if np.isfinite(expected):
+            assert relative_difference([expected], [result]) < TOL
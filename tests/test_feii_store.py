@@ -0,0 +1,85 @@
+"""
+FeII_store: building, checking and loading the preconvolved FeII template store (on a small FWHM grid).
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from QubeSpec.Models import FeII_comp
+from QubeSpec.Models.FeII_models import FeII_store, template_names
+
+grid = dict(FWHM_min=3000, FWHM_max=3100, FWHM_step=50)
+wave = np.linspace(1.3, 1.6, 200)
+z = 2.
+
+
+@pytest.fixture(scope='module')
+def store_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('cache')/'Preconvolved_FeII')
+    assert FeII_comp.build_store(path, **grid)
+    return path
+
+
+def test_build_store(store_path):
+    assert FeII_comp.read_metadata(store_path) == FeII_comp.store_metadata(**grid)
+    for name in template_names:
+        assert os.path.isfile(os.path.join(store_path, name+'_coeffs.npy'))
+    assert not FeII_comp.build_store(store_path, **grid)
+
+def test_load_store(store_path):
+    store = FeII_store(store_path, **grid)
+    assert not store.loaded
+    for name in template_names:
+        template = store[name](wave, z, 3050.)
+        assert np.all(np.isfinite(template)) and np.max(template) > 0
+    assert store.loaded and not store.rebuilt and not store.in_memory
+
+def test_memory_store(store_path):
+    """ The templates built in memory are the ones read from the store."""
+    store = FeII_store(store_path, **grid)
+    FWHMs, templates = FeII_comp.memory_store(**grid)
+    assert np.array_equal(FWHMs, np.load(os.path.join(store_path, 'FWHMs.npy')))
+    for name in template_names:
+        assert np.allclose(templates[name][1], store[name].coeffs, rtol=1e-12, atol=0)
+
+def test_store_rebuilt_on_new_grid(tmp_path):
+    path = str(tmp_path/'Preconvolved_FeII')
+    store = FeII_store(path, **grid)
+    store.load()
+    assert store.rebuilt
+
+    other = dict(grid, FWHM_max=3150)
+    store = FeII_store(path, **other)
+    store.load()
+    assert store.rebuilt
+    assert FeII_comp.read_metadata(path) == FeII_comp.store_metadata(**other)
+
+    store = FeII_store(path, **other)
+    store.load()
+    assert not store.rebuilt
+
+def test_default_store_path(monkeypatch, tmp_path):
+    monkeypatch.setenv('QUBESPEC_CACHE', str(tmp_path))
+    assert FeII_comp.default_store_path() == os.path.join(str(tmp_path), 'Preconvolved_FeII')
+    monkeypatch.delenv('QUBESPEC_CACHE')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert FeII_comp.default_store_path() == os.path.join(str(tmp_path), 'QubeSpec', 'Preconvolved_FeII')
+
+def test_unwritable_store(store_path):
+    """ A store that cannot be written is built in memory, and sent along when pickled."""
+    store = FeII_store('/dev/null/Preconvolved_FeII', **grid)
+    template = store['BG92'](wave, z, 3050.)
+    assert store.in_memory and store.rebuilt
+    assert np.allclose(template, FeII_store(store_path, **grid)['BG92'](wave, z, 3050.), rtol=1e-12)
+
+    copy = pickle.loads(pickle.dumps(store))
+    assert copy.loaded and np.array_equal(copy['BG92'](wave, z, 3050.), template)
+
+def test_pickled_store_reopens(store_path):
+    store = FeII_store(store_path, **grid)
+    template = store['Veron'](wave, z, 3000.)
+    copy = pickle.loads(pickle.dumps(store))
+    assert not copy.loaded
+    assert np.array_equal(copy['Veron'](wave, z, 3000.), template)
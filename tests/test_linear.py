@@ -0,0 +1,109 @@
+"""
+Linear mode (Fitting linear='nnls'/'marginalise') - the compiled amplitude solvers against scipy and brute
+force integration, and the regression of the linear modes against the default (all parameters sampled) fit of
+the example cube.
+"""
+import numpy as np
+import pytest
+from scipy.optimize import lsq_linear
+from scipy.stats import norm, truncnorm
+
+from QubeSpec.Fitting.linear import bounded_ls, ndtri, solve_amplitudes, truncated_normal
+
+
+def test_ndtri():
+    p = np.array([1e-300, 1e-20, 1e-5, 0.01, 0.3, 0.5, 0.9, 0.999])
+    assert np.allclose([ndtri(q) for q in p], norm.ppf(p), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('a, b', [(-1, 2), (3, 5), (12.9, 500), (40, 41), (-50, -45)])
+def test_truncated_normal(a, b):
+    rng = np.random.default_rng(1)
+    z = np.array([truncated_normal(a, b, u)[0] for u in rng.random(20000)])
+    reference = truncnorm(a, b)
+    assert np.all((z >= a) & (z <= b))
+    assert abs(z.mean()-reference.mean()) < 5*reference.std()/np.sqrt(len(z))
+    assert abs(z.std()/reference.std()-1) < 0.05
+    # mirrored to the lower tail, where logcdf is accurate
+    low, high = (-b, -a) if a > 0 else (a, b)
+    logp = norm.logcdf(high) + np.log1p(-np.exp(norm.logcdf(low)-norm.logcdf(high)))
+    assert np.isclose(truncated_normal(a, b, 0.5)[1], logp, rtol=1e-8)
+
+
+def test_bounded_ls():
+    rng = np.random.default_rng(2)
+    for trial in range(100):
+        A = rng.normal(size=(30, 5))
+        y = rng.normal(size=30)
+        lo = rng.uniform(-1, 0, 5)
+        hi = lo + rng.uniform(0.05, 1, 5)
+        x = bounded_ls(A.T@A, A.T@y, lo, hi)
+        reference = lsq_linear(A, y, bounds=(lo, hi), tol=1e-12).x
+        assert np.all((x >= lo) & (x <= hi))
+        assert np.sum((A@x-y)**2) <= np.sum((A@reference-y)**2) + 1e-8
+
+
+def test_solve_amplitudes_marginal():
+    """ The marginal likelihood estimate is unbiased and the draws respect the prior bounds and constraints."""
+    rng = np.random.default_rng(3)
+    x = np.linspace(0, 1, 60)
+    design = np.array([np.exp(-0.5*((x-0.5)/0.1)**2), np.exp(-0.5*((x-0.55)/0.12)**2)])
+    error = np.full(60, 0.3)
+    flux = 0.8*design[0] + 0.05*design[1] + rng.normal(0, 0.3, 60)
+    args = (design, np.zeros(60), flux, error, np.ones(60, dtype=bool), np.array([-1., 1e-3]), np.array([3., 2.]),
+            np.array([False, True]), np.zeros(2), np.array([0, 1]))
+
+    a = np.linspace(-1, 3, 801)
+    b = np.exp(np.linspace(np.log(1e-3), np.log(2), 1601))
+    A, B = np.meshgrid(a, b, indexing='ij')
+    chi2 = np.sum((flux-A[...,None]*design[0]-B[...,None]*design[1])**2/error**2, axis=-1)
+    density = np.exp(-0.5*chi2)/4/(B*np.log(2/1e-3))
+
+    for cons in [np.zeros((0,3)), np.array([[0, 1, 30.]])]:
+        inside = np.ones(A.shape) if len(cons)==0 else A >= 30*B
+        Z = np.trapezoid(np.trapezoid(density*inside, b, axis=1), a)
+        estimates = []
+        for i in range(4000):
+            amps, logL, sample = solve_amplitudes(*args, cons, False, rng.random((16, 3)))
+            estimates.append(np.exp(logL-np.log(Z)))
+            if np.isfinite(logL):
+                assert (-1 <= sample[0] <= 3) & (1e-3 <= sample[1] <= 2)
+                assert (len(cons)==0) or (sample[0] >= 30*sample[1])
+        assert abs(np.mean(estimates)-1) < 5*np.std(estimates)/np.sqrt(len(estimates))
+
+    amps, logL, sample = solve_amplitudes(*args, np.zeros((0,3)), True, rng.random((16, 3)))
+    assert np.isclose(logL, -0.5*np.min(chi2), rtol=1e-4)
+
+
+LINEAR_LABELS = ['z', 'cont', 'OIII_peak', 'OIII_out_peak', 'Nar_fwhm', 'outflow_fwhm', 'outflow_vel']
+
+def fit_oiii(spectrum, linear, N):
+    import QubeSpec.Fitting as emfit
+    wave, flux, error, z = spectrum
+    np.random.seed(1)
+    Fits = emfit.Fitting(wave, flux.copy(), error, z, N=N, progress=False, linear=linear)
+    Fits.fitting_OIII('outflow')
+    return Fits
+
+@pytest.fixture(scope='module')
+def default_fit(xid208_spectrum):
+    return fit_oiii(xid208_spectrum, None, 10000)
+
+@pytest.mark.parametrize('linear', ['nnls', 'marginalise'])
+def test_linear_matches_default(xid208_spectrum, default_fit, linear):
+    """ Regression on the example cube: the linear modes agree with the default fit within the errors, with
+    errors of the same size, and the amplitudes stay inside their (loguniform) priors."""
+    Fits = fit_oiii(xid208_spectrum, linear, 4000)
+    for name in LINEAR_LABELS:
+        value, low, high = Fits.props[name][:3]
+        ref_value, ref_low, ref_high = default_fit.props[name][:3]
+        sigma = 0.5*(low+high)
+        ref_sigma = 0.5*(ref_low+ref_high)
+        assert abs(value-ref_value) < 2*np.hypot(sigma, ref_sigma), name
+        assert 0.5 < sigma/ref_sigma < 2, name
+
+    for i, name in enumerate(Fits.labels):
+        if ('_peak' in name) | (name=='cont'):
+            code = Fits.pr_code[i]
+            assert code[0] == 3
+            assert np.all((Fits.flat_samples[:,i] >= 10**code[1]) & (Fits.flat_samples[:,i] <= 10**code[2])), name
@@ -0,0 +1,108 @@
+"""
+FitResult: compact result of a fit, its round-trip back to a Fitting and the conversion of legacy pickles.
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+from QubeSpec.Fitting import Fitting
+from QubeSpec.Fitting.result import FitResult, convert_legacy, compact_results, model_name
+from QubeSpec.Models.OIII_models import OIII_gal
+
+wave = np.linspace(1.1, 1.4, 300)
+popt = [1.533, 0.1, 0.0, 2., 400., 0.3]
+labels = ['z', 'cont', 'cont_grad', 'OIII_peak', 'Nar_fwhm', 'Hbeta_peak']
+
+
+def fake_fitting(nsamples=2000, seed=1):
+    """ Fitting instance as left by fitting_general with OIII_gal, without running the sampler."""
+    rng = np.random.default_rng(seed)
+    flux = OIII_gal(wave, *popt) + rng.normal(0, 0.05, len(wave))
+    error = np.full(len(wave), 0.05)
+    Fits = Fitting(wave, flux, error, popt[0])
+    Fits.labels = list(labels)
+    Fits.chains = {'name': 'test'}
+    for name, p in zip(labels, popt):
+        Fits.chains[name] = p + rng.normal(0, 1e-3*(abs(p)+1), nsamples)
+    Fits.props = {'name': 'test'}
+    for name in labels:
+        Fits.props[name] = np.percentile(Fits.chains[name], (50, 16, 84))
+    Fits.props['popt'] = [Fits.props[name][0] for name in labels]
+    use = (wave>1.2) & (wave<1.3)
+    Fits.wave_fitloc = wave[use]
+    Fits.fitted_model = OIII_gal
+    Fits.yeval = OIII_gal(wave, *Fits.props['popt'])
+    Fits.chi2 = 123.
+    Fits.BIC = 150.
+    return Fits
+
+
+def test_fitresult_compact():
+    Fits = fake_fitting()
+    result = FitResult(Fits, nchain=100)
+    assert result.fitted_model == model_name(OIII_gal) == 'QubeSpec.Models.OIII_models:OIII_gal'
+    assert result.chain.shape == (100, len(labels))
+    assert result.chain.dtype == np.float32
+    assert len(result.yeval) == len(Fits.wave_fitloc)
+    assert result.props['popt'] == pytest.approx(Fits.props['popt'], rel=1e-6)
+    assert FitResult(Fits, nchain=0).chain is None
+
+    restored = pickle.loads(pickle.dumps(result))
+    assert restored.labels == result.labels
+    assert np.array_equal(restored.chain, result.chain)
+
+def test_fitresult_to_fitting():
+    Fits = fake_fitting()
+    result = FitResult(Fits)
+    New = result.to_fitting(Fits.wave, Fits.fluxs, Fits.error)
+    assert New.fitted_model is OIII_gal
+    assert New.z == pytest.approx(Fits.props['z'][0], rel=1e-6)
+    assert np.array_equal(New.wave_fitloc, Fits.wave_fitloc)
+    assert np.allclose(New.yeval, Fits.yeval, rtol=1e-5)
+    for name in labels:
+        assert np.allclose(New.props[name], Fits.props[name], rtol=1e-6)
+        assert len(New.chains[name]) == 1000
+    assert New.chi2 == Fits.chi2 and New.BIC == Fits.BIC
+
+def test_fitresult_to_fitting_without_model():
+    """ A model that cannot be imported falls back to the stored model on the fit window."""
+    Fits = fake_fitting()
+    result = FitResult(Fits)
+    result.fitted_model = 'no_such_module:OIII_gal'
+    New = result.to_fitting(Fits.wave, Fits.fluxs, Fits.error)
+    use = result.fit_window(wave)
+    assert New.fitted_model is None
+    assert np.all(np.isnan(New.yeval[~use]))
+    assert np.allclose(New.yeval[use], Fits.yeval[use], rtol=1e-5)
+
+def test_convert_legacy_single(tmp_path):
+    """ A Fitting.save pickle is converted without losing chain samples or precision."""
+    Fits = fake_fitting()
+    path = tmp_path/'legacy.txt'
+    with open(path, 'wb') as fp:
+        pickle.dump(Fits.__dict__, fp)
+
+    result = convert_legacy(str(path), str(tmp_path/'converted.txt'))
+    assert isinstance(result, FitResult)
+    assert result.chain.dtype == np.float64
+    for i, name in enumerate(labels):
+        assert np.array_equal(result.chain[:,i], Fits.chains[name])
+
+    with open(tmp_path/'converted.txt', 'rb') as fp:
+        saved = pickle.load(fp)
+    assert np.array_equal(saved.chain, result.chain)
+
+def test_convert_legacy_spaxels(tmp_path):
+    """ Spaxel rows keep their indices and failed fits."""
+    rows = [[0, 1, fake_fitting(seed=1)], [2, 3, {'Failed fit': 'test'}], [4, 5, fake_fitting(seed=2)]]
+    path = tmp_path/'spaxel_fit_raw.txt'
+    with open(path, 'wb') as fp:
+        pickle.dump(rows, fp)
+
+    converted = convert_legacy(str(path))
+    assert [row[:2] for row in converted] == [row[:2] for row in rows]
+    assert converted[1][2] == {'Failed fit': 'test'}
+    for row, new in zip(rows[::2], converted[::2]):
+        assert np.array_equal(new[2].chain[:,0], row[2].chains['z'])
+    assert compact_results(converted)[1][2] == {'Failed fit': 'test'}
@@ -0,0 +1,96 @@
+"""
+ResultStore: append-only store of the spaxel fits, resuming an interrupted run and refusing to resume a
+store written by a different fit.
+"""
+import os
+import pickle
+
+import pytest
+
+from QubeSpec.Spaxel_fitting.store import ResultStore
+from QubeSpec.Spaxel_fitting.Spaxel import store_signature
+
+priors = {'z': [0, 'normal_hat', 0, 0.003, 0.01, 0.01], 'cont': [0, 'loguniform', -4, 1]}
+signature = store_signature('OIII', 'outflow', priors, 10000, lsf=None, integrate=False, template=0)
+
+
+def row(i, j, value=1.):
+    return [i, j, {'value': value}]
+
+
+def test_store_resume(tmp_path):
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    store = ResultStore(path, signature)
+    assert len(store) == 0
+    store.append(row(0, 0))
+    store.append(row(0, 1))
+    store.append([1, 1, {'Failed fit': 'test'}])
+    store.append(row(0, 0, 2.))
+
+    store = ResultStore(path, signature)
+    assert len(store) == 3
+    assert store[0, 0][2]['value'] == 2.
+    assert store.done() == {(0, 0), (0, 1)}
+    assert (1, 1) in store
+
+def test_store_restart(tmp_path):
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    ResultStore(path, signature).append(row(0, 0))
+    assert len(ResultStore(path, signature, restart=True)) == 0
+
+def test_store_signature_mismatch(tmp_path):
+    """ Other priors, number of steps or settings give another signature and the store is not resumed."""
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    ResultStore(path, signature).append(row(0, 0))
+    assert store_signature('OIII', 'outflow', dict(priors), 10000, integrate=False, lsf=None, template=0) == signature
+
+    others = [store_signature('OIII', 'gal', priors, 10000, lsf=None, integrate=False, template=0),
+              store_signature('OIII', 'outflow', dict(priors, cont=[0, 'loguniform', -3, 1]), 10000,
+                              lsf=None, integrate=False, template=0),
+              store_signature('OIII', 'outflow', priors, 5000, lsf=None, integrate=False, template=0),
+              store_signature('OIII', 'outflow', priors, 10000, lsf=None, integrate=True, template=0)]
+    for other in others:
+        assert other != signature
+        with pytest.raises(Exception):
+            ResultStore(path, other)
+    assert len(ResultStore(path, signature)) == 1
+
+def test_store_incomplete_record(tmp_path):
+    """ A record cut short by a crash is dropped and truncated from the file."""
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    store = ResultStore(path, signature)
+    store.append(row(0, 0))
+    store.append(row(0, 1))
+    size = os.path.getsize(store.path)
+    with open(store.path, 'ab') as fp:
+        fp.write(pickle.dumps(row(0, 2))[:-5])
+
+    store = ResultStore(path, signature)
+    assert len(store) == 2
+    assert os.path.getsize(store.path) == size
+    store.append(row(0, 2))
+    assert len(ResultStore(path, signature)) == 3
+
+def test_store_finalize(tmp_path):
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    store = ResultStore(path, signature)
+    for i, j in [(1, 0), (0, 0), (0, 1)]:
+        store.append(row(i, j))
+
+    rows = store.finalize()
+    assert [r[:2] for r in rows] == [[1, 0], [0, 0], [0, 1]]
+    rows = store.finalize(order=[(0, 0), (0, 1), (2, 2), (1, 0)])
+    assert [r[:2] for r in rows] == [[0, 0], [0, 1], [1, 0]]
+    with open(path, 'rb') as fp:
+        assert pickle.load(fp) == rows
+
+def test_store_legacy(tmp_path):
+    """ A run that only left the legacy results file is resumed from it."""
+    path = str(tmp_path/'spaxel_fit_raw_OIII.txt')
+    with open(path, 'wb') as fp:
+        pickle.dump([row(0, 0), [0, 1, {'Failed fit': 'test'}]], fp)
+
+    store = ResultStore(path, signature, legacy=True)
+    assert len(store) == 2
+    assert store.done() == {(0, 0)}
+    assert len(ResultStore(path, signature)) == 2